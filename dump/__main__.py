@@ -2,27 +2,150 @@
 from __future__ import unicode_literals, division, print_function, absolute_import
 import argparse
 import sys
+import time
 import logging
 
 from dump import __version__
 from dump.interface import postgres
+from dump.compression import CODECS
+from dump.chunkstore import ChunkStore
+from dump.verify import Verifier
+from dump.metrics import JsonLines, PrometheusTextfile
+
+
+def get_interface(kwargs):
+    """return the Postgres interface with the metrics listeners the command line
+    asked for"""
+    events = kwargs.pop("events")
+    prometheus_textfile = kwargs.pop("prometheus_textfile")
+    db = postgres.Postgres(**kwargs)
+    if events:
+        db.metrics.listen(JsonLines(sys.stderr))
+    if prometheus_textfile:
+        db.metrics.listen(PrometheusTextfile(prometheus_textfile))
+    return db
 
 
 def console_backup(args):
     kwargs = vars(args)
     tables = kwargs.pop("tables")
+    all_tables = kwargs.pop("all_tables")
+    jobs = kwargs.pop("jobs")
+    chunks = kwargs.pop("chunks")
+    incremental = kwargs.pop("incremental")
+    watermark = kwargs.pop("watermark")
+    previous = kwargs.pop("previous")
+    track_changes = kwargs.pop("track_changes")
+    resume = kwargs.pop("resume")
+    where = kwargs.pop("where")
+    query = kwargs.pop("query")
+    subset = kwargs.pop("subset")
+    sample = kwargs.pop("sample")
 
-    db = postgres.Postgres(**kwargs)
-    for table in tables:
-        db.table_dump(table)
+    db = get_interface(kwargs)
+    if all_tables:
+        tables = db.get_tables()
+    elif tables:
+        tables = db.get_tables(tables)
+    else:
+        raise ValueError("no tables, pass table names or --all")
+
+    if subset or sample is not None:
+        if len(tables) != 1 or query:
+            raise ValueError("--subset needs exactly one table, the one its rows are picked from, and no --query")
+
+        db.subset_dump(
+            tables[0],
+            where=where,
+            percent=sample,
+            jobs=jobs,
+            chunks=chunks,
+            incremental=incremental,
+            previous=previous,
+            track_changes=track_changes,
+            resume=resume,
+        )
+        db.close()
+        return 0
+
+    queries = None
+    if query:
+        if len(tables) != 1:
+            raise ValueError("--query needs exactly one table, the one its rows are restored into")
+        queries = {tables[0]: query}
+
+    db.tables_dump(
+        tables,
+        jobs=jobs,
+        chunks=chunks,
+        incremental=incremental,
+        watermark=watermark,
+        previous=previous,
+        track_changes=track_changes,
+        resume=resume,
+        where=where,
+        queries=queries,
+    )
+    db.close()
 
     return 0
 
 
 def console_restore(args):
     kwargs = vars(args)
-    db = postgres.Postgres(**kwargs)
-    db.restore()
+    jobs = kwargs.pop("jobs")
+    fast = kwargs.pop("fast")
+    maintenance_work_mem = kwargs.pop("maintenance_work_mem")
+    backend = kwargs.pop("backend")
+    resume = kwargs.pop("resume")
+    tables = kwargs.pop("tables")
+    exclude = kwargs.pop("exclude")
+    target_schema = kwargs.pop("target_schema")
+    target_table = kwargs.pop("target_table")
+    db = get_interface(kwargs)
+    db.restore(
+        jobs=jobs,
+        fast=fast,
+        maintenance_work_mem=maintenance_work_mem,
+        backend=backend,
+        resume=resume,
+        tables=tables,
+        exclude=exclude,
+        target_schema=target_schema,
+        target_table=target_table,
+    )
+    db.close()
+    return 0
+
+
+def console_prune(args):
+    store = ChunkStore(args.store)
+    count, size = store.prune(args.directories)
+    logging.info("------- pruned {} chunks ({} bytes) from {}".format(count, size, args.store))
+    return 0
+
+
+def console_verify(args):
+    start = time.time()
+    verifier = Verifier(directory=args.directory, archive=args.archive, store=args.store)
+    results = verifier.run(jobs=args.jobs)
+    failed = [ret for ret in results if ret["error"]]
+    logging.info("------- checked {} files of {} tables, {} rows, {} raw bytes in {:.2f}s".format(
+        len(results),
+        len(set(ret["table"] for ret in results)),
+        sum(ret.get("rows") or 0 for ret in results),
+        sum(ret.get("raw_bytes") or 0 for ret in results),
+        time.time() - start,
+    ))
+    if failed:
+        logging.error("------- FAILED, {} of {} files are bad: {}".format(
+            len(failed),
+            len(results),
+            ", ".join(ret["name"] for ret in failed),
+        ))
+        return 1
+
+    logging.info("------- PASSED")
     return 0
 
 
@@ -46,6 +169,37 @@ def console():
         help="database server host or socket directory"
     )
     parent_parser.add_argument("-p", "--port", type=int, default=5432, dest="port", help="database server post")
+    parent_parser.add_argument(
+        "--timeout",
+        dest="timeout",
+        type=float,
+        default=None,
+        help="stop if any psql or pg_dump command takes longer than this many seconds"
+    )
+    parent_parser.add_argument(
+        "--archive",
+        dest="archive",
+        default=None,
+        help="backup into or restore from this one file instead of a directory of files, - to backup to stdout"
+    )
+    parent_parser.add_argument(
+        "--store",
+        dest="store",
+        default=None,
+        help="split the backup files into the chunks of this directory, chunks already in it aren't saved again"
+    )
+    parent_parser.add_argument(
+        "--events",
+        dest="events",
+        action="store_true",
+        help="write an event for every file, job and run as a line of json on stderr"
+    )
+    parent_parser.add_argument(
+        "--prometheus-textfile",
+        dest="prometheus_textfile",
+        default=None,
+        help="keep the totals of the files and runs in this file for node_exporter's textfile collector"
+    )
     parent_parser.add_argument(
         "--help",
         action="help",
@@ -66,13 +220,133 @@ def console():
         dest="directory",
         help="directory where the backup files should go"
     )
+    backup_parser.add_argument(
+        "-j", "--jobs",
+        dest="jobs",
+        type=int,
+        default=1,
+        help="how many tables to dump at the same time"
+    )
+    backup_parser.add_argument(
+        "--chunks",
+        dest="chunks",
+        type=int,
+        default=1,
+        help="split the rows of each table into this many parts that can be dumped and restored at the same time"
+    )
+    backup_parser.add_argument(
+        "--incremental",
+        dest="incremental",
+        action="store_true",
+        help="only dump the rows that are new since the last backup into this directory"
+    )
+    backup_parser.add_argument(
+        "--watermark",
+        dest="watermark",
+        default=None,
+        help="the column that only increases for new or updated rows, defaults to the primary key"
+    )
+    backup_parser.add_argument(
+        "--driver",
+        dest="driver",
+        default="psql",
+        choices=postgres.DRIVERS,
+        help="read the rows with psql, or with psycopg2 in this process"
+    )
+    backup_parser.add_argument(
+        "--previous",
+        dest="previous",
+        default=None,
+        help="the directory of an earlier backup, unchanged tables are linked from it instead of dumped again"
+    )
+    backup_parser.add_argument(
+        "--track-changes",
+        dest="track_changes",
+        action="store_true",
+        help="record the version of every table's rows so a later backup with --previous can link the unchanged tables"
+    )
+    backup_parser.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help="keep the tables a failed backup into this --dir finished instead of dumping them again"
+    )
+    backup_parser.add_argument(
+        "--where",
+        dest="where",
+        default=None,
+        help="only dump the rows of each table that match this WHERE clause, like \"created > '2020-01-01'\""
+    )
+    backup_parser.add_argument(
+        "--query",
+        dest="query",
+        default=None,
+        help="dump the rows of this SELECT as the rows of the one table being backed up"
+    )
+    backup_parser.add_argument(
+        "--subset",
+        dest="subset",
+        action="store_true",
+        help="dump the --where or --sample rows of the one table, and every row of any table they reference"
+    )
+    backup_parser.add_argument(
+        "--sample",
+        dest="sample",
+        type=float,
+        default=None,
+        help="with --subset, only this percent of the rows of the table, picked at random"
+    )
+    backup_parser.add_argument(
+        "--no-snapshot",
+        dest="consistent",
+        action="store_false",
+        help="don't dump all the tables from the same snapshot of the db"
+    )
+    backup_parser.add_argument(
+        "--data-format",
+        dest="data_format",
+        choices=postgres.DATA_FORMATS,
+        default="copy",
+        help="how the rows of each table are written, inserts is much slower than copy or binary but is the most portable"
+    )
+    backup_parser.add_argument(
+        "--compression",
+        dest="compression",
+        choices=sorted(CODECS.keys()),
+        default="gzip",
+        help="how the backup files are compressed, zstd needs the zstandard package"
+    )
+    backup_parser.add_argument(
+        "--compression-level",
+        dest="compression_level",
+        type=int,
+        default=None,
+        help="the compression level, defaults to the codec's own default"
+    )
+    backup_parser.add_argument(
+        "--compression-threads",
+        dest="compression_threads",
+        type=int,
+        default=1,
+        help="how many threads compress each file, the output is still one valid compressed file"
+    )
     backup_parser.add_argument(
         "--debug",
         dest="debug",
         action="store_true",
         help="Turn on debugging output"
     )
-    backup_parser.add_argument("tables", nargs="+")
+    backup_parser.add_argument(
+        "--all",
+        dest="all_tables",
+        action="store_true",
+        help="dump every table in every schema"
+    )
+    backup_parser.add_argument(
+        "tables",
+        nargs="*",
+        help="the tables to dump, globs like 'log_*' are matched against the tables in the db"
+    )
     backup_parser.set_defaults(func=console_backup)
 
     restore_parser = subparsers.add_parser(
@@ -86,20 +360,137 @@ def console():
         dest="directory",
         help="directory where the backup files are located"
     )
+    restore_parser.add_argument(
+        "-j", "--jobs",
+        dest="jobs",
+        type=int,
+        default=1,
+        help="how many tables to restore at the same time"
+    )
+    restore_parser.add_argument(
+        "--fast",
+        dest="fast",
+        action="store_true",
+        help="load all the rows before building indexes and adding constraints, with synchronous_commit off"
+    )
+    restore_parser.add_argument(
+        "--maintenance-work-mem",
+        dest="maintenance_work_mem",
+        default="1GB",
+        help="the memory each job can use to build indexes with --fast"
+    )
+    restore_parser.add_argument(
+        "--backend",
+        dest="backend",
+        default="session",
+        choices=postgres.RESTORE_BACKENDS,
+        help="session loads the files through one psql session per job, process starts a psql for every file"
+    )
+    restore_parser.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help="don't load the files a failed restore of this --dir finished loading again"
+    )
+    restore_parser.add_argument(
+        "--exclude",
+        dest="exclude",
+        action="append",
+        default=[],
+        help="don't restore the tables matching this name or glob, can be passed more than once"
+    )
+    restore_parser.add_argument(
+        "--target-schema",
+        dest="target_schema",
+        default=None,
+        help="restore the tables into this schema instead of the one they were dumped from"
+    )
+    restore_parser.add_argument(
+        "--target-table",
+        dest="target_table",
+        default=None,
+        help="load only the rows of the one table being restored into this table"
+    )
     restore_parser.add_argument(
         "--debug",
         dest="debug",
         action="store_true",
         help="Turn on debugging output"
     )
+    restore_parser.add_argument(
+        "tables",
+        nargs="*",
+        help="the tables to restore, globs like 'log_*' are matched against the tables in the backup, defaults to all"
+    )
     restore_parser.set_defaults(func=console_restore)
 
+    prune_parser = subparsers.add_parser(
+        "prune",
+        help="delete the chunks of a store that none of the given backups use",
+    )
+    prune_parser.add_argument(
+        "--store",
+        dest="store",
+        required=True,
+        help="the directory of the chunk store"
+    )
+    prune_parser.add_argument(
+        "--debug",
+        dest="debug",
+        action="store_true",
+        help="Turn on debugging output"
+    )
+    prune_parser.add_argument(
+        "directories",
+        nargs="+",
+        help="the backup directories and archives that are kept, every chunk they use is kept"
+    )
+    prune_parser.set_defaults(func=console_prune)
+
+    verify_parser = subparsers.add_parser(
+        "verify",
+        help="check every file of a backup can be read, without a database",
+    )
+    verify_parser.add_argument(
+        "-D", "--dir", "--directory",
+        dest="directory",
+        help="directory where the backup files are located"
+    )
+    verify_parser.add_argument(
+        "--archive",
+        dest="archive",
+        default=None,
+        help="check this archive instead of a directory"
+    )
+    verify_parser.add_argument(
+        "--store",
+        dest="store",
+        default=None,
+        help="the chunk store the backup was split into"
+    )
+    verify_parser.add_argument(
+        "-j", "--jobs",
+        dest="jobs",
+        type=int,
+        default=None,
+        help="how many files to check at the same time, defaults to the number of cores"
+    )
+    verify_parser.add_argument(
+        "--debug",
+        dest="debug",
+        action="store_true",
+        help="Turn on debugging output"
+    )
+    verify_parser.set_defaults(func=console_verify)
+
     args = parser.parse_args()
 
+    # an archive written to stdout can't have the log mixed in
+    stream = sys.stderr if getattr(args, "archive", None) == "-" else sys.stdout
     if args.debug:
-        logging.basicConfig(format="[%(levelname).1s] %(message)s", level=logging.DEBUG, stream=sys.stdout)
+        logging.basicConfig(format="[%(levelname).1s] %(message)s", level=logging.DEBUG, stream=stream)
     else:
-        logging.basicConfig(format="[%(levelname).1s] %(message)s", level=logging.INFO, stream=sys.stdout)
+        logging.basicConfig(format="[%(levelname).1s] %(message)s", level=logging.INFO, stream=stream)
 
     ret_code = args.func(args)
     return ret_code
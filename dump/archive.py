@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+A whole backup in one file
+
+an archive is the backup files one after the other, each still the complete
+compressed stream (frame) it was as a file, then an index of where each file
+starts and how many bytes it is, then a fixed size trailer:
+
+    <frame> <frame> ... <index> <trailer>
+
+the index is json and the trailer is MAGIC followed by the offset and size of
+the index. Nothing before the end is ever changed once it is written so an
+archive can be written to a pipe or stdout, and a reader finds the index at
+the end and seeks straight to the frames it needs without reading the rest
+"""
+from __future__ import unicode_literals, division, print_function, absolute_import
+import io
+import os
+import json
+import struct
+from collections import OrderedDict
+
+from .compression import CHUNK_SIZE, Reader, find_codec
+
+
+MAGIC = b"DUMPARC1"
+
+# MAGIC, the offset of the index, and the size of the index
+TRAILER = struct.Struct("<8sQQ")
+
+
+class ArchiveWriter(object):
+    """write files into an archive
+
+    :Example:
+        with open("backup.dump", "wb") as fp:
+            writer = ArchiveWriter(fp)
+            writer.add("001_foo.sql.gz", "/some/dir/001_foo.sql.gz")
+            writer.close()
+    """
+    version = 1
+
+    def __init__(self, fp):
+        """
+        fp -- file -- where the archive is written, it is only ever appended to
+        """
+        self.fp = fp
+        self.offset = 0
+        self.files = OrderedDict()
+
+    def add(self, name, path):
+        """copy the file at path into the archive as name"""
+        with open(path, "rb") as fp:
+            self.add_chunks(name, iter(lambda: fp.read(CHUNK_SIZE), b""))
+
+    def add_chunks(self, name, chunks):
+        """write chunks of bytes into the archive as name"""
+        if name in self.files:
+            raise ValueError("{} is already in the archive".format(name))
+
+        size = 0
+        for data in chunks:
+            self.fp.write(data)
+            size += len(data)
+
+        self.files[name] = OrderedDict([("name", name), ("offset", self.offset), ("bytes", size)])
+        self.offset += size
+
+    def close(self):
+        """write the index and the trailer, the archive can't be read without
+        them"""
+        index = json.dumps(OrderedDict([
+            ("version", self.version),
+            ("files", list(self.files.values())),
+        ])).encode("utf-8")
+        self.fp.write(index)
+        self.fp.write(TRAILER.pack(MAGIC, self.offset, len(index)))
+        self.fp.flush()
+
+
+class Member(io.RawIOBase):
+    """a file object of the bytes of one file in an archive, it reads with
+    pread so any number of threads can read the same archive at once"""
+    def __init__(self, fd, offset, size):
+        self.fd = fd
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        size = min(len(b), self.size - self.position)
+        if size <= 0:
+            return 0
+
+        data = os.pread(self.fd, size, self.offset + self.position)
+        if not data:
+            raise EOFError("The archive ended in the middle of a file")
+
+        b[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+class Archive(object):
+    """read the files of an archive"""
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        try:
+            size = os.fstat(self.fd).st_size
+            if size < TRAILER.size:
+                raise ValueError("{} is not an archive".format(path))
+
+            magic, offset, index_size = TRAILER.unpack(os.pread(self.fd, TRAILER.size, size - TRAILER.size))
+            if magic != MAGIC or offset + index_size + TRAILER.size != size:
+                raise ValueError("{} is not an archive, or it was cut off".format(path))
+
+            index = json.loads(os.pread(self.fd, index_size, offset).decode("utf-8"))
+
+        except BaseException:
+            os.close(self.fd)
+            raise
+
+        self.files = OrderedDict((fields["name"], fields) for fields in index["files"])
+
+    def __contains__(self, name):
+        return name in self.files
+
+    def names(self):
+        """return the names of all the files in the archive, in the order they
+        were added"""
+        return list(self.files.keys())
+
+    def get_size(self, name):
+        """return how many bytes the file name is in the archive, 0 if it isn't
+        in it"""
+        fields = self.files.get(name)
+        return fields["bytes"] if fields else 0
+
+    def open_raw(self, name):
+        """return a file object of the bytes of name as they are in the archive"""
+        try:
+            fields = self.files[name]
+        except KeyError:
+            raise IOError("{} is not in {}".format(name, self.path))
+        return io.BufferedReader(Member(self.fd, fields["offset"], fields["bytes"]), buffer_size=CHUNK_SIZE)
+
+    def read_chunks(self, name, codec=None):
+        """yield the decompressed contents of name
+
+        codec -- Codec -- what decompresses name, defaults to the codec of its
+            extension
+        """
+        if codec is None:
+            codec, _ = find_codec(name)
+        with self.open_raw(name) as fp:
+            for data in codec.decompress_chunks(fp):
+                yield data
+
+    def open(self, name, codec=None):
+        """return a file object of the decompressed contents of name"""
+        return io.BufferedReader(Reader(self.read_chunks(name, codec)), buffer_size=CHUNK_SIZE)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
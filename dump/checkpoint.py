@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, division, print_function, absolute_import
+import os
+import json
+import threading
+from collections import OrderedDict
+
+
+class Checkpoint(object):
+    """a journal of the jobs of a backup or restore that have finished, so a run
+    that failed can be resumed without doing them again
+
+    the first line is the header, what the run was started with, and every job
+    that finishes appends a line of json that is flushed to disk right away, so
+    the journal is still good if the process is killed half way through a line
+    """
+    @property
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def __init__(self, directory, name):
+        """
+        directory -- string -- the backup directory
+        name -- string -- what is being journaled, like backup or restore
+        """
+        self.path = os.path.join(directory, "{}.checkpoint".format(name))
+        self.lock = threading.Lock()
+        self.header = None
+        self.jobs = OrderedDict()
+
+    def load(self):
+        with open(self.path) as fp:
+            for line in fp:
+                try:
+                    data = json.loads(line, object_pairs_hook=OrderedDict)
+                except ValueError:
+                    # the last line was cut off, that job has to be done again
+                    break
+
+                if self.header is None:
+                    self.header = data
+                else:
+                    self.jobs[data["job"]] = data
+
+    def start(self, **header):
+        """start a new journal, forgetting any jobs of an earlier run"""
+        with self.lock:
+            self.header = OrderedDict(sorted(header.items()))
+            self.jobs = OrderedDict()
+            with open(self.path, "w") as fp:
+                self._write(fp, self.header)
+
+    def add(self, job, **fields):
+        """record that job has finished
+
+        **fields -- whatever is needed to check the job's work is still good
+            when the run is resumed, like the names and sizes of its files
+        """
+        with self.lock:
+            data = OrderedDict([("job", job)])
+            data.update(sorted(fields.items()))
+            self.jobs[job] = data
+            with open(self.path, "a") as fp:
+                self._write(fp, data)
+
+    def get(self, job):
+        """return the record of job or None if it didn't finish"""
+        return self.jobs.get(job)
+
+    def remove(self):
+        """the run finished so there is nothing to resume"""
+        if self.exists:
+            os.unlink(self.path)
+
+    def _write(self, fp, data):
+        fp.write(json.dumps(data))
+        fp.write("\n")
+        fp.flush()
+        os.fsync(fp.fileno())
+
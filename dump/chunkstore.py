@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+A store of compressed chunks shared by many backups
+
+every backup file is split into chunks where its content says to, so a row
+inserted or deleted in the middle of a table only changes the chunk it is in
+and the chunks after it line up with the ones of the last backup again. Each
+chunk is compressed once and saved under the sha256 of its bytes, a chunk that
+is already in the store isn't saved again, and the backup file becomes a recipe
+of the chunks it is made of:
+
+    {"version": 1, "codec": "gzip"}
+    <sha256> <bytes>
+    <sha256> <bytes>
+    ...
+
+the recipe is saved in the backup directory as NNN_table.sql.gz.chunks
+
+every backup writing to the store holds a shared lock of the store's lock file,
+and prune holds it exclusively, so a chunk is never deleted while a backup that
+is still writing its recipes might use it
+"""
+from __future__ import unicode_literals, division, print_function, absolute_import
+import os
+import json
+import time
+import uuid
+import zlib
+import fcntl
+import hashlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from .compression import CHUNK_SIZE, Codec, get_codec
+from .archive import Archive
+
+
+# the extension of a recipe, after the extension of the codec of its chunks
+EXTENSION = ".chunks"
+
+# the file in the store that is locked while backups write to it or it is pruned
+LOCK_NAME = ".lock"
+
+# a chunk can end after any line once it is MIN_CHUNK_SIZE bytes, the hash of
+# each line decides if it ends the chunk with a chance of its length divided by
+# the bytes past MIN_CHUNK_SIZE a chunk should have, so chunks average about
+# AVERAGE_CHUNK_SIZE bytes. Rows without any newlines are cut at MAX_CHUNK_SIZE
+MIN_CHUNK_SIZE = 64 * 1024
+AVERAGE_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+THRESHOLD = 2 ** 32 // (AVERAGE_CHUNK_SIZE - MIN_CHUNK_SIZE)
+
+
+class ChunkStore(object):
+    """a directory of compressed chunks, saved as ab/abcdef...gz by the sha256
+    of their uncompressed bytes"""
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def codec(self, codec):
+        """return the codec that writes and reads recipes of chunks compressed
+        with codec"""
+        return ChunkedCodec(self, codec)
+
+    @contextmanager
+    def lock(self, shared=False):
+        """hold the lock of the store, any number of backups can hold it shared
+        at the same time but prune holds it alone"""
+        fd = os.open(os.path.join(self.directory, LOCK_NAME), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            yield self
+
+        finally:
+            os.close(fd)
+
+    def get_path(self, digest, codec):
+        return os.path.join(self.directory, digest[:2], "{}{}".format(digest, codec.extension))
+
+    def put(self, data, codec, stages=None):
+        """save data as a chunk unless it is already in the store
+
+        stages -- dict -- the seconds spent compressing and writing are added to
+            its compress and write keys
+        return -- tuple -- (the sha256 of data, how many bytes were written to
+            the store, 0 if the chunk was already in it)
+        """
+        stages = {} if stages is None else stages
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.get_path(digest, codec)
+        if os.path.isfile(path):
+            return digest, 0
+
+        start = time.time()
+        data = codec.compress_block(data)
+        stages["compress"] = stages.get("compress", 0.0) + time.time() - start
+
+        # many jobs can save the same chunk at the same time, each writes its
+        # own file and the last rename wins with the same bytes
+        start = time.time()
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        with open(tmp_path, "wb") as fp:
+            fp.write(data)
+        os.rename(tmp_path, path)
+        stages["write"] = stages.get("write", 0.0) + time.time() - start
+        return digest, len(data)
+
+    def get(self, digest, size, codec):
+        """return the uncompressed bytes of a chunk, checking they are the
+        size and sha256 the recipe says they are"""
+        path = self.get_path(digest, codec)
+        try:
+            with open(path, "rb") as fp:
+                data = b"".join(codec.decompress_chunks(fp))
+
+        except (IOError, OSError) as e:
+            raise IOError("Chunk {} can't be read from {}: {}".format(digest, self.directory, e))
+
+        if len(data) != size or hashlib.sha256(data).hexdigest() != digest:
+            raise IOError("Chunk {} in {} is corrupt".format(digest, self.directory))
+        return data
+
+    def prune(self, directories):
+        """delete every chunk that isn't in a recipe of the backups in directories
+
+        this waits for the backups writing to the store to finish, and they wait
+        for it
+
+        directories -- list -- every backup directory and archive that is still
+            kept
+        return -- tuple -- (how many chunks were deleted, how many bytes they were)
+        """
+        with self.lock():
+            keep = set()
+            for directory in directories:
+                for digest in self.get_digests(directory):
+                    keep.add(digest)
+
+            count = 0
+            size = 0
+            for root, dirs, files in os.walk(self.directory):
+                for name in files:
+                    if name == LOCK_NAME:
+                        continue
+
+                    digest = name.split(".", 1)[0]
+                    if digest not in keep:
+                        path = os.path.join(root, name)
+                        size += os.path.getsize(path)
+                        os.unlink(path)
+                        count += 1
+
+        return count, size
+
+    def get_digests(self, path):
+        """yield the sha256 of every chunk in the recipes of the backup directory
+        or archive at path"""
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                if name.endswith(EXTENSION):
+                    with open(os.path.join(path, name), "rb") as fp:
+                        for digest, _ in read_recipe(fp)[1]:
+                            yield digest
+
+        else:
+            archive = Archive(path)
+            try:
+                for name in archive.names():
+                    if name.endswith(EXTENSION):
+                        with archive.open_raw(name) as fp:
+                            for digest, _ in read_recipe(fp)[1]:
+                                yield digest
+
+            finally:
+                archive.close()
+
+
+def read_recipe(fp):
+    """return the header of the recipe in the file object fp and a generator of
+    the (sha256, bytes) tuples of its chunks"""
+    header = json.loads(fp.readline().decode("utf-8"))
+    if header.get("version") != ChunkWriter.version:
+        raise ValueError("Unknown chunk recipe version {}".format(header.get("version")))
+
+    def chunks():
+        for line in fp:
+            digest, size = line.split()
+            yield digest.decode("utf-8"), int(size)
+
+    return header, chunks()
+
+
+class ChunkedCodec(Codec):
+    """a codec of the recipes of a chunk store, the chunks are compressed with
+    another codec"""
+    def __init__(self, store, codec):
+        super(ChunkedCodec, self).__init__(level=codec.level, threads=codec.threads)
+        self.store = store
+        self.codec = codec
+        self.name = codec.name
+        self.extension = codec.extension + EXTENSION
+
+    def create_compressor(self):
+        return self.codec.create_compressor()
+
+    def create_decompressor(self):
+        return self.codec.create_decompressor()
+
+    def decompress_chunks(self, fp, size=CHUNK_SIZE):
+        """yield the contents of the chunks of the recipe in the file object fp"""
+        header, chunks = read_recipe(fp)
+        codec = get_codec(header["codec"])
+        for digest, chunk_size in chunks:
+            yield self.store.get(digest, chunk_size, codec)
+
+    def writer(self, path):
+        return ChunkWriter(self.store, self.codec, path)
+
+
+class ChunkWriter(object):
+    """split everything written to it into chunks, saving the chunks in the
+    store and the recipe at path
+
+    this has the same counts as compression.Writer, bytes is the size of the
+    recipe and stored_bytes is how much was added to the store
+    """
+    version = 1
+
+    def __init__(self, store, codec, path):
+        self.store = store
+        self.codec = codec
+        self.path = path
+        # prune can't run until the recipe is written
+        self.lock = store.lock(shared=True)
+        self.lock.__enter__()
+        try:
+            self.fp = open(path, "wb")
+
+        except BaseException:
+            self.lock.__exit__(None, None, None)
+            raise
+        self.buffer = bytearray()
+        # where the next line to check for the end of the chunk starts
+        self.scanned = 0
+        self.raw_bytes = 0
+        self.bytes = 0
+        self.stored_bytes = 0
+        self.chunks = 0
+        self.hash = hashlib.sha256()
+        self.stages = OrderedDict([("chunk", 0.0), ("compress", 0.0), ("write", 0.0)])
+        self._write(json.dumps(OrderedDict([("version", self.version), ("codec", codec.name)])))
+
+    def write(self, data):
+        self.raw_bytes += len(data)
+        self.buffer.extend(data)
+
+        while True:
+            start = time.time()
+            end = self._find_end()
+            self.stages["chunk"] += time.time() - start
+            if not end:
+                break
+            self._save(end)
+
+    def _find_end(self):
+        """return where the chunk at the start of the buffer ends, or None if it
+        hasn't ended yet"""
+        buffer = self.buffer
+        if self.scanned < MIN_CHUNK_SIZE and len(buffer) >= MIN_CHUNK_SIZE:
+            # no line that ends before MIN_CHUNK_SIZE can end the chunk
+            self.scanned = max(self.scanned, buffer.rfind(b"\n", 0, MIN_CHUNK_SIZE - 1) + 1)
+
+        while True:
+            i = buffer.find(b"\n", self.scanned)
+            if i < 0:
+                return MAX_CHUNK_SIZE if len(buffer) >= MAX_CHUNK_SIZE else None
+
+            end = i + 1
+            if end > MAX_CHUNK_SIZE:
+                return MAX_CHUNK_SIZE
+
+            if end >= MIN_CHUNK_SIZE and zlib.crc32(buffer[self.scanned:end]) < (end - self.scanned) * THRESHOLD:
+                return end
+
+            self.scanned = end
+
+    def _save(self, end):
+        data = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        self.scanned = 0
+        digest, size = self.store.put(data, self.codec, self.stages)
+        self.stored_bytes += size
+        self.chunks += 1
+        self._write("{} {}".format(digest, len(data)))
+
+    def _write(self, line):
+        start = time.time()
+        data = "{}\n".format(line).encode("utf-8")
+        self.bytes += len(data)
+        self.hash.update(data)
+        self.fp.write(data)
+        self.stages["write"] += time.time() - start
+
+    def close(self):
+        try:
+            if self.buffer:
+                self._save(len(self.buffer))
+            self.fp.close()
+
+        finally:
+            self.lock.__exit__(None, None, None)
+
+    def hexdigest(self):
+        """return the sha256 of the recipe"""
+        return self.hash.hexdigest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            self.fp.close()
+            self.lock.__exit__(None, None, None)
+
+        else:
+            self.close()
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""
+In-process compression of the backup files
+
+every codec can compress in blocks on a pool of threads, each block is compressed
+into its own complete stream and the streams are written one after the other,
+gzip, bzip2, xz and zstd all treat concatenated streams as one file so the output
+can still be read with the normal command line tools
+"""
+from __future__ import unicode_literals, division, print_function, absolute_import
+import io
+import time
+import hashlib
+import zlib
+import bz2
+import lzma
+from abc import ABC, abstractmethod
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# how much is read from a file or pipe at a time
+CHUNK_SIZE = 1024 * 1024
+
+# how much uncompressed data goes into each block when compressing with threads
+BLOCK_SIZE = 1024 * 1024
+
+
+class Passthrough(object):
+    """a compressor and decompressor that doesn't change the data"""
+    eof = False
+    unused_data = b""
+
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return b""
+
+
+class Decompressor(object):
+    """wraps a decompressor so concatenated streams are all decompressed, and so
+    a stream that was cut off raises an error when it is flushed"""
+    def __init__(self, factory):
+        self.factory = factory
+        self.decompressor = factory()
+        self.started = False
+
+    def decompress(self, data):
+        ret = []
+        while data:
+            self.started = True
+            ret.append(self.decompressor.decompress(data))
+            if self.decompressor.eof:
+                data = self.decompressor.unused_data
+                self.decompressor = self.factory()
+                self.started = False
+
+            else:
+                data = b""
+
+        return b"".join(ret)
+
+    def flush(self):
+        if self.started:
+            raise EOFError("Compressed stream ended before the end-of-stream marker was reached")
+        return b""
+
+
+class BlockCompressor(object):
+    """compress data in blocks on a pool of threads
+
+    the compressed blocks are returned in order, and only a few blocks per thread
+    are allowed to be waiting so memory stays bounded when the data comes in faster
+    than it can be compressed
+    """
+    def __init__(self, codec):
+        self.codec = codec
+        self.executor = ThreadPoolExecutor(max_workers=codec.threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.blocks = 0
+
+    def compress(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.codec.block_size:
+            self.submit(bytes(self.buffer[:self.codec.block_size]))
+            del self.buffer[:self.codec.block_size]
+
+        ret = []
+        while self.pending and (len(self.pending) > self.codec.threads * 2 or self.pending[0].done()):
+            ret.append(self.pending.popleft().result())
+        return b"".join(ret)
+
+    def flush(self):
+        if self.buffer or not self.blocks:
+            # an empty stream still needs one block so it is a valid file
+            self.submit(bytes(self.buffer))
+            del self.buffer[:]
+
+        ret = [future.result() for future in self.pending]
+        self.pending.clear()
+        self.close()
+        return b"".join(ret)
+
+    def submit(self, block):
+        self.blocks += 1
+        self.pending.append(self.executor.submit(self.codec.compress_block, block))
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        for future in self.pending:
+            future.cancel()
+
+
+class Writer(object):
+    """compress everything written to it into the file at path
+
+    this counts the bytes going in and coming out, and hashes the compressed
+    bytes as they are written so the file doesn't have to be read again, the
+    seconds spent compressing and writing (with hashing) are added up in stages
+    """
+    def __init__(self, codec, path):
+        self.path = path
+        self.compressor = codec.compressor()
+        self.fp = open(path, "wb")
+        self.raw_bytes = 0
+        self.bytes = 0
+        self.hash = hashlib.sha256()
+        self.stages = OrderedDict([("compress", 0.0), ("write", 0.0)])
+
+    def write(self, data):
+        self.raw_bytes += len(data)
+        self._write(self._compress(self.compressor.compress, data))
+
+    def _compress(self, method, *args):
+        start = time.time()
+        try:
+            return method(*args)
+        finally:
+            self.stages["compress"] += time.time() - start
+
+    def _write(self, data):
+        if data:
+            start = time.time()
+            self.bytes += len(data)
+            self.hash.update(data)
+            self.fp.write(data)
+            self.stages["write"] += time.time() - start
+
+    def close(self):
+        self._write(self._compress(self.compressor.flush))
+        self.fp.close()
+
+    def hexdigest(self):
+        """return the sha256 of everything written to the file"""
+        return self.hash.hexdigest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            if hasattr(self.compressor, "close"):
+                self.compressor.close()
+            self.fp.close()
+
+        else:
+            self.close()
+
+
+class Reader(io.RawIOBase):
+    """a file object of the decompressed chunks"""
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.chunk = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not len(self.chunk):
+            try:
+                self.chunk = memoryview(next(self.chunks))
+            except StopIteration:
+                return 0
+
+        size = min(len(b), len(self.chunk))
+        b[:size] = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+        return size
+
+
+class Codec(ABC):
+    """the base class for all the compression formats"""
+    name = ""
+
+    extension = ""
+
+    default_level = None
+
+    def __init__(self, level=None, threads=1, block_size=BLOCK_SIZE):
+        self.level = self.default_level if level is None else level
+        self.threads = max(1, threads or 1)
+        self.block_size = block_size
+
+    @abstractmethod
+    def create_compressor(self):
+        """return a new object that compresses into one complete stream"""
+
+    @abstractmethod
+    def create_decompressor(self):
+        """return a new object that decompresses one complete stream"""
+
+    def compressor(self):
+        """return an object with compress(data) and flush() methods"""
+        if self.threads > 1:
+            return BlockCompressor(self)
+        return self.create_compressor()
+
+    def decompressor(self):
+        """return an object with decompress(data) and flush() methods"""
+        return Decompressor(self.create_decompressor)
+
+    def compress_block(self, data):
+        """compress data into one complete stream"""
+        compressor = self.create_compressor()
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress_chunks(self, fp, size=CHUNK_SIZE):
+        """yield the decompressed contents of the file object fp"""
+        decompressor = self.decompressor()
+        for data in iter(lambda: fp.read(size), b""):
+            data = decompressor.decompress(data)
+            if data:
+                yield data
+
+        data = decompressor.flush()
+        if data:
+            yield data
+
+    def read_chunks(self, path, size=CHUNK_SIZE):
+        """yield the decompressed contents of the file at path"""
+        with open(path, "rb") as fp:
+            for data in self.decompress_chunks(fp, size):
+                yield data
+
+    def open(self, path):
+        """return a file object of the decompressed contents of path"""
+        return io.BufferedReader(Reader(self.read_chunks(path)), buffer_size=CHUNK_SIZE)
+
+    def writer(self, path):
+        """return a file object that compresses everything written to it into path"""
+        return Writer(self, path)
+
+
+class Gzip(Codec):
+    name = "gzip"
+
+    extension = ".gz"
+
+    default_level = 6
+
+    def create_compressor(self):
+        # wbits 16 + 15 writes the gzip header and trailer
+        return zlib.compressobj(self.level, zlib.DEFLATED, 31)
+
+    def create_decompressor(self):
+        return zlib.decompressobj(31)
+
+
+class Bz2(Codec):
+    name = "bz2"
+
+    extension = ".bz2"
+
+    default_level = 9
+
+    def create_compressor(self):
+        return bz2.BZ2Compressor(self.level)
+
+    def create_decompressor(self):
+        return bz2.BZ2Decompressor()
+
+
+class Lzma(Codec):
+    name = "lzma"
+
+    extension = ".xz"
+
+    default_level = 6
+
+    def create_compressor(self):
+        return lzma.LZMACompressor(preset=self.level)
+
+    def create_decompressor(self):
+        return lzma.LZMADecompressor()
+
+
+class Zstd(Codec):
+    """zstd has its own threads so it doesn't need to be compressed in blocks"""
+    name = "zstd"
+
+    extension = ".zst"
+
+    default_level = 3
+
+    def __init__(self, *args, **kwargs):
+        if not zstandard:
+            raise ValueError("zstd compression needs the zstandard package")
+        super(Zstd, self).__init__(*args, **kwargs)
+
+    def create_compressor(self):
+        threads = self.threads if self.threads > 1 else 0
+        return zstandard.ZstdCompressor(level=self.level, threads=threads).compressobj()
+
+    def create_decompressor(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    def compressor(self):
+        return self.create_compressor()
+
+
+class Raw(Codec):
+    """no compression at all"""
+    name = "none"
+
+    def create_compressor(self):
+        return Passthrough()
+
+    def create_decompressor(self):
+        return Passthrough()
+
+    def compressor(self):
+        return Passthrough()
+
+    def decompressor(self):
+        return Passthrough()
+
+
+CODECS = dict((codec.name, codec) for codec in [Gzip, Bz2, Lzma, Zstd, Raw])
+
+
+def get_codec(name, level=None, threads=1):
+    """return the codec instance for name
+
+    name -- string -- one of the keys of CODECS
+    level -- integer -- the compression level, each codec has its own range
+    threads -- integer -- how many threads to compress with
+    """
+    try:
+        return CODECS[name](level=level, threads=threads)
+    except KeyError:
+        raise ValueError("Unknown compression {}".format(name))
+
+
+def find_codec(path):
+    """return the codec that should decompress path using its file extension
+
+    return -- tuple -- (codec, path without the codec's extension)
+    """
+    for codec_class in CODECS.values():
+        if codec_class.extension and path.endswith(codec_class.extension):
+            return codec_class(), path[:-len(codec_class.extension)]
+    return Raw(), path
+
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Count the rows of backup files
+
+the counters are passed the bytes of a file as it is dumped, or as it is read
+back by verify, in chunks that can split a row anywhere, and count the rows
+without decoding them
+"""
+from __future__ import unicode_literals, division, print_function, absolute_import
+import struct
+
+
+# every binary COPY file starts with this
+# https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4.5
+PGCOPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+
+
+class CopyRowCounter(object):
+    """count the rows of COPY's text format as it is written, every row is one
+    line because newlines in the values are escaped"""
+    def __init__(self):
+        self.rows = 0
+
+    def write(self, data):
+        self.rows += data.count(b"\n")
+
+
+class BinaryRowCounter(object):
+    """count the rows of COPY's binary format as it is written
+
+    the values are skipped over using their lengths, the data is never decoded
+    """
+    def __init__(self):
+        self.rows = 0
+        self.fields = 0
+        self.buffer = b""
+        self.skip = 0
+        self.header = True
+        self.done = False
+
+    def write(self, data):
+        if self.done:
+            return
+
+        if self.buffer:
+            data = self.buffer + data
+
+        pos = self.skip
+        size = len(data)
+        if self.header:
+            # signature, flags, then the length of the header extension
+            if size < len(PGCOPY_SIGNATURE) + 8:
+                self.buffer = data
+                return
+            pos = len(PGCOPY_SIGNATURE) + 8 + struct.unpack_from(">i", data, len(PGCOPY_SIGNATURE) + 4)[0]
+            self.header = False
+
+        unpack_from = struct.unpack_from
+        rows = self.rows
+        fields = self.fields
+        while True:
+            if fields:
+                if pos + 4 > size: break
+                length = unpack_from(">i", data, pos)[0]
+                pos += 4 + (length if length > 0 else 0)
+                fields -= 1
+
+            else:
+                if pos + 2 > size: break
+                fields = unpack_from(">h", data, pos)[0]
+                pos += 2
+                if fields < 0:
+                    # the trailer
+                    self.done = True
+                    break
+                rows += 1
+
+        self.rows = rows
+        self.fields = fields
+        if pos > size:
+            self.skip = pos - size
+            self.buffer = b""
+
+        else:
+            self.skip = 0
+            self.buffer = data[pos:]
+
+
+class ScriptRowCounter(object):
+    """count the rows of a pg_dump script as it is written, these are the lines
+    of its COPY blocks or its INSERT statements"""
+    def __init__(self):
+        self.rows = 0
+        self.copying = False
+        self.buffer = b""
+
+    def write(self, data):
+        if self.buffer:
+            data = self.buffer + data
+
+        # data always starts at the beginning of a line
+        pos = 0
+        while True:
+            if self.copying:
+                if data.startswith(b"\\.\n", pos):
+                    self.copying = False
+                    pos += 3
+                    continue
+
+                end = data.find(b"\n\\.\n", pos)
+                if end < 0:
+                    end = data.rfind(b"\n", pos)
+                    if end >= 0:
+                        self.rows += data.count(b"\n", pos, end + 1)
+                        pos = end + 1
+                    break
+
+                self.rows += data.count(b"\n", pos, end + 1)
+                pos = end + 1
+
+            else:
+                end = data.find(b"\n", pos)
+                if end < 0:
+                    break
+
+                line = data[pos:end]
+                if line.startswith(b"COPY ") and line.endswith(b" FROM stdin;"):
+                    self.copying = True
+                elif line.startswith(b"INSERT INTO "):
+                    self.rows += 1
+                pos = end + 1
+
+        self.buffer = data[pos:]
@@ -11,109 +11,2460 @@ http://blog.kimiensoftware.com/2011/05/compare-pg_dump-and-gzip-compression-241
 """
 from __future__ import unicode_literals, division, print_function, absolute_import
 import re
+import io
+import sys
+import fnmatch
+import asyncio
 import subprocess
 import os, time
 import tempfile
 import logging
+import threading
+import shutil
+from collections import OrderedDict
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import psycopg2
+    from psycopg2 import extensions as psycopg2_extensions
+except ImportError:
+    psycopg2 = None
+
+from ..scheduler import Scheduler
+from ..pipeline import Pipeline
+from ..compression import get_codec, find_codec, CODECS, CHUNK_SIZE, Reader
+from ..manifest import Manifest
+from ..checkpoint import Checkpoint
+from ..archive import Archive, ArchiveWriter
+from ..chunkstore import ChunkStore
+from .. import chunkstore
+from ..metrics import Metrics, timed
+from ..counters import PGCOPY_SIGNATURE, CopyRowCounter, BinaryRowCounter, ScriptRowCounter
+from .session import Session
 
 
 logger = logging.getLogger(__name__)
 
 
+@contextmanager
+def _null_context():
+    yield None
+
+
+def quote_ident(name):
+    """quote name so it can be used as a column name in a query"""
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def split_name(name):
+    """split a table name like schema.table into its parts, a quoted part keeps
+    its case and can have dots in it, the rest are lowercase like postgres
+    makes them
+
+    name -- string -- a table name, like "Some Schema".foo
+    return -- list -- the unquoted parts, the table name is the last one
+    """
+    ret = []
+    for quoted, bare in re.findall(r'"((?:[^"]|"")*)"|([^."]+)', name):
+        ret.append(quoted.replace('""', '"') if quoted else bare.strip().lower())
+    return ret
+
+
+def quote_name(*parts):
+    """join parts into a name like schema.table, a part is only quoted if it
+    isn't all lowercase letters, digits and underscores, like pg_dump prints
+    names"""
+    return ".".join(
+        part if re.match(r"^[a-z_][a-z0-9_$]*$", part) else quote_ident(part)
+        for part in parts
+    )
+
+
+def match_tables(names, pattern):
+    """return the table names that match the shell style glob pattern, a pattern
+    without a schema matches the tables of every schema
+
+    names -- list -- table names like schema.table
+    pattern -- string -- a glob like "log_*" or "public.log_*"
+    return -- list -- the matching names in the order of names
+    """
+    return [
+        name for name in names
+        if fnmatch.fnmatchcase(name, pattern)
+        or ("." not in pattern and fnmatch.fnmatchcase(split_name(name)[-1], pattern))
+    ]
+
+
+# pg_dump puts a comment like this before every entry of a script, the groups
+# are the name, the type, and the schema of the entry:
+#     -- Name: foo_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+TOC_REGEX = re.compile(br'^-- (?:Data for )?Name: (.*); Type: ([^;]+); Schema: ([^;]+);')
+
+# NNN_table.sql is the pg_dump script, NNN_table.copy and NNN_table.pgcopy are
+# rows that are loaded with COPY after the script has run, as are the
+# NNN_table.partK.copy chunks of the rows and the NNN_table.incK.copy increments,
+# each with the extension of its codec and of a chunk store recipe. The suffixes
+# are matched from the right since a table in another schema, like
+# NNN_other.users.sql, has a dot in its name. The groups are NNN_table, the
+# table, the .partK or .incK suffix, part or inc, and K
+FILENAME_REGEX = re.compile(r'^(\d{{3,}}_(.+?))(\.(part|inc)(\d+))?\.(sql|copy|pgcopy)({})?({})?$'.format(
+    "|".join(re.escape(c.extension) for c in CODECS.values() if c.extension),
+    re.escape(chunkstore.EXTENSION),
+))
+
+# the ways the rows of a table can be written out
+#   copy -- a pg_dump script that loads the rows with COPY
+#   binary -- a pg_dump script with only the schema and a binary COPY file of the rows
+#   inserts -- a pg_dump script with an INSERT statement for every row
+DATA_FORMATS = ("copy", "binary", "inserts")
+
+# the pg_dump entry types that pg_restore puts in its post-data section
+# https://www.postgresql.org/docs/current/app-pgrestore.html (--section)
+POST_DATA_TYPES = set([
+    "INDEX",
+    "INDEX ATTACH",
+    "CONSTRAINT",
+    "CHECK CONSTRAINT",
+    "FK CONSTRAINT",
+    "TRIGGER",
+    "EVENT TRIGGER",
+    "RULE",
+    "POLICY",
+    "ROW SECURITY",
+    "STATISTICS",
+])
+
+# how the rows are read from the db when dumping
+#   psql -- COPY runs in a psql process and its output is read from a pipe
+#   psycopg -- COPY runs on a psycopg2 connection in this process, this needs
+#       the psycopg2 package
+DRIVERS = ("psql", "psycopg")
+
+# how restore talks to the db
+#   session -- the files are loaded through one long running psql session per
+#       job, each table is restored in a transaction
+#   process -- every file is loaded by its own psql
+RESTORE_BACKENDS = ("session", "process")
+
+# these pg_dump entry types belong to the section of the entry before them
+ATTACHED_TYPES = set(["COMMENT", "ACL", "SECURITY LABEL"])
+
+
+class ChunkBuffer(object):
+    """gather small writes into chunks before passing them on, psycopg2 writes
+    every row of a COPY on its own"""
+    def __init__(self, write, size=CHUNK_SIZE):
+        self.callback = write
+        self.size = size
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer.extend(data)
+        if len(self.buffer) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.callback(bytes(self.buffer))
+            del self.buffer[:]
+
+
 class Postgres(object):
     """wrapper to dump postgres tables"""
 
     # http://dbaspot.com/postgresql/348627-pg_dump-t-give-where-condition.html
     # http://docs.python.org/2/library/tempfile.html
 
-    def __init__(self, dbname, username, password, host=None, port=5432, directory=None, **kwargs):
+    def __init__(
+        self,
+        dbname,
+        username,
+        password,
+        host=None,
+        port=5432,
+        directory=None,
+        data_format="copy",
+        compression="gzip",
+        compression_level=None,
+        compression_threads=1,
+        consistent=True,
+        driver="psql",
+        timeout=None,
+        archive=None,
+        store=None,
+        **kwargs
+    ):
+        if data_format not in DATA_FORMATS:
+            raise ValueError("Unknown data format {}".format(data_format))
+
+        if driver not in DRIVERS:
+            raise ValueError("Unknown driver {}".format(driver))
+
+        if driver == "psycopg" and not psycopg2:
+            raise ValueError("The psycopg driver needs the psycopg2 package")
+
         self.tmp_files = set()
+        self.tmp_directory = None
         self.outfile_count = 0
 
+        # the currently running commands, sessions, and connections, so they can
+        # be stopped if another table fails while dumping in parallel
+        self.tasks = set()
+        self.procs = set()
+        self.conns = set()
+        self.procs_lock = threading.Lock()
+        self.cancelled = threading.Event()
+
+        # the event loop the scheduler is running on, commands run on it
+        self.loop = None
+        self.timeout = timeout
+
         if directory:
             if not os.path.exists(directory):
                 os.makedirs(directory)
 
         else:
             directory = tempfile.mkdtemp(prefix="postgres-{}".format(time.strftime("%y%m%d%S")))
+            self.tmp_directory = directory
 
         self.directory = directory
+
+        # every backup file is written into this file as soon as it is dumped,
+        # and restored from it, - is stdout, see close()
+        self.archive_path = archive
+        self.archive = None
+        self.archive_writer = None
+        self.archive_lock = threading.Lock()
+        self.archive_stack = ExitStack()
+        self.manifest = Manifest(directory)
+
+        # call self.metrics.listen() to get the events of every file, job, and run
+        self.metrics = Metrics()
         self.dbname = dbname
         self.username = username
         self.password = password
         self.host = host 
         self.port = port
+        self.data_format = data_format
+        self.consistent = consistent
+        self.driver = driver
+        self.snapshot_id = None
+        self.server_version = None
+
+        # server settings every psql and pg_dump session should use, these are
+        # passed in PGOPTIONS
+        self.settings = OrderedDict()
+
+        # the psql sessions restore is using, keyed by thread
+        self.backend = "process"
+        self.sessions = {}
+
+        # where restore is loading the tables into, see restore()
+        self.target_schema = None
+        self.target_table = None
+        self.codec = get_codec(
+            compression,
+            level=compression_level,
+            threads=compression_threads,
+        )
+
+        # the backup files are split into the chunks of this store, each chunk
+        # is only saved once no matter how many backups it is in
+        self.store = None
+        if store:
+            self.store = ChunkStore(store)
+            self.codec = self.store.codec(self.codec)
 
         # make sure we have the needed stuff
         self._run_cmd(["which", "psql"])
         self._run_cmd(["which", "pg_dump"])
-        self._run_cmd(["which", "gzip"])
 
 
     def __del__(self):
         # cleanup by getting rid of all the temporary files
         for tf in self.tmp_files:
             os.unlink(tf)
+        self._remove_tmp_directory()
+
+    def close(self):
+        """finish the archive the backups were written into and remove the
+        temporary directory an archive is backed up and restored through
+
+        the files that aren't in the archive yet, like the files a resumed backup
+        kept, and the manifest are added and then the index is written, the
+        archive can't be read without it, so this has to be called once all the
+        backups into an archive are done
+        """
+        with self.archive_lock:
+            if self.archive_writer:
+                logger.info("------- finishing the archive {}".format(self.archive_path))
+                for name in self.manifest.files():
+                    if name not in self.archive_writer.files:
+                        self.archive_writer.add(name, os.path.join(self.directory, name))
+                self.archive_writer.add(Manifest.filename, self.manifest.path)
+                self.archive_writer.close()
+                self.archive_writer = None
+                self.archive_stack.close()
+
+        if self.archive:
+            self.archive.close()
+            self.archive = None
+
+        self._remove_tmp_directory()
 
-    def restore(self):
+    def _remove_tmp_directory(self):
+        """remove self.directory and everything in it if it is the temporary
+        directory an archive is backed up and restored through, without an
+        archive the files in a temporary directory are the backup"""
+        if self.archive_path and self.tmp_directory and os.path.isdir(self.tmp_directory):
+            shutil.rmtree(self.tmp_directory)
+
+    def restore(
+        self,
+        jobs=1,
+        fast=False,
+        maintenance_work_mem="1GB",
+        backend="session",
+        resume=False,
+        tables=None,
+        exclude=None,
+        target_schema=None,
+        target_table=None,
+    ):
         """use the self.directory to restore a db
 
+        tables are restored jobs at a time, a table won't be restored until all
+        the tables it has foreign keys to have been restored
+
+        only the files of the selected tables are read, so restoring one table
+        takes as long as that table no matter how big the backup is
+
         NOTE -- this will only restore a database dumped with one of the methods
         of this class
+
+        jobs -- integer -- how many tables can be restored at the same time
+        fast -- boolean -- load the rows of every table before its indexes,
+            constraints and triggers are created, with synchronous_commit off.
+            Only the indexes and constraints of a table wait for the tables it
+            has foreign keys to, so all the rows are loaded at the same time
+        maintenance_work_mem -- string -- the memory each session can use to
+            build indexes in fast mode, every job can use this much
+        backend -- string -- one of RESTORE_BACKENDS
+        resume -- boolean -- if the last restore of self.directory failed, the
+            files it finished loading aren't loaded again, as long as they are
+            still the same size and nothing they depend on has to be loaded again
+        tables -- list -- the names of the tables to restore and shell style
+            globs like "log_*", defaults to all the tables of the backup
+        exclude -- list -- names and globs of tables that won't be restored
+        target_schema -- string -- restore the tables into this schema instead of
+            the one they were dumped from, it is created if it doesn't exist
+        target_table -- string -- load the rows of the one selected table into
+            this table, it is created from the CREATE TABLE in the backup if it
+            doesn't exist. Only the rows are loaded, the dumped table is left
+            alone and doesn't have to exist
         """
-        sql_files = []
-        for root, dirs, files in os.walk(self.directory):
-            for f in files:
-                if f.endswith(".sql.gz"):
-                    path = os.path.join(self.directory, f)
-                    self._run_cmd(["gunzip", path])
-                    sql_files.append(f.rstrip(".gz"))
-
-                elif f.endswith('.sql'):
-                    sql_files.append(f)
-
-        sql_files.sort() # we want to go in the order the tables were dumped
-        r = re.compile('\d{3,}_([^\.]+)')
-        for f in sql_files:
-            path = os.path.join(self.directory, f)
-            m = r.match(f)
+        if backend not in RESTORE_BACKENDS:
+            raise ValueError("Unknown restore backend {}".format(backend))
+
+        if target_schema and target_table:
+            raise ValueError("Restore into a target schema or a target table, not both")
+
+        if self.archive_path:
+            self._open_archive()
+
+        snapshots = self.manifest.snapshots()
+        if len(snapshots) > 1:
+            logger.warning(
+                "------- the backup was resumed, its files are from {} snapshots so its tables might not be"
+                " consistent with each other".format(len(snapshots))
+            )
+
+        # the files are decompressed as they are loaded so they are left
+        # untouched, any of them can be the recipe of a chunk store
+        dumps = {}
+        parts = {}
+        increments = {}
+        for f in self._get_files():
+            m = FILENAME_REGEX.match(f)
             if m:
-                table = m.group(1)
-                logger.info('------- restoring table {}'.format(table))
+                path = os.path.join(self.directory, f)
+                if m.group(4) == "part":
+                    parts.setdefault(m.group(1), []).append((int(m.group(5)), path))
+                elif m.group(4) == "inc":
+                    increments.setdefault(m.group(1), []).append((int(m.group(5)), path))
+                else:
+                    dumps.setdefault((m.group(1), m.group(2)), []).append(path)
+
+        selected = self._select_tables(sorted(set(t for _, t in dumps)), tables, exclude)
+        dumps = dict((k, paths) for k, paths in dumps.items() if k[1] in selected)
+        if target_table and len(selected) != 1:
+            raise ValueError("A target table needs exactly one table to restore, not {}".format(len(selected)))
+
+        # every job costs the decompressed bytes it has to load, so the biggest tables are
+        # started first and don't hold up the end of the restore
+        scheduler = Scheduler(jobs)
+        tables = {}
+        post_names = {}
+        post_datas = {}
+        for (name, table), paths in sorted(dumps.items()): # ties go in the order the tables were dumped
+            paths.sort(key=lambda path: (not self._is_script(path), path))
+            post_data = [] if fast else None
+            scheduler.add(name, self._restore_table, table, paths, post_data)
+            post_datas[name] = post_data
+            scheduler.weigh(name, self._get_raw_size(*paths))
+            tables.setdefault(table, []).append((name, paths))
+
+            # the parts of a table split into chunks are loaded at the same time
+            # once the table has been created
+            for i, path in sorted(parts.get(name, [])):
+                part_name = "{}.part{}".format(name, i)
+                scheduler.add(part_name, self._restore_data, table, path)
+                scheduler.weigh(part_name, self._get_raw_size(path))
+                scheduler.depend(part_name, name)
+                tables[table].append((part_name, [path]))
+
+            def add_post_data():
+                # the indexes and constraints are built once all the rows are in
+                post_name = "{}.post".format(name)
+                scheduler.add(post_name, self._restore_post_data, table, post_data)
+                # building the indexes takes about as long as the rows they index
+                scheduler.weigh(post_name, sum(scheduler.queue[n].cost for n, _ in tables[table]))
+                scheduler.depend(post_name, *[n for n, _ in tables[table]])
+                tables[table].append((post_name, []))
+                post_names.setdefault(table, []).append(post_name)
+
+            # an increment replaces rows by the primary key the manifest recorded,
+            # a backup from before it did reads the key from the restored table,
+            # so in fast mode its increments wait until the key has been built
+            key_from_table = "primary_key" not in (self.manifest.get(table) or {})
+            if fast and key_from_table and name in increments:
+                add_post_data()
 
-                #psql_args = self._get_args('psql', '-X', '--echo-queries', '-f {}'.format(path))
-                psql_args = self._get_args('psql', '-X', '--quiet', '--file={}'.format(path))
-                self._run_cmd(psql_args)
+            # the increments are loaded one after the other once the base dump
+            # and all its parts are loaded
+            for i, path in sorted(increments.get(name, [])):
+                inc_name = "{}.inc{}".format(name, i)
+                scheduler.add(inc_name, self._restore_increment, table, path)
+                scheduler.weigh(inc_name, self._get_raw_size(path))
+                scheduler.depend(inc_name, *[n for n, _ in tables[table]])
+                tables[table].append((inc_name, [path]))
 
-                logger.info('------- restored table {}'.format(table))
+            if fast and "{}.post".format(name) not in scheduler.queue:
+                add_post_data()
 
+        for table, parents in self._get_dependencies(tables, jobs).items():
+            # in fast mode there are no foreign keys until the post-data is restored
+            names = post_names[table] if fast else [n for n, _ in tables[table]]
+            for name in names:
+                for parent in parents:
+                    scheduler.depend(name, *[n for n, _ in tables[parent]])
+
+        checkpoint = self._start_checkpoint(
+            "restore",
+            resume,
+            fast=fast,
+            tables=sorted(selected),
+            target_schema=target_schema,
+            target_table=target_table,
+        )
+        job_paths = dict(item for items in tables.values() for item in items)
+        for name in self._resume(scheduler, checkpoint, lambda job, record: self._verify_files(record["files"])):
+            if post_datas.get(name) is not None:
+                # the indexes of a table that was already loaded still have to be
+                # built, so its post-data is read again
+                for path in job_paths[name]:
+                    if self._is_script(path):
+                        for _ in self._split_script(path, post_datas[name]):
+                            pass
+
+        def on_done(job, ret):
+            checkpoint.add(job.name, files=[
+                {"name": os.path.basename(path), "bytes": self._get_size(path)} for path in job_paths[job.name]
+            ])
+
+        if fast:
+            settings = self._fast_settings(maintenance_work_mem=maintenance_work_mem)
+        else:
+            settings = _null_context()
+
+        with self._run_metrics("restore", tables):
+            self.backend = backend
+            self.target_schema = target_schema
+            self.target_table = target_table
+            try:
+                # a target table is created from the table definition in the
+                # backup, see _read_script()
+                if target_schema:
+                    self._query("CREATE SCHEMA IF NOT EXISTS {}".format(quote_ident(target_schema)))
+
+                with settings:
+                    self._run_scheduler(scheduler, on_done)
+
+                self._restore_sequences(sorted(self._get_restore_name(table) for table in tables))
+
+            finally:
+                self.backend = "process"
+                self.target_schema = None
+                self.target_table = None
+                self._close_sessions()
+
+        checkpoint.remove()
+
+        for job in scheduler.queue.values():
+            if not job.skipped:
+                logger.info("------- restored {} in {:.2f}s".format(job.name, job.elapsed))
+
+        critical_path = scheduler.critical_path()
+        logger.info("------- critical path {:.2f}s: {}".format(
+            scheduler.elapsed(critical_path),
+            " -> ".join("{} ({:.2f}s)".format(job.name, job.elapsed) for job in critical_path),
+        ))
         return True
 
-    def table_dump(self, table):
-        """dump all the rows of the given table name"""
+    def _select_tables(self, names, patterns=None, exclude=None):
+        """return the names of the backed up tables that should be restored
+
+        names -- list -- the tables in the backup
+        patterns -- list -- table names and shell style globs, every one of them
+            has to match at least one table, defaults to all the tables
+        exclude -- list -- table names and globs of tables to leave out
+        return -- set -- the selected names
+        """
+        selected = set()
+        for pattern in patterns or ["*"]:
+            matches = match_tables(names, pattern)
+            if not matches:
+                raise ValueError("No tables in {} match {}".format(self.directory, pattern))
+            selected.update(matches)
+
+        for pattern in exclude or []:
+            selected.difference_update(match_tables(names, pattern))
+
+        return selected
+
+    def _get_restore_name(self, table):
+        """return the name the rows of the backed up table are loaded into"""
+        if self.target_table:
+            # a name like schema.table is the table in that schema
+            return ".".join(quote_ident(name) for name in self.target_table.split("."))
+
+        if self.target_schema:
+            # the table is moved out of the schema it was dumped from, like
+            # _read_script() moves its definition
+            return "{}.{}".format(quote_ident(self.target_schema), quote_ident(split_name(table)[-1]))
+
+        return table
+
+    def _open_archive(self):
+        """open the archive at self.archive_path to restore from it, its manifest
+        replaces the manifest of self.directory"""
+        if self.archive_path == "-":
+            raise ValueError("An archive has to be a file to restore from it, not stdin")
+
+        if self.archive:
+            self.archive.close()
+        self.archive = Archive(self.archive_path)
+        with self.archive.open_raw(Manifest.filename) as fp:
+            self.manifest.load(fp)
+
+    def _get_files(self):
+        """return the names of the backup files in self.directory or the archive
+
+        the files are listed in the manifest, only directories backed up before
+        there was a manifest are scanned
+        """
+        if self.archive:
+            return [name for name in self.archive.names() if name != Manifest.filename]
+
+        if self.manifest.exists:
+            return self.manifest.files()
+
+        for root, dirs, files in os.walk(self.directory):
+            return files
+        return []
+
+    def _get_size(self, *paths):
+        """return how many bytes all the backup files at paths are"""
+        if self.archive:
+            return sum(self.archive.get_size(os.path.basename(path)) for path in paths)
+        return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+    def _get_raw_size(self, *paths):
+        """return how many bytes the backup files at paths are decompressed, the
+        compressed sizes of different codecs and data formats can't be compared
+        so this is what restore jobs are weighed by
+
+        a file the manifest doesn't know the raw size of counts its size on disk
+        """
+        size = 0
+        for path in paths:
+            fields = self.manifest.get_file(os.path.basename(path)) or {}
+            raw_bytes = fields.get("raw_bytes")
+            size += self._get_size(path) if raw_bytes is None else raw_bytes
+        return size
+
+    def _has_file(self, path):
+        """return True if the backup file at path exists"""
+        if self.archive:
+            return os.path.basename(path) in self.archive
+        return os.path.isfile(path)
+
+    def _start_checkpoint(self, name, resume, **header):
+        """return the journal of the jobs that finish, if resume is True and the
+        last run with the same header failed then its journal is kept"""
+        if resume and self.tmp_directory:
+            # the journal would be in a temporary directory the next run can't find
+            raise ValueError("The {} can only be resumed in a backup directory".format(name))
+
+        checkpoint = Checkpoint(self.directory, name)
+        if resume and checkpoint.exists:
+            checkpoint.load()
+            if checkpoint.header == OrderedDict(sorted(header.items())):
+                logger.info("------- resuming the {} in {}".format(name, self.directory))
+                return checkpoint
+
+            raise ValueError("The {} in {} can't be resumed, it was started with other settings".format(
+                name,
+                self.directory,
+            ))
+
+        checkpoint.start(**header)
+        return checkpoint
+
+    def _resume(self, scheduler, checkpoint, verify):
+        """skip every job that finished in the run checkpoint is the journal of
+
+        a job is only skipped if verify says its work is still good and all the
+        jobs it depends on are skipped too, since redoing a job can undo the jobs
+        after it (like a table being created again)
+
+        verify -- callable -- passed the job and its checkpoint record
+        return -- list -- the names of the skipped jobs
+        """
+        names = set(
+            job.name for job in scheduler.queue.values()
+            if checkpoint.get(job.name) and verify(job, checkpoint.get(job.name))
+        )
+        while True:
+            redo = set(name for name in names if not scheduler.queue[name].depends <= names)
+            if not redo:
+                break
+            names -= redo
+
+        ret = [name for name in scheduler.queue if name in names]
+        for name in ret:
+            logger.info("------- skipping {}, it finished before".format(name))
+            scheduler.skip(name)
+        return ret
+
+    def _verify_files(self, files):
+        """return True if the files are all still in self.directory with the same
+        sizes"""
+        for fields in files:
+            path = os.path.join(self.directory, fields["name"])
+            if not self._has_file(path) or self._get_size(path) != fields["bytes"]:
+                return False
+        return True
+
+    def _restore_table(self, table, paths, post_data=None):
+        """restore the dump files of table
+
+        post_data -- list -- if given, the post-data section of the pg_dump script
+            isn't run, its lines are added to this list instead
+        """
+        logger.info('------- restoring table {}'.format(table))
+
+        with self._transaction() as session:
+            for path in paths:
+                with self._restore_metrics(table, path) as stages:
+                    if self._is_script(path):
+                        if post_data is not None:
+                            chunks = timed(self._split_script(path, post_data), stages, "read")
+                        elif self.target_schema or self.target_table:
+                            chunks = timed(self._join_lines(self._read_script(path)), stages, "read")
+                        else:
+                            chunks = self._read(path, stages)
+                        self._run_script(session, chunks)
+
+                    else:
+                        self._copy(session, self._get_restore_name(table), path, stages)
+
+        logger.info('------- restored table {}'.format(table))
+
+    @contextmanager
+    def _restore_metrics(self, table, path):
+        """send a file event once the file at path has been loaded
+
+        this yields the dict the seconds spent reading and decompressing the file
+        should be added to, the rest of the time was spent loading it
+        """
+        start = time.time()
+        stages = OrderedDict()
+        yield stages
+
+        name = os.path.basename(path)
+        fields = self.manifest.get_file(name) or {}
+        self.metrics.file(
+            "restore",
+            table,
+            name,
+            time.time() - start,
+            fields.get("raw_bytes"),
+            self._get_size(path),
+            fields.get("rows"),
+            stages,
+            "load",
+        )
+
+    def _restore_post_data(self, table, post_data):
+        """run the post-data section of the pg_dump script of table, this builds
+        the indexes and adds the constraints and triggers of the table
+
+        unlike the rest of the script, any statement of the post-data that fails
+        fails the restore, only the settings from the top of the script can fail
+        on their own
+        """
+        logger.info('------- building indexes and constraints of table {}'.format(table))
+        lines = []
+        stopping = False
+        for line in post_data:
+            if not stopping and line.startswith(b"-- ") and TOC_REGEX.match(line):
+                lines.append(b"\\set ON_ERROR_STOP on\n")
+                stopping = True
+            lines.append(line)
+
+        with self._transaction() as session:
+            if self._run_script(session, iter([b"".join(lines)])) and stopping:
+                raise IOError("Could not build the indexes and constraints of table {}".format(table))
+        logger.info('------- built indexes and constraints of table {}'.format(table))
+
+    @contextmanager
+    def _transaction(self):
+        """return the session of this thread with a transaction started, the
+        transaction is committed when the context exits, None is returned if
+        every file is being restored by its own psql"""
+        if self.backend != "session":
+            yield None
+            return
+
+        session = self._get_session()
+        session.begin()
+        try:
+            yield session
+
+        except BaseException:
+            try:
+                session.rollback()
+
+            except IOError:
+                # the session is broken, the next job will start a new one
+                self._close_session()
+            raise
+
+        session.commit()
+
+    def _get_session(self):
+        """return the psql session of the current thread, starting it if needed"""
+        key = threading.current_thread().ident
+        with self.procs_lock:
+            session = self.sessions.get(key)
+            if not session:
+                if self.cancelled.is_set():
+                    raise IOError("Session was cancelled")
+                session = Session(self._get_args("psql"), env=self._get_env())
+                self.sessions[key] = session
+                self.procs.add(session.pipe)
+        return session
+
+    def _close_session(self, key=None):
+        key = key or threading.current_thread().ident
+        with self.procs_lock:
+            session = self.sessions.pop(key, None)
+            if session:
+                self.procs.discard(session.pipe)
+
+        if session:
+            session.close()
+
+    def _close_sessions(self):
+        for key in list(self.sessions.keys()):
+            self._close_session(key)
+
+    def _run_script(self, session, chunks):
+        """run the SQL script in chunks, like psql --file would
+
+        return -- boolean -- True if the last command failed in session, psql
+            exits with an error if the script stopped on an error without one
+        """
+        if session:
+            return session.run_file(chunks)
+
+        else:
+            #psql_args = self._get_args('psql', '-X', '--echo-queries', '-f {}'.format(path))
+            psql_args = self._get_args('psql', '-X', '--quiet', '--file=-')
+            self._run_cmds([(psql_args, {"stdout": subprocess.DEVNULL})], stdin=chunks)
+
+    def _copy(self, session, table, path, stages=None):
+        """load the rows in path into table using COPY, the rows can be in COPY's
+        text or binary format
+
+        stages -- dict -- see _read()
+        """
+        logger.debug('------- loading {} into table {}'.format(os.path.basename(path), table))
+        options = self._get_copy_options(path)
+        if session:
+            session.copy(table, self._read(path, stages), options)
+
+        else:
+            psql_args = self._get_args(
+                'psql',
+                '-X',
+                '--quiet',
+                '--set=ON_ERROR_STOP=1',
+                '--command=COPY {} FROM STDIN{}'.format(table, options),
+            )
+            self._load(path, psql_args, stages)
+
+    def _split_script(self, path, post_data):
+        """yield the pre-data and data sections of the pg_dump script at path
+
+        pg_dump puts a comment like this before every entry of the script:
+
+            -- Name: foo_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+
+        everything from an entry with a post-data type on is added to post_data,
+        along with the settings at the top of the script so the post-data can be
+        run in its own session
+
+        path -- string -- the path of a pg_dump script
+        post_data -- list -- the lines of the post-data section are added to this
+        """
+        def lines():
+            header = True
+            post = False
+            for line in self._read_script(path):
+                if line.startswith(b"-- "):
+                    m = TOC_REGEX.match(line)
+                    if m:
+                        header = False
+                        entry_type = m.group(2).decode("utf-8")
+                        if entry_type not in ATTACHED_TYPES:
+                            post = entry_type in POST_DATA_TYPES
+
+                if post:
+                    post_data.append(line)
+
+                else:
+                    if header and (line.startswith(b"SET ") or line.startswith(b"SELECT pg_catalog.set_config(")):
+                        post_data.append(line)
+
+                    yield line
+
+        return self._join_lines(lines())
+
+    def _join_lines(self, lines):
+        """yield the lines joined into chunks of about CHUNK_SIZE bytes"""
+        chunk = []
+        size = 0
+        for line in lines:
+            chunk.append(line)
+            size += len(line)
+            if size >= CHUNK_SIZE:
+                yield b"".join(chunk)
+                chunk = []
+                size = 0
+
+        if chunk:
+            yield b"".join(chunk)
+
+    def _read_script(self, path):
+        """yield the lines of the pg_dump script at path, changed to restore into
+        self.target_schema or self.target_table if either is set
+
+        with a target schema, every name qualified with the schema the table
+        was dumped from (the Schema of the first entry of the script) is moved
+        to the target schema, the rows themselves are left alone
+
+        with a target table only the table definition and the rows are kept,
+        the CREATE TABLE of the TABLE entry creates the target table if it
+        doesn't exist, the COPY and INSERT statements of the TABLE DATA entries
+        load the rows into it, and everything else besides the settings at the
+        top is left out, so the table doesn't have to be in the db
+        """
+        with self._open(path) as fp:
+            if not self.target_schema and not self.target_table:
+                for line in fp:
+                    yield line
+                return
+
+            # the statements that load the rows, the groups are the command and
+            # the table without its schema
+            statement = re.compile(br'^(COPY|INSERT INTO) (?:"[^"]*"|[^\s."]+)\.("[^"]*"|[^\s."(]+) ')
+            create = re.compile(br'^CREATE (?:UNLOGGED )?TABLE (?:"[^"]*"|[^\s."]+)\.(?:"[^"]*"|[^\s."(]+) ')
+            if self.target_table:
+                target_table = self._get_restore_name(None).encode("utf-8")
+                target = lambda m: m.group(1) + b" " + target_table + b" "
+            else:
+                target_schema = quote_ident(self.target_schema).encode("utf-8")
+                target = lambda m: m.group(1) + b" " + target_schema + b"." + m.group(2) + b" "
+
+            # the lines before the first entry (like the DROPs of --clean) wait
+            # until the entry says what schema the table was dumped from
+            header = []
+            data = False
+            definition = False
+            creating = False
+            copying = False
+            qualified = None
+            for line in fp:
+                if copying:
+                    copying = line != b"\\.\n"
+                    yield line
+                    continue
+
+                if creating:
+                    creating = not line.rstrip().endswith(b";")
+                    yield line
+                    continue
+
+                if line.startswith(b"-- "):
+                    m = TOC_REGEX.match(line)
+                    if m:
+                        data = m.group(2) == b"TABLE DATA"
+                        definition = m.group(2) == b"TABLE"
+                        if header is not None:
+                            schema = quote_name(m.group(3).decode("utf-8"))
+                            qualified = re.compile(br'(?<![\w"$.])' + re.escape(schema.encode("utf-8")) + br'\.')
+                            for header_line in header:
+                                if self.target_table:
+                                    # the target table is found on the session's
+                                    # search_path, not the empty one pg_dump sets
+                                    if header_line.startswith(b"SET "):
+                                        yield header_line
+
+                                else:
+                                    yield qualified.sub(lambda m: target_schema + b".", header_line)
+                            header = None
+
+                if header is not None:
+                    header.append(line)
+                    continue
+
+                if data:
+                    line, found = statement.subn(target, line, count=1)
+                    copying = found and line.startswith(b"COPY ")
+
+                elif self.target_table:
+                    if not definition:
+                        continue
+
+                    line, creating = create.subn(b"CREATE TABLE IF NOT EXISTS " + target_table + b" ", line, count=1)
+                    if not creating:
+                        continue
+                    creating = not line.rstrip().endswith(b";")
+
+                elif not line.startswith(b"-- "):
+                    line = qualified.sub(lambda m: target_schema + b".", line)
+
+                yield line
+
+    @contextmanager
+    def _fast_settings(self, **settings):
+        """every session started in this context loads rows without waiting for
+        the WAL to be flushed and can use more memory to build indexes"""
+        previous = self.settings
+        self.settings = OrderedDict(previous)
+        self.settings["synchronous_commit"] = "off"
+        self.settings.update(settings)
+        try:
+            yield self.settings
+
+        finally:
+            self.settings = previous
+
+    def _restore_data(self, table, path):
+        """load the rows of one of the parts of table"""
+        with self._transaction() as session:
+            with self._restore_metrics(table, path) as stages:
+                self._copy(session, self._get_restore_name(table), path, stages)
+
+    def _restore_increment(self, table, path):
+        """load the rows of an incremental dump into table
+
+        the rows are loaded into a temporary table first, any row of table with
+        the same primary key as one of the new rows is replaced so rows that were
+        updated since the last dump end up with their latest values, the
+        sequences of table catch up with the new rows once everything is loaded
+
+        the primary key is the one the manifest recorded when table was dumped,
+        in fast mode the restored table doesn't have its key yet
+        """
+        logger.info('------- loading {} into table {}'.format(os.path.basename(path), table))
+        record = self.manifest.get(table) or {}
+        table = self._get_restore_name(table)
+        options = self._get_copy_options(path)
+        before = [
+            "CREATE TEMPORARY TABLE dump_increment (LIKE {}) ON COMMIT DROP".format(table),
+        ]
+
+        commands = []
+        if "primary_key" in record:
+            pk = record["primary_key"]
+        else:
+            pk = [c for c, _ in self._get_primary_key(table)]
+        if pk:
+            commands.append("DELETE FROM {} USING dump_increment WHERE {}".format(
+                table,
+                " AND ".join(
+                    "{}.{} = dump_increment.{}".format(table, quote_ident(c), quote_ident(c)) for c in pk
+                ),
+            ))
+
+        commands.append("INSERT INTO {} SELECT * FROM dump_increment".format(table))
+
+        with self._transaction() as session, self._restore_metrics(table, path) as stages:
+            if session:
+                for command in before:
+                    session.execute(command)
+                session.copy("dump_increment", self._read(path, stages), options)
+                for command in commands:
+                    session.execute(command)
+
+            else:
+                commands = ["BEGIN"] + before + ["COPY dump_increment FROM STDIN{}".format(options)] + commands
+                commands.append("COMMIT")
+                psql_args = self._get_args(
+                    'psql',
+                    '-X',
+                    '--quiet',
+                    '--set=ON_ERROR_STOP=1',
+                    *["--command={}".format(command) for command in commands]
+                )
+                self._load(path, psql_args, stages)
+
+    def _restore_sequences(self, tables):
+        """make sure the next value of every sequence owned by a column of tables
+        (serial and identity columns in any schema) is past the highest value of
+        its column
+
+        the dump scripts set the sequences to what they were when the table was
+        dumped, but increments and chunks can load rows with higher values, so
+        all the sequences are found with one query and caught up with one more,
+        a sequence is never moved backwards
+
+        tables -- list -- the table names
+        """
+        if not tables:
+            return
+
+        rows = self._query(" ".join([
+            "SELECT s.oid::regclass, t.oid::regclass, a.attname FROM pg_depend d",
+            "JOIN pg_class s ON s.oid = d.objid AND s.relkind = 'S'",
+            "JOIN pg_class t ON t.oid = d.refobjid",
+            "JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = d.refobjsubid",
+            "WHERE d.classid = 'pg_class'::regclass AND d.refclassid = 'pg_class'::regclass",
+            "AND d.deptype IN ('a', 'i')",
+            "AND t.oid = ANY(ARRAY[{}]::regclass[])".format(
+                ", ".join("'{}'".format(table.replace("'", "''")) for table in tables)
+            ),
+        ]))
+        if not rows:
+            return
+
+        logger.info("------- resetting {} sequences".format(len(rows)))
+        self._query(" ".join([
+            "SELECT setval(seq, m) FROM (VALUES {}) AS s(seq, m)".format(", ".join(
+                "('{}'::regclass, (SELECT MAX({}) FROM {})::bigint)".format(
+                    seq.replace("'", "''"),
+                    quote_ident(column),
+                    table,
+                ) for seq, table, column in rows
+            )),
+            "WHERE m > COALESCE(pg_sequence_last_value(seq), 0)",
+        ]))
+
+    def _get_copy_options(self, path):
+        """return the options COPY needs to load the rows in path"""
+        with self._open(path) as fp:
+            if fp.read(len(PGCOPY_SIGNATURE)) == PGCOPY_SIGNATURE:
+                return " WITH (FORMAT binary)"
+        return ""
+
+    def _load(self, path, psql_args, stages=None):
+        """stream the contents of path into the stdin of the psql_args command,
+        decompressing it on the way without ever writing it to disk"""
+        self._run_cmds([(psql_args, {"stdout": subprocess.DEVNULL})], stdin=self._read(path, stages))
+
+    def _read(self, path, stages=None):
+        """yield the decompressed contents of path
+
+        stages -- dict -- if given, the seconds spent reading and decompressing
+            the file are added to its read key
+        """
+        codec, _ = self._find_codec(path)
+        if self.archive:
+            chunks = self.archive.read_chunks(os.path.basename(path), codec)
+
+        else:
+            chunks = codec.read_chunks(path)
+        return chunks if stages is None else timed(chunks, stages, "read")
+
+    def _open(self, path):
+        """open path for reading, decompressing it if needed"""
+        return io.BufferedReader(Reader(self._read(path)), buffer_size=CHUNK_SIZE)
+
+    def _find_codec(self, path):
+        """return the codec that reads the backup file at path and path without
+        the codec's extension, the recipes of a chunk store are read from
+        self.store"""
+        if path.endswith(chunkstore.EXTENSION):
+            if not self.store:
+                raise ValueError("{} is a recipe of a chunk store, the store is needed to restore it".format(path))
+            codec, path = find_codec(path[:-len(chunkstore.EXTENSION)])
+            return self.store.codec(codec), path
+
+        return find_codec(path)
+
+    def _is_script(self, path):
+        """return True if path is a pg_dump script, False if it is rows for COPY"""
+        _, path = self._find_codec(path)
+        return path.endswith(".sql")
+
+    def _get_dependencies(self, tables, jobs=1):
+        """find the foreign keys between the given tables
+
+        the foreign keys are found in the db catalog and in the references the
+        manifest recorded for each table when it was dumped. A table that doesn't
+        exist in the db yet and was backed up before the manifest recorded its
+        references has its dump script scanned for foreign key constraints
+
+        tables -- dict -- the keys are the table names, the values are a list of
+            (name, paths) tuples of the dump files of that table
+        jobs -- integer -- how many scripts are scanned at the same time
+        return -- dict -- the keys are table names, the values are the set of table
+            names the key has foreign keys to
+        """
+        deps = {}
+        found = set()
+
+        relations = self._query(" ".join([
+            "SELECT n.nspname, c.relname FROM pg_class c",
+            "JOIN pg_namespace n ON n.oid = c.relnamespace",
+            "WHERE c.relkind IN ('r', 'p')",
+        ]))
+        foreign_keys = self._query(" ".join([
+            "SELECT cn.nspname, c.relname, pn.nspname, p.relname FROM pg_constraint con",
+            "JOIN pg_class c ON c.oid = con.conrelid",
+            "JOIN pg_namespace cn ON cn.oid = c.relnamespace",
+            "JOIN pg_class p ON p.oid = con.confrelid",
+            "JOIN pg_namespace pn ON pn.oid = p.relnamespace",
+            "WHERE con.contype = 'f'",
+        ]))
+
+        # the table names are either qualified with their schema or bare, a bare
+        # name is the table on the search_path
+        qualified = {}
+        bare = {}
+        for table in tables:
+            parts = split_name(table)
+            if len(parts) > 1:
+                qualified[tuple(parts[-2:])] = table
+            else:
+                bare[parts[0]] = table
+
+        # every schema each table name is in, as far as the db and the manifest know
+        schemas = {}
+        for schema, name in list(relations) + list(qualified.keys()):
+            schemas.setdefault(name, set()).add(schema)
+        for table in tables:
+            for schema, name in (self.manifest.get(table) or {}).get("references", []):
+                schemas.setdefault(name, set()).add(schema)
+
+        def get_table(schema, name):
+            table = qualified.get((schema, name))
+            if table is None and name in bare:
+                # the bare name can only be the table if no other schema has a
+                # table with that name that isn't in tables under its own name,
+                # without a schema there can be one
+                others = schemas.get(name, set()) - set(s for s, n in qualified if n == name)
+                others.discard(schema)
+                if len(others) <= (0 if schema else 1):
+                    table = bare[name]
+            return table
+
+        for schema, name in relations:
+            table = get_table(schema, name)
+            if table:
+                found.add(table)
+
+        for schema, name, parent_schema, parent_name in foreign_keys:
+            table = get_table(schema, name)
+            parent = get_table(parent_schema, parent_name)
+            if table and parent and table != parent:
+                deps.setdefault(table, set()).add(parent)
+
+        scans = []
+        for table, files in tables.items():
+            record = self.manifest.get(table) or {}
+            if "references" in record:
+                for parent_schema, parent_name in record["references"]:
+                    parent = get_table(parent_schema, parent_name)
+                    if parent and table != parent:
+                        deps.setdefault(table, set()).add(parent)
+
+            elif table not in found:
+                for name, paths in files:
+                    scans.extend((table, path) for path in paths if self._is_script(path))
+
+        # the foreign keys are at the end of the script, after any rows that
+        # are in it, so the whole script has to be read
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            references = executor.map(self._find_references, [path for _, path in scans])
+            for (table, _), parents in zip(scans, references):
+                for parent in parents:
+                    parent = get_table(*parent) if len(parent) > 1 else get_table(None, parent[0])
+                    if parent and table != parent:
+                        deps.setdefault(table, set()).add(parent)
+
+        return deps
+
+    def _find_references(self, path):
+        """return the tables the foreign keys in the dump script at path reference,
+        only the lines with a foreign key are decoded
+
+        return -- set -- tuples of the unquoted (schema, table) or (table,) names
+        """
+        # pg_dump writes foreign keys like:
+        #     ADD CONSTRAINT bar_foo_fkey FOREIGN KEY (foo) REFERENCES public.foo(_id);
+        r = re.compile(r'^\s+ADD CONSTRAINT .+ FOREIGN KEY .+ REFERENCES ([^(]+)\(')
+        ret = set()
+        with self._open(path) as fp:
+            for line in fp:
+                if b" FOREIGN KEY " in line:
+                    m = r.match(line.decode("utf-8", "replace"))
+                    if m:
+                        ret.add(tuple(split_name(m.group(1).strip())[-2:]))
+        return ret
+
+    def table_dump(self, table, data_format=None, chunks=1, **kwargs):
+        """dump all the rows of the given table name
+
+        table -- string -- the table name
+        data_format -- string -- one of DATA_FORMATS, defaults to self.data_format
+        chunks -- integer -- split the rows into this many parts that are all
+            dumped at the same time
+        **kwargs -- anything else tables_dump() takes
+        """
         if not table: raise ValueError("no table")
+        kwargs.setdefault("jobs", chunks)
+        return self.tables_dump([table], data_format=data_format, chunks=chunks, **kwargs)
+
+    def select_dump(self, table, query, data_format=None, **kwargs):
+        """dump the rows query returns as the rows of table
+
+        the definition of table is dumped like always, and the rows are dumped
+        with COPY (query) TO STDOUT, so restoring the backup creates table with
+        just these rows
+
+        :Example:
+            # backup only the last week of events
+            db.select_dump("events", "SELECT * FROM events WHERE created > now() - interval '7 days'")
+
+        table -- string -- the table name
+        query -- string -- a SELECT that returns the columns of table in order
+        data_format -- string -- copy or binary, defaults to self.data_format
+        **kwargs -- anything else tables_dump() takes
+        """
+        if not table: raise ValueError("no table")
+        return self.tables_dump([table], data_format=data_format, queries={table: query}, **kwargs)
+
+    def subset_dump(self, table, where=None, percent=None, data_format=None, **kwargs):
+        """dump some of the rows of table and every row they reference
+
+        the seed rows of table are picked with where and percent, then the
+        foreign keys in the db catalog are followed from them to every row of
+        every table they reference, and the rows those reference, and so on.
+        Each of those tables is dumped with just its rows, so the backup
+        restores without any foreign key violations. Rows that reference the
+        seed rows aren't dumped
+
+        :Example:
+            # a staging copy of about 1% of the orders and their users, products...
+            db.subset_dump("orders", percent=1)
+
+        table -- string -- the table the seed rows come from
+        where -- string -- only the rows of table matching this WHERE clause are
+            seed rows
+        percent -- float -- only this percent of the rows of table, picked at
+            random, are seed rows. The same rows are picked every time as long as
+            the table doesn't change
+        data_format -- string -- copy or binary, defaults to self.data_format
+        **kwargs -- anything else tables_dump() takes
+        """
+        if not table: raise ValueError("no table")
+        if percent is not None and not 0 < percent <= 100:
+            raise ValueError("percent has to be more than 0 and at most 100")
+
+        queries = self._get_subset_queries(table, where, percent)
+        logger.info("------- dumping a subset of {} and the {} tables it references".format(
+            table,
+            len(queries) - 1,
+        ))
+        return self.tables_dump(list(queries.keys()), data_format=data_format, queries=queries, **kwargs)
+
+    def _get_subset_queries(self, table, where=None, percent=None):
+        """return the queries of the rows subset_dump() dumps from each table
+
+        every table the seed table references, directly or through other tables,
+        gets a query with a common table expression (subset_N) for each of the
+        tables whose rows it is referenced by, so a row is only selected if a
+        selected row references it. A table that references itself selects the
+        rows its own selected rows reference with a recursive query over their
+        ctids
+
+        return -- dict -- the keys are the table names, the tables that are
+            referenced come first, the values are the SELECT queries
+        """
+        table = self._query("SELECT '{}'::regclass".format(table))[0][0]
+        foreign_keys = self._get_foreign_keys()
+
+        # every table the seed table references, and the foreign keys between them
+        tables = [table]
+        references = OrderedDict()
+        for name in tables:
+            for columns, parent, parent_columns in foreign_keys.get(name, []):
+                references.setdefault(parent, []).append((name, columns, parent_columns))
+                if parent not in tables:
+                    tables.append(parent)
+
+        # a table has to come after every table that references it
+        order = []
+        visiting = []
+
+        def visit(name):
+            if name in order: return
+            if name in visiting:
+                cycle = visiting[visiting.index(name):] + [name]
+                raise ValueError("The foreign keys of {} form a cycle, a subset can't follow them".format(
+                    " -> ".join(cycle)
+                ))
+
+            visiting.append(name)
+            for child, _, _ in references.get(name, []):
+                if child != name:
+                    visit(child)
+            visiting.pop()
+            order.append(name)
+
+        for name in tables:
+            visit(name)
+
+        ctes = OrderedDict()
+        for name in order:
+            cte = "subset_{}".format(len(ctes) + 1)
+            if name == table:
+                source = [
+                    "SELECT * FROM {}".format(name),
+                    "TABLESAMPLE BERNOULLI ({}) REPEATABLE (0)".format(percent) if percent else "",
+                    "WHERE ({})".format(where) if where else "",
+                ]
+
+            else:
+                source = ["SELECT * FROM {} WHERE".format(name), " OR ".join(
+                    "({}) IN (SELECT {} FROM {})".format(
+                        ", ".join(parent_columns),
+                        ", ".join(columns),
+                        ctes[child][0],
+                    ) for child, columns, parent_columns in references[name] if child != name
+                )]
+
+            source = " ".join(q for q in source if q)
+            joins = [
+                "({}) = ({})".format(
+                    ", ".join("p.{}".format(c) for c in parent_columns),
+                    ", ".join("c.{}".format(c) for c in columns),
+                ) for child, columns, parent_columns in references.get(name, []) if child == name
+            ]
+            if joins:
+                source = " ".join([
+                    "SELECT * FROM {} WHERE ctid IN (".format(name),
+                    "WITH RECURSIVE tids(tid) AS (",
+                    source.replace("SELECT *", "SELECT ctid", 1),
+                    "UNION",
+                    "SELECT p.ctid FROM tids JOIN {} AS c ON c.ctid = tids.tid".format(name),
+                    "JOIN {} AS p ON {}".format(name, " OR ".join(joins)),
+                    ") SELECT tid FROM tids)",
+                ])
+
+            # the tables whose subset this one is picked from
+            needs = set([name])
+            for child, _, _ in references.get(name, []):
+                if child != name:
+                    needs.update(ctes[child][1])
+            ctes[name] = (cte, needs, source)
+
+        queries = OrderedDict()
+        for name in reversed(order):
+            cte, needs, _ = ctes[name]
+            queries[name] = "WITH {} SELECT * FROM {}".format(
+                ", ".join("{} AS ({})".format(c, q) for n, (c, _, q) in ctes.items() if n in needs),
+                cte,
+            )
+        return queries
+
+    def _get_foreign_keys(self):
+        """return all the foreign keys in the db
+
+        return -- dict -- the keys are the table names, the values are a list of
+            (columns, parent table, parent columns) tuples, the columns are quoted
+        """
+        # the names of the columns are joined with the record separator, chr(30)
+        separator = "\x1e"
+        columns = " ".join([
+            "array_to_string(ARRAY(SELECT a.attname FROM unnest(con.{}) WITH ORDINALITY AS k(attnum, i)",
+            "JOIN pg_attribute a ON a.attrelid = con.{} AND a.attnum = k.attnum ORDER BY k.i), chr(30))",
+        ])
+        ret = {}
+        for table, table_columns, parent, parent_columns in self._query(" ".join([
+            "SELECT con.conrelid::regclass,",
+            columns.format("conkey", "conrelid") + ",",
+            "con.confrelid::regclass,",
+            columns.format("confkey", "confrelid"),
+            "FROM pg_constraint con",
+            # the foreign keys of a partitioned table are copied to its partitions
+            "WHERE con.contype = 'f' AND con.conparentid = 0",
+            "ORDER BY con.conrelid::regclass::text, con.conname",
+        ])):
+            ret.setdefault(table, []).append((
+                [quote_ident(c) for c in table_columns.split(separator)],
+                parent,
+                [quote_ident(c) for c in parent_columns.split(separator)],
+            ))
+        return ret
+
+    def tables_dump(
+        self,
+        tables,
+        jobs=1,
+        data_format=None,
+        chunks=1,
+        incremental=False,
+        watermark=None,
+        previous=None,
+        resume=False,
+        where=None,
+        queries=None,
+        track_changes=False,
+    ):
+        """dump all the rows of all the given tables, running up to jobs dumps at
+        the same time
+
+        the biggest tables are dumped first, but the output files are numbered in
+        the order of tables no matter what order the dumps finish in, and if any
+        table fails the rest of the dumps are stopped and the exception is raised
+
+        tables -- list -- the table names to dump
+        jobs -- integer -- how many tables can be dumped at the same time
+        data_format -- string -- one of DATA_FORMATS, defaults to self.data_format
+        chunks -- integer -- split the rows of every table into this many parts,
+            the parts are dumped at the same time like separate tables
+        incremental -- boolean -- the first time a table is dumped into
+            self.directory all its rows are dumped, after that only the rows
+            whose watermark column is past the highest value of the last dump
+            are dumped into NNN_table.incK.copy
+        watermark -- string -- the watermark column for tables dumped for the
+            first time, it has to only ever increase for new or updated rows, like
+            an id or an updated timestamp, defaults to the primary key
+        previous -- string -- the directory of an earlier backup, tables that
+            haven't changed since that backup are linked from it instead of
+            being dumped again, this implies track_changes
+        resume -- boolean -- if the last backup of the same tables into
+            self.directory failed, the tables and chunks it finished dumping are
+            kept, if their files are still the same size, instead of being dumped
+            again. These are from the snapshot of the failed backup, the
+            manifest records the snapshot of each file so restore can warn that
+            the tables might not be consistent with each other
+        where -- string -- only dump the rows of every table that match this
+            WHERE clause, like "created > now() - interval '7 days'"
+        queries -- dict -- the keys are table names and the values are the
+            SELECT queries whose rows are dumped as the rows of that table
+        track_changes -- boolean -- record the version of the rows of every
+            dumped table in the manifest, a later backup with previous only links
+            a table if its rows still have that version. This reads every
+            dumped table once more, at the same time as the dumps
+        """
+        for table in tables:
+            if not table: raise ValueError("no table")
+
+        queries = queries or {}
+        filters = OrderedDict()
+        if where:
+            filters["where"] = where
+        if queries:
+            filters["queries"] = OrderedDict(sorted(queries.items()))
+
+        if filters and incremental:
+            raise ValueError("Incremental dumps can't be filtered with a where clause or a query")
+
+        signatures = {}
+        previous_manifest = None
+        checkpoint = None
+        if incremental:
+            if previous:
+                raise ValueError("Incremental dumps can't link unchanged tables from a previous backup")
+
+            if resume:
+                raise ValueError("Incremental dumps carry on from their last watermark, they can't be resumed")
+
+        else:
+            # these are read before the snapshot is taken, so any change that
+            # didn't make it into the snapshot changes the signature next time
+            signatures = self._get_signatures(tables)
+            if previous:
+                previous_manifest = Manifest(previous)
+
+            checkpoint = self._start_checkpoint(
+                "backup",
+                resume,
+                tables=list(tables),
+                data_format=data_format or self.data_format,
+                compression=self.codec.name,
+                chunks=chunks,
+                **filters
+            )
+            for record in checkpoint.jobs.values():
+                # a resumed table has files from the failed backup, so it has to
+                # look like it did then to a later backup, and the rows of this
+                # snapshot say nothing about them
+                signatures[record["table"]] = OrderedDict(record["signature"], rows=None)
+
+        sizes = self._get_sizes(tables)
+        references = self._get_references(tables)
+        primary_keys = self._get_primary_keys(tables)
+
+        if self.archive_path:
+            self._start_archive()
+
+        # the chunks of the recipes can't be pruned until the recipes are all in
+        # the directory or the archive
+        store_lock = self.store.lock(shared=True) if self.store else _null_context()
+        with store_lock, self._run_metrics("backup", tables), self._consistent_snapshot():
+            linked = set()
+            if previous_manifest:
+                linked = self._get_unchanged(
+                    tables,
+                    previous_manifest,
+                    signatures,
+                    dict((table, self._get_dump_settings(table, data_format, chunks, where, queries)) for table in tables),
+                    jobs,
+                )
+
+            # the row versions are read at the same time as the rows are dumped
+            row_versions = {}
+            track_changes = bool((previous or track_changes) and self.snapshot_id and self._has_row_versions())
+
+            scheduler = Scheduler(jobs)
+            if incremental:
+                if not self.snapshot_id:
+                    raise ValueError("Incremental dumps need a consistent snapshot")
+
+                for record in self.manifest.tables.values():
+                    self.outfile_count = max(self.outfile_count, int(record["name"].split("_", 1)[0]))
+
+            for table in tables:
+                if incremental:
+                    self._add_incremental_jobs(scheduler, table, data_format, chunks, watermark, sizes[table])
+
+                else:
+                    self.manifest.remove(table)
+                    outfile_prefix = self._get_outfile_prefix(table)
+                    name = os.path.basename(outfile_prefix)
+                    settings = self._get_dump_settings(table, data_format, chunks, where, queries)
+                    if table in linked:
+                        scheduler.add(name, self._link_dump, table, outfile_prefix, previous_manifest)
+
+                    else:
+                        names = self._add_dump_jobs(
+                            scheduler,
+                            table,
+                            outfile_prefix,
+                            data_format,
+                            chunks,
+                            sizes[table],
+                            where=where,
+                            query=queries.get(table),
+                        )
+                        if track_changes and "rows" not in signatures[table]:
+                            scheduler.add(name + ".rows", self._read_row_version, table, row_versions)
+                            scheduler.weigh(name + ".rows", sizes[table])
+                            names.append(name + ".rows")
+
+                        scheduler.add(
+                            name + ".manifest",
+                            self._save_dump,
+                            table,
+                            outfile_prefix,
+                            signatures[table],
+                            settings,
+                            row_versions,
+                        )
+                        scheduler.depend(name + ".manifest", *names)
+
+            on_done = None
+            if checkpoint:
+                on_done = lambda job, files: self._checkpoint_dump(checkpoint, job, files, signatures)
+                for name in self._resume(scheduler, checkpoint, self._verify_dump):
+                    for fields in checkpoint.get(name)["files"]:
+                        self.manifest.add_file(scheduler.queue[name].args[0], **fields)
+
+            self._run_scheduler(scheduler, on_done)
+            for table in tables:
+                self.manifest.update(
+                    table,
+                    save=False,
+                    references=references[table],
+                    primary_key=primary_keys[table],
+                )
+            self.manifest.save()
+
+            if checkpoint:
+                checkpoint.remove()
+
+        return True
+
+    def _start_archive(self):
+        """open the archive at self.archive_path that every backup file is
+        written into, it stays open for all the backups until close()"""
+        with self.archive_lock:
+            if self.archive_writer:
+                return
+
+            if self.archive_path == "-":
+                fp = sys.stdout.buffer
+
+            else:
+                fp = self.archive_stack.enter_context(open(self.archive_path, "wb"))
+
+            if self.store:
+                # the recipes that are only in the archive can't be found by
+                # prune until the archive has its index
+                self.archive_stack.enter_context(self.store.lock(shared=True))
+
+            self.archive_writer = ArchiveWriter(fp)
+
+    def _archive_file(self, name):
+        """write the backup file name into the archive as soon as it is dumped,
+        a file in a temporary directory is removed once it is in the archive so
+        the whole backup is never on disk"""
+        path = os.path.join(self.directory, name)
+        with self.archive_lock:
+            if not self.archive_writer:
+                return
+            self.archive_writer.add(name, path)
+
+        if self.tmp_directory:
+            os.unlink(path)
+
+    def _get_dump_settings(self, table, data_format, chunks, where, queries):
+        """return the settings table is dumped with, the files of a previous
+        backup are only linked if they were dumped with the same settings"""
+        settings = OrderedDict([
+            ("data_format", data_format or self.data_format),
+            ("compression", self.codec.name),
+            ("chunks", chunks),
+        ])
+        # a table that was filtered can only be linked to the same filtered rows
+        if where:
+            settings["where"] = where
+        if table in queries:
+            settings["query"] = queries[table]
+        return settings
+
+    def _get_unchanged(self, tables, previous_manifest, signatures, settings, jobs):
+        """return the tables that haven't changed since the previous backup
+
+        a table whose signature and settings are the same as in the previous
+        backup could still have changed, the change counters of the statistics
+        collector are only flushed by each session every so often and an UPDATE
+        in place doesn't change the size of the table. So the versions of its
+        rows are read from the snapshot too, and the table is only unchanged if
+        they are the same as the rows the previous backup dumped
+
+        signatures -- dict -- the signature of each table now
+        settings -- dict -- the settings each table is dumped with now
+        return -- set -- the names of the tables whose files can be linked
+        """
+        if not self.snapshot_id:
+            logger.warning("------- dumping every table, unchanged tables are only linked from a snapshot")
+            return set()
+
+        if not self._has_row_versions():
+            logger.warning("------- dumping every table, unchanged tables are only linked from PostgreSQL 11 on")
+            return set()
+
+        candidates = []
+        for table in tables:
+            record = previous_manifest.get(table)
+            if not record or not record.get("signature"):
+                continue
+
+            previous_signature = OrderedDict(record["signature"])
+            rows = previous_signature.pop("rows", None)
+            if rows and previous_signature == signatures[table] and record.get("settings") == settings[table]:
+                candidates.append((table, rows))
+
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            versions = list(executor.map(self._get_row_version, [table for table, _ in candidates]))
+
+        unchanged = set()
+        for (table, rows), version in zip(candidates, versions):
+            if rows == version:
+                unchanged.add(table)
+
+            else:
+                logger.info("------- dumping table {}, its rows changed since the previous backup".format(table))
+
+        return unchanged
+
+    def _checkpoint_dump(self, checkpoint, job, files, signatures):
+        """journal the files of a dump job once it has finished"""
+        if isinstance(files, list):
+            table = job.args[0]
+            checkpoint.add(job.name, table=table, args=list(job.args), files=files, signature=signatures[table])
+
+    def _verify_dump(self, job, record):
+        """return True if the dump job journaled in record doesn't need to run
+        again"""
+        return record["args"] == list(job.args) and self._verify_files(record["files"])
+
+    def _read_row_version(self, table, row_versions):
+        """read the version of the rows of table from the snapshot into
+        row_versions, see _get_row_version()"""
+        row_versions[table] = self._get_row_version(table)
+
+    def _save_dump(self, table, outfile_prefix, signature, settings, row_versions):
+        """record a finished dump of table in the manifest so a later backup can
+        tell if the table has changed since
+
+        row_versions -- dict -- the version of the rows of the tables whose
+            changes are tracked, a table without one is never linked
+        """
+        signature = OrderedDict(signature)
+        if "rows" not in signature:
+            signature["rows"] = row_versions.get(table)
+
+        self.manifest.update(
+            table,
+            save=False,
+            name=os.path.basename(outfile_prefix),
+            signature=signature,
+            settings=settings,
+            skipped=False,
+        )
+
+    def _link_dump(self, table, outfile_prefix, previous_manifest):
+        """use the files of table from a previous backup instead of dumping it
+
+        the files are hard linked so they don't take any more space, or copied if
+        the previous backup is on another filesystem
+        """
+        record = previous_manifest.get(table)
+        directory = os.path.dirname(previous_manifest.path)
+        logger.info('------- skipping table {}, it is unchanged since {}'.format(
+            table,
+            os.path.join(directory, record["name"]),
+        ))
+
+        for fields in record["files"]:
+            fields = OrderedDict(fields)
+            src = os.path.join(directory, fields["name"])
+            fields["name"] = os.path.basename(outfile_prefix) + fields["name"][len(record["name"]):]
+            # the rows were checked against this snapshot, see _get_unchanged()
+            fields["snapshot"] = self.snapshot_id
+            dst = os.path.join(self.directory, fields["name"])
+            if os.path.exists(dst):
+                os.unlink(dst)
+
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copy2(src, dst)
+
+            self.manifest.add_file(table, **fields)
+            self._archive_file(fields["name"])
+
+        self.manifest.update(
+            table,
+            save=False,
+            name=os.path.basename(outfile_prefix),
+            signature=record["signature"],
+            settings=record["settings"],
+            skipped=True,
+            previous=os.path.join(directory, record["name"]),
+        )
+
+    def get_tables(self, patterns=None):
+        """return the names of the tables to dump
+
+        the tables are the ordinary and partitioned tables of every schema but
+        the system ones, their names are qualified with their schema and quoted
+        if they need to be (like public."Foo") so pg_dump --table and ::regclass
+        find the same table
+
+        patterns -- list -- table names and shell style globs like "log_*", a
+            name without any of *?[ is returned as is, a glob is replaced with
+            the names of the tables it matches, see match_tables(), defaults to
+            all the tables
+        return -- list -- the table names in the order of patterns
+        """
+        if patterns and not any(re.search(r"[*?\[]", p) for p in patterns):
+            return list(patterns)
+
+        names = [quote_name(schema, name) for schema, name in self._query(" ".join([
+            "SELECT n.nspname, c.relname FROM pg_class c",
+            "JOIN pg_namespace n ON n.oid = c.relnamespace",
+            "WHERE c.relkind IN ('r', 'p')",
+            "AND n.nspname !~ '^pg_' AND n.nspname <> 'information_schema'",
+            "ORDER BY n.nspname, c.relname",
+        ]))]
+        if not patterns:
+            return names
+
+        ret = []
+        for pattern in patterns:
+            if re.search(r"[*?\[]", pattern):
+                matches = match_tables(names, pattern)
+                if not matches:
+                    raise ValueError("No tables match {}".format(pattern))
+
+            else:
+                matches = [pattern]
+
+            ret.extend(name for name in matches if name not in ret)
+        return ret
+
+    def _get_references(self, tables):
+        """return the tables the foreign keys of each table reference, these are
+        saved in the manifest so restore knows what order to load the tables in
+        without reading their scripts
+
+        return -- dict -- the keys are the table names, the values are sorted
+            lists of [schema, table] pairs
+        """
+        names = ", ".join("'{}'".format(table.replace("'", "''")) for table in tables)
+        rows = self._query(" ".join([
+            "SELECT DISTINCT t.name, n.nspname, p.relname",
+            "FROM unnest(ARRAY[{}]::text[]) AS t(name)".format(names),
+            "JOIN pg_constraint con ON con.conrelid = t.name::regclass AND con.contype = 'f'",
+            "JOIN pg_class p ON p.oid = con.confrelid",
+            "JOIN pg_namespace n ON n.oid = p.relnamespace",
+        ]))
+        ret = dict((table, []) for table in tables)
+        for table, schema, name in rows:
+            ret[table].append([schema, name])
+        return dict((table, sorted(parents)) for table, parents in ret.items())
+
+    def _get_primary_keys(self, tables):
+        """return the columns of the primary key of each table, these are saved
+        in the manifest so restore can replace the rows of an increment before
+        the primary key of the restored table is built
+
+        return -- dict -- the keys are the table names, the values are lists of
+            the column names in the order of the key, empty without a key
+        """
+        names = ", ".join("'{}'".format(table.replace("'", "''")) for table in tables)
+        rows = self._query(" ".join([
+            "SELECT t.name, a.attname, array_position(i.indkey::int2[], a.attnum)",
+            "FROM unnest(ARRAY[{}]::text[]) AS t(name)".format(names),
+            "JOIN pg_index i ON i.indrelid = t.name::regclass AND i.indisprimary",
+            "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)",
+        ]))
+        ret = dict((table, []) for table in tables)
+        for table, column, position in sorted(rows, key=lambda row: (row[0], int(row[2]))):
+            ret[table].append(column)
+        return ret
+
+    def _get_sizes(self, tables):
+        """return the bytes each table takes on disk, with its indexes and TOAST
+
+        return -- dict -- the keys are the table names, the values are integers
+        """
+        names = ", ".join("'{}'".format(table.replace("'", "''")) for table in tables)
+        rows = self._query(" ".join([
+            "SELECT t.name, pg_total_relation_size(t.name::regclass)",
+            "FROM unnest(ARRAY[{}]::text[]) AS t(name)".format(names),
+        ]))
+        return dict((name, int(size)) for name, size in rows)
+
+    def _get_signatures(self, tables):
+        """return what the rows and the definition of each table look like now,
+        if a signature is the same as an earlier signature of the table then the
+        table hasn't changed in between
+
+        the signature uses the insert, update and delete counters of the
+        statistics collector, the table's file node (changed by TRUNCATE and table
+        rewrites), its size, and its columns, constraints and indexes
+
+        the counters can lag behind the changes, so a table is only unchanged if
+        the versions of its rows are the same too, see _get_row_version()
+
+        tables -- list -- the table names
+        return -- dict -- the keys are the table names, the values are dicts
+        """
+        names = ", ".join("'{}'".format(table.replace("'", "''")) for table in tables)
+        rows = self._query(" ".join([
+            "SELECT",
+            "  t.name,",
+            "  s.n_tup_ins,",
+            "  s.n_tup_upd,",
+            "  s.n_tup_del,",
+            "  c.relfilenode,",
+            "  pg_relation_size(c.oid),",
+            "  (SELECT md5(string_agg(",
+            "    a.attname || ' ' || format_type(a.atttypid, a.atttypmod) || ' ' || a.attnotnull, ', '",
+            "    ORDER BY a.attnum",
+            "  )) FROM pg_attribute a WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped),",
+            "  (SELECT md5(coalesce(string_agg(pg_get_constraintdef(con.oid), ', ' ORDER BY con.conname), ''))",
+            "    FROM pg_constraint con WHERE con.conrelid = c.oid),",
+            "  (SELECT md5(coalesce(string_agg(pg_get_indexdef(i.indexrelid), ', ' ORDER BY 1), ''))",
+            "    FROM pg_index i WHERE i.indrelid = c.oid)",
+            "FROM unnest(ARRAY[{}]::text[]) AS t(name)".format(names),
+            "JOIN pg_class c ON c.oid = t.name::regclass",
+            "LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid",
+        ]))
+
+        signatures = {}
+        for row in rows:
+            signature = OrderedDict(zip(
+                ["inserted", "updated", "deleted", "filenode", "size", "columns", "constraints", "indexes"],
+                row[1:9],
+            ))
+            signatures[row[0]] = signature
+
+        return signatures
+
+    def _has_row_versions(self):
+        """return True if the server can hash the row versions, the 64 bit
+        hashtextextended() is only in PostgreSQL 11 on"""
+        if self.server_version is None:
+            self.server_version = int(self._query("SHOW server_version_num")[0][0])
+        return self.server_version >= 110000
+
+    def _get_row_version(self, table):
+        """return the count and a hash of where every row of table is and the
+        transaction that wrote it
+
+        any INSERT, UPDATE or DELETE changes it as soon as it is committed, even
+        an UPDATE in place, since every row it writes is a new row version. Only
+        the system columns are read so it is much cheaper than hashing the rows
+        """
+        return self._query(" ".join([
+            "SELECT COUNT(*) || ':' || COALESCE(SUM(",
+            "  hashtextextended(tableoid::text || ctid::text || ':' || xmin::text, 0)",
+            "), 0) FROM {}".format(table),
+        ]))[0][0]
+
+    @contextmanager
+    def snapshot(self):
+        """every dump made inside this context sees the db as it was when the
+        context was entered
+
+        this holds a transaction open in a psql session and exports its snapshot
+        with pg_export_snapshot(), every pg_dump and COPY then imports that
+        snapshot so all the tables and chunks are consistent with each other even
+        though they are dumped by separate connections
+
+        :Example:
+            with db.snapshot():
+                db.table_dump("foo")
+                db.table_dump("bar")
+        """
+        if self.snapshot_id:
+            # we are already in a snapshot
+            yield self.snapshot_id
+            return
 
-        cmds = []
-        logger.info('------- dumping table {}'.format(table))
         cmd = self._get_args(
-            "pg_dump",
+            "psql",
+            "-X",
+            "--quiet",
+            "--no-align",
+            "--tuples-only",
+            "--set=ON_ERROR_STOP=1",
+        )
+        logger.debug("Running: {}".format(cmd))
+        pipe = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=self._get_env())
+        try:
+            pipe.stdin.write(b"BEGIN TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;\n")
+            pipe.stdin.write(b"SELECT pg_export_snapshot();\n")
+            pipe.stdin.flush()
+            self.snapshot_id = pipe.stdout.readline().strip().decode("utf-8")
+            if not self.snapshot_id:
+                raise IOError("Could not export a snapshot, psql exited with {}".format(pipe.wait()))
+
+            logger.info("------- using snapshot {}".format(self.snapshot_id))
+            yield self.snapshot_id
+
+            pipe.stdin.write(b"COMMIT;\n")
+
+        finally:
+            self.snapshot_id = None
+            pipe.stdin.close()
+            pipe.stdout.close()
+            pipe.wait()
+
+    def _consistent_snapshot(self):
+        """return the context the dumps should run in"""
+        if self.consistent:
+            return self.snapshot()
+        return _null_context()
+
+    def _add_dump_jobs(self, scheduler, table, outfile_prefix, data_format=None, chunks=1, size=0, where="", query=None):
+        """add the jobs that will dump table to scheduler
+
+        if the table is split into chunks the first job dumps everything but the
+        rows into NNN_table.sql and each chunk job dumps its rows into
+        NNN_table.partK.copy
+
+        size -- integer -- the bytes of the table, this is what the jobs cost so
+            the biggest tables are dumped first
+        where -- string -- only the rows matching this WHERE clause are dumped
+        query -- string -- the rows of this SELECT are dumped instead of the
+            rows of table
+        """
+        data_format = data_format or self.data_format
+        if data_format not in DATA_FORMATS:
+            raise ValueError("Unknown data format {}".format(data_format))
+
+        if data_format == "inserts" and (where or query):
+            raise ValueError("Only copy and binary data formats can be filtered")
+
+        if query and (where or chunks > 1):
+            raise ValueError("The rows of a query can't be filtered or split into chunks")
+
+        name = os.path.basename(outfile_prefix)
+        names = [name]
+        if chunks > 1:
+            if data_format == "inserts":
+                raise ValueError("Only copy and binary data formats can be split into chunks")
+
+            scheduler.add(name, self._table_dump, table, outfile_prefix, data_format, False)
+            for i, chunk_where in enumerate(self._get_chunk_wheres(table, chunks), 1):
+                part = ".part{}".format(i)
+                scheduler.add(
+                    name + part,
+                    self._data_dump,
+                    table,
+                    outfile_prefix + part,
+                    data_format,
+                    " AND ".join("({})".format(w) for w in [chunk_where, where] if w),
+                )
+                scheduler.weigh(name + part, size // chunks)
+                names.append(name + part)
+
+        else:
+            scheduler.add(name, self._table_dump, table, outfile_prefix, data_format, where=where, query=query)
+            scheduler.weigh(name, size)
+
+        return names
+
+    def _add_incremental_jobs(self, scheduler, table, data_format=None, chunks=1, watermark=None, size=0):
+        """add the jobs that will dump the rows of table that are new since the
+        last time it was dumped, or all the rows if this is the first time"""
+        data_format = data_format or self.data_format
+        record = self.manifest.get(table)
+        if record and "watermark" in record:
+            scheduler.add(
+                "{}.inc{}".format(record["name"], len(record["increments"]) + 1),
+                self._increment_dump,
+                table,
+                data_format,
+            )
+
+        else:
+            column = watermark
+            if not column:
+                pk = self._get_primary_key(table)
+                if len(pk) != 1:
+                    raise ValueError("Table {} needs a watermark column".format(table))
+                column = pk[0][0]
+
+            else:
+                # a column that doesn't exist fails here, before any files are
+                # written, instead of once the rows have been dumped
+                self._query("SELECT {} FROM {} LIMIT 0".format(quote_ident(column), table))
+
+            # files of this table that aren't in the manifest were left by a run
+            # that failed before it finished
+            for f in os.listdir(self.directory):
+                m = FILENAME_REGEX.match(f)
+                if m and m.group(2) == table:
+                    os.unlink(os.path.join(self.directory, f))
+            self.manifest.remove(table)
+
+            outfile_prefix = self._get_outfile_prefix(table)
+            names = self._add_dump_jobs(scheduler, table, outfile_prefix, data_format, chunks, size)
+            name = os.path.basename(outfile_prefix)
+            scheduler.add(name + ".watermark", self._save_watermark, table, name, column)
+            scheduler.depend(name + ".watermark", *names)
+
+    def _save_watermark(self, table, name, column):
+        """record the highest value of column in the manifest once table has been
+        dumped for the first time"""
+        value = self._get_watermark(table, column)
+        self.manifest.update(
+            table,
+            name=name,
+            watermark={"column": column, "value": value},
+            increments=[],
+        )
+
+    def _increment_dump(self, table, data_format):
+        """dump the rows of table that are past the watermark of the last dump"""
+        record = self.manifest.get(table)
+        column = record["watermark"]["column"]
+        value = record["watermark"]["value"]
+        increments = list(record["increments"])
+
+        new_value = self._get_watermark(table, column)
+        if new_value == value:
+            logger.info("------- no new rows in table {} since {} {}".format(table, column, value))
+            return
+
+        inc_name = "{}.inc{}".format(record["name"], len(increments) + 1)
+        where = ""
+        if value is not None:
+            where = "{} > '{}'".format(quote_ident(column), value.replace("'", "''"))
+
+        self._data_dump(table, os.path.join(self.directory, inc_name), data_format, where)
+        increments.append(inc_name)
+        self.manifest.update(
+            table,
+            watermark={"column": column, "value": new_value},
+            increments=increments,
+        )
+
+    def _get_watermark(self, table, column):
+        """return the highest value of column in table, None if there are no rows"""
+        value = self._query("SELECT MAX({}) FROM {}".format(quote_ident(column), table))[0][0]
+        return value if value else None
+
+    def _table_dump(self, table, outfile_prefix, data_format=None, rows=True, where="", query=None):
+        """dump table using pg_dump
+
+        rows -- boolean -- False if the rows of the table are being dumped by
+            another job
+        where -- string -- only dump the rows matching this WHERE clause
+        query -- string -- dump the rows of this SELECT instead
+        return -- list -- the manifest fields of each file
+        """
+        data_format = data_format or self.data_format
+        logger.info('------- dumping table {}'.format(table))
+        args = [
             "--table={}".format(table),
             #"--data-only",
             "--clean",
             "--no-owner",
-            "--column-inserts",
+        ]
+        # the rows go in their own file unless pg_dump is writing them, pg_dump
+        # can't filter the rows
+        separate = (
+            data_format == "binary"
+            or (data_format == "copy" and self.driver == "psycopg")
+            or bool(where or query)
         )
-        cmds.append((cmd, {}))
 
-        outfile_path = self._get_outfile_path(table)
-        cmds.append(('gzip > "{}"'.format(outfile_path), {"shell": True}))
+        if data_format == "inserts":
+            args.append("--column-inserts")
+
+        if separate or not rows:
+            # the rows will be in their own file, but we still want everything
+            # else like the sequence values
+            args.append("--exclude-table-data={}".format(table))
+
+        if self.snapshot_id:
+            args.append("--snapshot={}".format(self.snapshot_id))
+
+        outfile_path = "{}.sql{}".format(outfile_prefix, self.codec.extension)
+        files = [self._dump_cmd(table, self._get_args("pg_dump", *args), outfile_path, ScriptRowCounter())]
+
+        if separate and rows:
+            try:
+                files.extend(self._data_dump(table, outfile_prefix, data_format, where, query))
 
-        #cmd += ' | {}'.format(' | '.join(pipes))
-        #cmd += ' > {}'.format(outfile_path)
+            except BaseException:
+                if os.path.exists(outfile_path):
+                    os.unlink(outfile_path)
+                raise
 
-        self._run_cmds(cmds)
         logger.info('------- dumped table {}'.format(table))
-        return True
+        return files
+
+    def _data_dump(self, table, outfile_prefix, data_format, where="", query=None):
+        """dump the rows of table using COPY
+
+        where -- string -- only dump the rows matching this WHERE clause
+        query -- string -- dump the rows of this SELECT instead of the rows of
+            table, they are streamed straight from COPY (query) TO STDOUT
+        return -- list -- the manifest fields of the file
+        """
+        if query:
+            logger.info('------- dumping table {} as {}'.format(table, query))
+            source = "({})".format(query.strip().rstrip(";"))
+
+        elif where:
+            logger.info('------- dumping table {} WHERE {}'.format(table, where))
+            source = "(SELECT * FROM {} WHERE {})".format(table, where)
+
+        else:
+            source = table
+
+        if data_format == "binary":
+            extension = ".pgcopy"
+            options = " WITH (FORMAT binary)"
+            counter = BinaryRowCounter()
+
+        else:
+            extension = ".copy"
+            options = ""
+            counter = CopyRowCounter()
+
+        outfile_path = "{}{}{}".format(outfile_prefix, extension, self.codec.extension)
+        query = "COPY {} TO STDOUT{}".format(source, options)
+        if self.driver == "psycopg":
+            fields = self._dump_stream(table, outfile_path, counter, lambda write: self._copy_to(query, write))
+
+        else:
+            cmd = self._get_args(
+                "psql",
+                "-X",
+                "--quiet",
+                "--set=ON_ERROR_STOP=1",
+                *self._get_snapshot_commands(query)
+            )
+            fields = self._dump_cmd(table, cmd, outfile_path, counter)
+
+        return [fields]
+
+    def _copy_to(self, query, write):
+        """run the COPY ... TO STDOUT query on a psycopg2 connection, inside the
+        exported snapshot if there is one, and pass its output to write"""
+        conn = self._connect()
+        try:
+            if self.snapshot_id:
+                conn.set_session(
+                    isolation_level=psycopg2_extensions.ISOLATION_LEVEL_REPEATABLE_READ,
+                    readonly=True,
+                )
+
+            cursor = conn.cursor()
+            if self.snapshot_id:
+                cursor.execute("SET TRANSACTION SNAPSHOT %s", [self.snapshot_id])
+
+            fp = ChunkBuffer(write)
+            cursor.copy_expert(query, fp, size=CHUNK_SIZE)
+            fp.flush()
+            conn.rollback()
+
+        finally:
+            with self.procs_lock:
+                self.conns.discard(conn)
+            conn.close()
+
+    def _connect(self):
+        """return a new psycopg2 connection to the db"""
+        with self.procs_lock:
+            if self.cancelled.is_set():
+                raise IOError("Connection was cancelled")
+
+            conn = psycopg2.connect(
+                dbname=self.dbname,
+                user=self.username,
+                password=self.password,
+                host=self.host,
+                port=self.port,
+            )
+            self.conns.add(conn)
+        return conn
+
+    def _get_snapshot_commands(self, query):
+        """return the psql --command arguments to run query, inside the exported
+        snapshot if there is one"""
+        if not self.snapshot_id:
+            return ["--command={}".format(query)]
+
+        # psql runs each --command in order in the same session, --quiet keeps
+        # the command tags of the other commands out of the output
+        return [
+            "--command=BEGIN TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY",
+            "--command=SET TRANSACTION SNAPSHOT '{}'".format(self.snapshot_id),
+            "--command={}".format(query),
+            "--command=COMMIT",
+        ]
+
+    def _dump_cmd(self, table, cmd, outfile_path, counter):
+        """run cmd and compress everything it outputs into outfile_path"""
+        return self._dump_stream(table, outfile_path, counter, lambda write: self._run_cmds([(cmd, {})], stdout=write))
+
+    def _dump_stream(self, table, outfile_path, counter, stream):
+        """compress everything stream outputs into outfile_path, then add the file
+        to the manifest of table
+
+        return -- dict -- the manifest fields of the file
+
+        counter -- object -- everything stream outputs is passed to its write()
+            method, its rows property is the rows of table in outfile_path
+        stream -- callable -- this is passed a write callback that it should call
+            with every chunk of output
+        """
+        start = time.time()
+        stages = OrderedDict([("count", 0.0)])
+
+        def write(data):
+            count_start = time.time()
+            counter.write(data)
+            stages["count"] += time.time() - count_start
+            fp.write(data)
+
+        try:
+            with self.codec.writer(outfile_path) as fp:
+                stream(write)
+
+        except BaseException:
+            # don't leave a half written file around to be restored later
+            if os.path.exists(outfile_path):
+                os.unlink(outfile_path)
+            raise
+
+        fields = OrderedDict([
+            ("name", os.path.basename(outfile_path)),
+            ("raw_bytes", fp.raw_bytes),
+            ("bytes", fp.bytes),
+            ("sha256", fp.hexdigest()),
+            ("rows", counter.rows),
+            ("elapsed", round(time.time() - start, 3)),
+        ])
+        if self.store:
+            # bytes is the size of the recipe, this is what the file added to
+            # the store
+            fields["stored_bytes"] = fp.stored_bytes
+        if self.snapshot_id:
+            # a resumed backup keeps the files of the failed backup, which are
+            # from its own snapshot
+            fields["snapshot"] = self.snapshot_id
+        self.manifest.add_file(table, **fields)
+        self._archive_file(fields["name"])
+
+        stages.update(fp.stages)
+        self.metrics.file(
+            "backup",
+            table,
+            fields["name"],
+            time.time() - start,
+            fields["raw_bytes"],
+            fields["bytes"],
+            fields["rows"],
+            stages,
+            "read",
+        )
+        return fields
+
+    def _get_chunk_wheres(self, table, chunks):
+        """split the rows of table into ranges
+
+        the table is split on its primary key if it is a single integer column,
+        otherwise it is split on the physical location of the rows (ctid), which
+        can only skip straight to the blocks of each range on PostgreSQL 14+
+
+        return -- list -- a WHERE clause for each chunk, together they match all
+            the rows of the table
+        """
+        pk = self._get_primary_key(table)
+        if len(pk) == 1 and pk[0][1] in ("smallint", "integer", "bigint"):
+            column = quote_ident(pk[0][0])
+            start, stop = self._query("SELECT MIN({}), MAX({}) FROM {}".format(column, column, table))[0]
+            if not start:
+                return [""]
+            start = int(start)
+            stop = int(stop) + 1
+            lower = "{} >= {}"
+            upper = "{} < {}"
+
+        else:
+            column = "ctid"
+            start = 0
+            stop = int(self._query(
+                "SELECT pg_relation_size('{}'::regclass) / current_setting('block_size')::int".format(table)
+            )[0][0])
+            lower = "{} >= '({},0)'::tid"
+            upper = "{} < '({},0)'::tid"
+
+        size = max(1, -(-(stop - start) // chunks))
+        bounds = list(range(start + size, stop, size))
+        wheres = []
+        for i in range(len(bounds) + 1):
+            where = []
+            if i > 0:
+                where.append(lower.format(column, bounds[i - 1]))
+            if i < len(bounds):
+                where.append(upper.format(column, bounds[i]))
+            wheres.append(" AND ".join(where))
+        return wheres
+
+    def _get_primary_key(self, table):
+        """return the primary key of table
+
+        return -- list -- a (column, type) tuple for each column of the key, in order
+        """
+        return self._query(" ".join([
+            "SELECT a.attname, format_type(a.atttypid, a.atttypmod) FROM pg_index i",
+            "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)",
+            "WHERE i.indrelid = '{}'::regclass AND i.indisprimary".format(table),
+            "ORDER BY array_position(i.indkey::int2[], a.attnum)",
+        ]))
+
+    @contextmanager
+    def _run_metrics(self, operation, tables):
+        """send a run event once the backup or restore has finished, whether it
+        worked or not"""
+        start = time.time()
+        success = False
+        try:
+            yield
+            success = True
+
+        finally:
+            self.metrics.emit(
+                "run",
+                operation=operation,
+                success=success,
+                tables=len(tables),
+                elapsed=round(time.time() - start, 3),
+            )
+
+    def _run_scheduler(self, scheduler, on_done=None):
+        """run all the jobs in scheduler, stopping everything if one of them fails
+
+        on_done -- callable -- see Scheduler.run()
+        """
+        self._get_env()
+        self.cancelled.clear()
+
+        def done(job, ret):
+            self.metrics.emit("job", name=job.name, elapsed=round(job.elapsed, 3))
+            if on_done:
+                on_done(job, ret)
+
+        asyncio.run(self._run_scheduler_async(scheduler, done))
+
+    async def _run_scheduler_async(self, scheduler, on_done=None):
+        self.loop = asyncio.get_running_loop()
+        try:
+            await scheduler.run_async(on_error=self._cancel, on_done=on_done)
+
+        finally:
+            self.loop = None
 
     def _get_file(self):
         '''
@@ -146,48 +2497,83 @@ class Postgres(object):
 
         this will also create a fake pgpass file in order to make it possible for
         the script to be passwordless"""
-        if hasattr(self, 'env'): return self.env
-
-        # create a temporary pgpass file
-        pgpass = self._get_file()
-        # format: http://www.postgresql.org/docs/9.2/static/libpq-pgpass.html
-        pgpass.write('*:*:*:{}:{}\n'.format(self.username, self.password).encode("utf-8"))
-        pgpass.close()
-        self.env = dict(os.environ)
-        self.env['PGPASSFILE'] = pgpass.name
-
-        # we want to assure a consistent environment
-        if 'PGOPTIONS' in self.env: del self.env['PGOPTIONS']
+        if not hasattr(self, 'env'):
+            # create a temporary pgpass file
+            pgpass = self._get_file()
+            # format: http://www.postgresql.org/docs/9.2/static/libpq-pgpass.html
+            pgpass.write('*:*:*:{}:{}\n'.format(self.username, self.password).encode("utf-8"))
+            pgpass.close()
+            self.env = dict(os.environ)
+            self.env['PGPASSFILE'] = pgpass.name
+
+            # we want to assure a consistent environment
+            if 'PGOPTIONS' in self.env: del self.env['PGOPTIONS']
+
+        if self.settings:
+            env = dict(self.env)
+            env['PGOPTIONS'] = " ".join("-c {}={}".format(k, v) for k, v in self.settings.items())
+            return env
+
         return self.env
 
-    def _run_cmds(self, cmds):
+    def _cancel(self):
+        """stop all the currently running commands and make sure no new ones start"""
+        self.cancelled.set()
+        with self.procs_lock:
+            for task in self.tasks:
+                task.get_loop().call_soon_threadsafe(task.cancel)
+
+            for pipe in self.procs:
+                if pipe.poll() is None:
+                    pipe.terminate()
+
+            for conn in self.conns:
+                conn.cancel()
+
+    def _run_cmds(self, cmds, stdin=None, stdout=None):
+        """run the cmds, piping the output of each command into the next command
 
-        pipes = []
-        env = self._get_env()
-        for args, kwargs in cmds:
-            logger.debug("Running: {}".format(args))
+        the commands run on the event loop of the running scheduler, or on a new
+        event loop if no scheduler is running, see Pipeline
 
-            if "env" not in kwargs:
-                kwargs["env"] = env
+        cmds -- list -- each item is a tuple (args, kwargs) for
+            asyncio.create_subprocess_exec
+        stdin -- iterable -- if given, the chunks of bytes are written to the stdin
+            of the first command
+        stdout -- callable -- if given, the output of the last command is passed
+            to this in chunks instead of being returned
+        return -- bytes -- the output of the last command
+        """
+        pipeline = Pipeline(cmds, stdin=stdin, stdout=stdout, env=self._get_env(), timeout=self.timeout)
+        loop = self.loop
+        if loop:
+            return asyncio.run_coroutine_threadsafe(self._run_pipeline(pipeline), loop).result()
+        return asyncio.run(self._run_pipeline(pipeline))
 
-            if pipes:
-                kwargs["stdin"] = pipes[-1].stdout
+    async def _run_pipeline(self, pipeline):
+        """run pipeline so it is stopped if another job fails"""
+        task = asyncio.current_task()
+        with self.procs_lock:
+            if self.cancelled.is_set():
+                raise IOError("Command {} was cancelled".format(pipeline.cmds[-1][0]))
+            self.tasks.add(task)
 
-            kwargs["stdout"] = subprocess.PIPE
+        try:
+            return await pipeline.run()
 
-            pipes.append(subprocess.Popen(args, **kwargs))
+        except asyncio.CancelledError:
+            raise IOError("Command {} was cancelled".format(pipeline.cmds[-1][0]))
 
-        for i, pipe in enumerate(pipes):
-            ret_code = pipe.wait()
-            if ret_code > 0:
-                raise IOError("Command {} exited with {}".format(cmds[i][0], ret_code))
+        finally:
+            with self.procs_lock:
+                self.tasks.discard(task)
 
     def _run_cmd(self, cmd, **kwargs):
 
         ignore_ret_code = kwargs.pop("ignore_ret_code", False)
 
         try:
-            self._run_cmds([(cmd, kwargs)])
+            return self._run_cmds([(cmd, kwargs)])
 
         except IOError as e:
             if ignore_ret_code:
@@ -196,9 +2582,30 @@ class Postgres(object):
             else:
                 raise
 
-    def _get_outfile_path(self, table):
-        """return the path for a file we can use to back up the table"""
+    def _query(self, query):
+        """run query using psql and return the rows
+
+        query -- string -- the SQL query
+        return -- list -- a tuple of string values for each row
+        """
+        separator = "\x1f"
+        cmd = self._get_args(
+            "psql",
+            "-X",
+            "--quiet",
+            "--no-align",
+            "--tuples-only",
+            "--set=ON_ERROR_STOP=1",
+            "--field-separator={}".format(separator),
+            *self._get_snapshot_commands(query)
+        )
+        output = self._run_cmd(cmd)
+        return [tuple(line.split(separator)) for line in output.decode("utf-8").splitlines() if line]
+
+    def _get_outfile_prefix(self, table):
+        """return the path, without any extension, that all the files used to back
+        up the table should start with"""
         self.outfile_count += 1
-        outfile = os.path.join(self.directory, '{:03d}_{}.sql.gz'.format(self.outfile_count, table))
+        outfile = os.path.join(self.directory, '{:03d}_{}'.format(self.outfile_count, table))
         return outfile
 
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+A long running psql session that many restore files can be loaded through
+
+psql reads the commands from its stdin, and each file is handed to it through
+a named pipe so it can be decompressed on the way in, every batch of commands
+ends with an \\echo of a marker so we know when psql has finished them and if
+the last command failed
+"""
+from __future__ import unicode_literals, division, print_function, absolute_import
+import os
+import errno
+import shutil
+import tempfile
+import threading
+import subprocess
+import logging
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+
+class Session(object):
+    """a psql process that stays connected between files
+
+    :Example:
+        session = Session(args, env)
+        session.begin()
+        session.run_file(chunks)
+        session.copy("foo", chunks)
+        session.commit()
+        session.close()
+    """
+    def __init__(self, args, env=None):
+        """
+        args -- list -- the psql command, without any of the output options
+        env -- dict -- the environment psql runs in
+        """
+        self.directory = tempfile.mkdtemp(prefix="dump-session-")
+        self.fifo = os.path.join(self.directory, "fifo")
+        os.mkfifo(self.fifo)
+        self.marker = "dump-session-{}".format(uuid.uuid4().hex)
+
+        args = list(args)
+        args[1:1] = ["-X", "--quiet", "--no-align", "--tuples-only"]
+        logger.debug("Running: {}".format(args))
+        self.pipe = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+
+    def send(self, *commands):
+        """write commands to psql, a command is a SQL statement or a psql meta
+        command"""
+        try:
+            for command in commands:
+                self.pipe.stdin.write("{}\n".format(command).encode("utf-8"))
+            self.pipe.stdin.flush()
+
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            # psql exited, wait() will say so
+
+    def wait(self):
+        """wait for psql to run everything that has been sent
+
+        return -- boolean -- True if the last command failed
+        """
+        self.send("\\echo {} :ERROR".format(self.marker))
+        for line in iter(self.pipe.stdout.readline, b""):
+            line = line.decode("utf-8", "replace").strip()
+            if line.startswith(self.marker):
+                return line.split()[-1] == "true"
+
+        raise IOError("psql session exited with {}".format(self.pipe.wait()))
+
+    def execute(self, query):
+        """run query, raising an error if it fails"""
+        self.send("{};".format(query))
+        if self.wait():
+            raise IOError("Query failed: {}".format(query))
+
+    def run_file(self, chunks):
+        """run all the commands in chunks like psql --file would, any command that
+        fails is rolled back on its own and the rest of the commands still run,
+        unless the file sets ON_ERROR_STOP to stop at the first command that fails
+
+        anything the file SETs, like pg_dump's empty search_path, is reset after
+        it has run
+
+        chunks -- iterable -- the bytes of the file
+        return -- boolean -- True if the last command that ran failed
+        """
+        self.send("\\set ON_ERROR_ROLLBACK on", "\\i '{}'".format(self.fifo))
+        failed = self.feed(chunks, self.wait)
+        self.send("\\set ON_ERROR_ROLLBACK off", "\\set ON_ERROR_STOP off", "RESET ALL;")
+        return failed
+
+    def copy(self, table, chunks, options=""):
+        """load the rows in chunks into table with COPY, this has to be in a
+        transaction
+
+        options -- string -- anything that goes after FROM, like WITH (FORMAT binary)
+        """
+        self.send("\\copy {} FROM '{}'{}".format(table, self.fifo, options))
+        failed = self.feed(chunks, self.wait)
+
+        # psql doesn't set ERROR if a row can't be loaded, but then the
+        # transaction is aborted so the next query fails
+        self.send("SELECT 1;")
+        if self.wait() or failed:
+            raise IOError("Could not copy rows into {}".format(table))
+
+    def feed(self, chunks, callback):
+        """write chunks into the named pipe on another thread while callback waits
+        for psql to read them
+
+        return -- mixed -- whatever callback returns
+        """
+        errors = []
+
+        def write():
+            try:
+                with open(self.fifo, "wb") as fp:
+                    for data in chunks:
+                        fp.write(data)
+
+            except IOError as e:
+                # psql stopped reading, its error will say why
+                if e.errno != errno.EPIPE:
+                    errors.append(e)
+
+            except BaseException as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=write)
+        thread.daemon = True
+        thread.start()
+        try:
+            ret = callback()
+
+        finally:
+            if thread.is_alive():
+                # psql never opened the pipe, opening it lets the writer go on
+                # to fail on its first write
+                fd = os.open(self.fifo, os.O_RDONLY | os.O_NONBLOCK)
+                os.close(fd)
+            thread.join()
+
+        if errors:
+            raise errors[0]
+        return ret
+
+    def begin(self):
+        """start a transaction with the default settings"""
+        self.send("RESET ALL;")
+        self.execute("BEGIN")
+
+    def commit(self):
+        self.execute("COMMIT")
+
+    def rollback(self):
+        self.execute("ROLLBACK")
+
+    def close(self):
+        try:
+            self.send("\\q")
+            self.pipe.stdin.close()
+
+        except IOError:
+            pass
+
+        if self.pipe.poll() is None:
+            self.pipe.wait()
+        self.pipe.stdout.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, division, print_function, absolute_import
+import os
+import json
+import threading
+from collections import OrderedDict
+
+
+class Manifest(object):
+    """the metadata of a backup directory, this is saved as json in the directory
+    next to the backup files
+
+    each table has a record, a dict of whatever needs to be remembered about that
+    table between runs
+    """
+    filename = "manifest.json"
+
+    version = 2
+
+    # the fields of each file that are added up for the whole table
+    totals = ("raw_bytes", "bytes", "rows", "elapsed")
+
+    @property
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, self.filename)
+        self.lock = threading.RLock()
+        self.tables = OrderedDict()
+        if self.exists:
+            self.load()
+
+    def load(self, fp=None):
+        """
+        fp -- file -- read the manifest from this instead of self.path, like
+            the manifest in an archive
+        """
+        if fp is None:
+            with open(self.path) as fp:
+                data = json.load(fp, object_pairs_hook=OrderedDict)
+
+        else:
+            data = json.loads(fp.read().decode("utf-8"), object_pairs_hook=OrderedDict)
+
+        self.tables = data.get("tables", OrderedDict())
+
+    def save(self):
+        """write the manifest, the file is replaced all at once so a reader never
+        sees a half written manifest"""
+        with self.lock:
+            data = OrderedDict([
+                ("version", self.version),
+                ("tables", self.tables),
+            ])
+            tmp_path = "{}.tmp".format(self.path)
+            with open(tmp_path, "w") as fp:
+                json.dump(data, fp, indent=2)
+            os.rename(tmp_path, self.path)
+
+    def get(self, table):
+        """return the record of table or None"""
+        with self.lock:
+            return self.tables.get(table)
+
+    def update(self, table, save=True, **fields):
+        """set fields on the record of table and save the manifest
+
+        save -- boolean -- False to only change the record in memory, this is
+            faster when a lot of tables are being dumped and save() is called
+            once they are all done
+        """
+        with self.lock:
+            self.tables.setdefault(table, OrderedDict()).update(fields)
+            if save:
+                self.save()
+            return self.tables[table]
+
+    def remove(self, table):
+        """forget everything about table"""
+        with self.lock:
+            self.tables.pop(table, None)
+
+    def add_file(self, table, **fields):
+        """add a backup file to the record of table, replacing any file with the
+        same name, and total the sizes, rows, and times of all the files of table
+
+        this doesn't save the manifest
+
+        **fields -- the name of the file and its raw_bytes, bytes, sha256, rows,
+            and elapsed seconds
+        """
+        with self.lock:
+            record = self.tables.setdefault(table, OrderedDict())
+            files = [f for f in record.get("files", []) if f["name"] != fields["name"]]
+            files.append(OrderedDict(sorted(fields.items())))
+            record["files"] = sorted(files, key=lambda f: f["name"])
+            for k in self.totals:
+                record[k] = sum(f.get(k) or 0 for f in files)
+            return record
+
+    def get_file(self, name):
+        """return the fields of the backup file name or None"""
+        with self.lock:
+            for record in self.tables.values():
+                for fields in record.get("files", []):
+                    if fields["name"] == name:
+                        return fields
+
+    def snapshots(self):
+        """return the snapshots the files were dumped from, a backup that was
+        resumed can have the files of more than one snapshot and then the tables
+        might not be consistent with each other"""
+        with self.lock:
+            ret = []
+            for record in self.tables.values():
+                for fields in record.get("files", []):
+                    snapshot = fields.get("snapshot")
+                    if snapshot and snapshot not in ret:
+                        ret.append(snapshot)
+            return ret
+
+    def files(self):
+        """return the names of all the backup files of all the tables"""
+        with self.lock:
+            return [f["name"] for record in self.tables.values() for f in record.get("files", [])]
+
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics of backups and restores
+
+while a backup or restore runs it sends events to any callback listening to its
+Metrics, every event is a dict with the name of the event and the time it was
+sent:
+
+    file -- a backup file was written or loaded, with its table, its bytes before
+        (raw_bytes) and after compression (bytes), its rows, how many seconds it
+        took, the rows and raw bytes per second, and the seconds spent in each
+        stage of moving it (stages)
+    job -- a job of the scheduler finished, with how many seconds it took
+    run -- a whole backup or restore finished, with whether it succeeded
+
+JsonLines writes the events as lines of json, and PrometheusTextfile keeps
+totals of them in a file for node_exporter's textfile collector
+"""
+from __future__ import unicode_literals, division, print_function, absolute_import
+import os
+import sys
+import json
+import time
+import threading
+from collections import OrderedDict
+
+
+class Metrics(object):
+    """sends events to all the callbacks listening for them"""
+    def __init__(self):
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def listen(self, callback):
+        """callback will be passed every event"""
+        self.callbacks.append(callback)
+
+    def emit(self, event, **fields):
+        """send an event to every callback, the callbacks are called one at a time
+        even if events are sent from many threads"""
+        if not self.callbacks:
+            return
+
+        data = OrderedDict([("event", event), ("time", round(time.time(), 3))])
+        data.update(fields)
+        with self.lock:
+            for callback in self.callbacks:
+                callback(data)
+
+    def file(self, operation, table, name, elapsed, raw_bytes, bytes, rows, stages, rest):
+        """send a file event
+
+        operation -- string -- backup or restore
+        stages -- dict -- the seconds spent in each stage that was timed
+        rest -- string -- the stage the seconds that weren't timed were spent in,
+            like waiting on the db
+        """
+        stages = OrderedDict((k, round(v, 3)) for k, v in stages.items())
+        stages[rest] = round(max(0.0, elapsed - sum(stages.values())), 3)
+        self.emit(
+            "file",
+            operation=operation,
+            table=table,
+            name=name,
+            raw_bytes=raw_bytes,
+            bytes=bytes,
+            rows=rows,
+            elapsed=round(elapsed, 3),
+            rows_per_second=round(rows / elapsed, 1) if rows is not None and elapsed else None,
+            bytes_per_second=round(raw_bytes / elapsed, 1) if raw_bytes is not None and elapsed else None,
+            stages=stages,
+        )
+
+
+def timed(chunks, stages, name):
+    """yield the chunks, adding the seconds it took to get each one to stages[name]"""
+    chunks = iter(chunks)
+    stages.setdefault(name, 0.0)
+    while True:
+        start = time.time()
+        try:
+            data = next(chunks)
+        except StopIteration:
+            break
+        finally:
+            stages[name] += time.time() - start
+        yield data
+
+
+class JsonLines(object):
+    """write every event as a line of json"""
+    def __init__(self, stream=None):
+        """
+        stream -- file -- where the lines go, defaults to stderr
+        """
+        self.stream = stream or sys.stderr
+
+    def __call__(self, event):
+        self.stream.write(json.dumps(event))
+        self.stream.write("\n")
+        self.stream.flush()
+
+
+class PrometheusTextfile(object):
+    """keep totals of the events in a file in the Prometheus text format
+
+    the file is written again after every job and run, all at once so the
+    collector never reads a half written file, the totals are by operation and
+    table so dump_bytes_total / dump_file_seconds_total is the throughput
+    of each table
+    """
+    counters = OrderedDict([
+        ("files", "the backup files written or loaded"),
+        ("raw_bytes", "the bytes of the files before compression"),
+        ("bytes", "the bytes of the files after compression"),
+        ("rows", "the rows in the files"),
+        ("file_seconds", "the seconds spent writing or loading the files"),
+    ])
+
+    def __init__(self, path, prefix="dump"):
+        self.path = path
+        self.prefix = prefix
+        self.totals = OrderedDict()
+        self.stages = OrderedDict()
+        self.runs = OrderedDict()
+
+    def __call__(self, event):
+        if event["event"] == "file":
+            key = (event["operation"], event["table"])
+            totals = self.totals.setdefault(key, OrderedDict((k, 0) for k in self.counters))
+            totals["files"] += 1
+            totals["raw_bytes"] += event["raw_bytes"] or 0
+            totals["bytes"] += event["bytes"] or 0
+            totals["rows"] += event["rows"] or 0
+            totals["file_seconds"] += event["elapsed"]
+            for stage, seconds in event["stages"].items():
+                self.stages[key + (stage,)] = self.stages.get(key + (stage,), 0.0) + seconds
+
+        elif event["event"] == "run":
+            self.runs[event["operation"]] = event
+            self.save()
+
+        elif event["event"] == "job":
+            self.save()
+
+    def save(self):
+        lines = []
+        for name, help_text in self.counters.items():
+            metric = "{}_{}_total".format(self.prefix, name)
+            lines.append("# HELP {} {}".format(metric, help_text))
+            lines.append("# TYPE {} counter".format(metric))
+            for (operation, table), totals in self.totals.items():
+                lines.append('{}{{operation="{}",table="{}"}} {}'.format(
+                    metric,
+                    operation,
+                    table,
+                    round(totals[name], 3),
+                ))
+
+        metric = "{}_stage_seconds_total".format(self.prefix)
+        lines.append("# HELP {} the seconds spent in each stage of writing or loading the files".format(metric))
+        lines.append("# TYPE {} counter".format(metric))
+        for (operation, table, stage), seconds in self.stages.items():
+            lines.append('{}{{operation="{}",table="{}",stage="{}"}} {}'.format(
+                metric,
+                operation,
+                table,
+                stage,
+                round(seconds, 3),
+            ))
+
+        for name, help_text, field in [
+            ("last_run_seconds", "how long the last run took", "elapsed"),
+            ("last_run_success", "1 if the last run succeeded", "success"),
+            ("last_run_timestamp_seconds", "when the last run finished", "time"),
+        ]:
+            metric = "{}_{}".format(self.prefix, name)
+            lines.append("# HELP {} {}".format(metric, help_text))
+            lines.append("# TYPE {} gauge".format(metric))
+            for operation, event in self.runs.items():
+                value = int(event[field]) if field == "success" else event[field]
+                lines.append('{}{{operation="{}"}} {}'.format(metric, operation, value))
+
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "w") as fp:
+            fp.write("\n".join(lines))
+            fp.write("\n")
+        os.rename(tmp_path, self.path)
+
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Run chains of commands with asyncio
+
+every command of a pipeline is started with asyncio.create_subprocess_exec and
+the output of each command is copied into the next command by the event loop,
+so one thread can run any number of pipelines at the same time. Nothing is read
+from a command until the last chunk has been written to the next command (or
+handled by the stdout callback), so a slow consumer slows the producer down
+instead of piling up data in memory
+"""
+from __future__ import unicode_literals, division, print_function, absolute_import
+import asyncio
+import logging
+import subprocess
+
+from .compression import CHUNK_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+
+class Pipeline(object):
+    """a chain of commands, the output of each command is piped into the next
+
+    :Example:
+        pipeline = Pipeline([(["pg_dump", "foo"], {}), (["wc", "-l"], {})])
+        output = asyncio.run(pipeline.run())
+    """
+    def __init__(self, cmds, stdin=None, stdout=None, env=None, timeout=None, executor=None):
+        """
+        cmds -- list -- each item is a tuple (args, kwargs), kwargs can have env,
+            stdout (only DEVNULL makes sense) and stderr
+        stdin -- iterable -- if given, the chunks of bytes are written to the stdin
+            of the first command, the iterable is read on executor since it can
+            be slow (like decompressing a file)
+        stdout -- callable -- if given, the output of the last command is passed
+            to this in chunks on executor instead of being returned
+        env -- dict -- the environment of every command that doesn't have its own
+        timeout -- float -- the commands are stopped if they haven't finished in
+            this many seconds
+        executor -- concurrent.futures.Executor -- where stdin and stdout run,
+            defaults to the event loop's default executor
+        """
+        self.cmds = cmds
+        self.stdin = stdin
+        self.stdout = stdout
+        self.env = env
+        self.timeout = timeout
+        self.executor = executor
+        self.procs = []
+
+    async def run(self):
+        """run all the commands
+
+        return -- bytes -- the output of the last command, None if there is a
+            stdout callback
+        """
+        try:
+            if self.timeout:
+                try:
+                    return await asyncio.wait_for(self._run(), self.timeout)
+
+                except asyncio.TimeoutError:
+                    raise IOError("Command {} timed out after {}s".format(self.cmds[-1][0], self.timeout))
+
+            else:
+                return await self._run()
+
+        finally:
+            await self.stop()
+
+    async def stop(self):
+        """stop any command that is still running"""
+        for proc in self.procs:
+            if proc.returncode is None:
+                try:
+                    proc.terminate()
+                except ProcessLookupError:
+                    pass
+                await proc.wait()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        for i, (args, kwargs) in enumerate(self.cmds):
+            logger.debug("Running: {}".format(args))
+            kwargs = dict(kwargs)
+            kwargs.setdefault("env", self.env)
+            kwargs.setdefault("stdout", subprocess.PIPE)
+            if i > 0 or self.stdin is not None:
+                kwargs["stdin"] = subprocess.PIPE
+            self.procs.append(await asyncio.create_subprocess_exec(*args, **kwargs))
+
+        tasks = []
+        if self.stdin is not None:
+            tasks.append(self._feed(loop, iter(self.stdin), self.procs[0].stdin))
+
+        for proc, next_proc in zip(self.procs, self.procs[1:]):
+            tasks.append(self._pipe(proc.stdout, next_proc.stdin))
+
+        output = []
+        if self.procs[-1].stdout:
+            tasks.append(self._read(loop, self.procs[-1].stdout, output))
+
+        await asyncio.gather(*tasks)
+
+        for i, proc in enumerate(self.procs):
+            ret_code = await proc.wait()
+            if ret_code != 0:
+                raise IOError("Command {} exited with {}".format(self.cmds[i][0], ret_code))
+
+        return None if self.stdout else b"".join(output)
+
+    async def _feed(self, loop, chunks, writer):
+        """write chunks into writer, waiting for the command to read each chunk"""
+        try:
+            while True:
+                data = await loop.run_in_executor(self.executor, next, chunks, None)
+                if data is None:
+                    break
+                writer.write(data)
+                await writer.drain()
+
+        except (BrokenPipeError, ConnectionResetError):
+            # the command exited before reading everything, its return code
+            # will say why
+            pass
+
+        finally:
+            writer.close()
+
+    async def _pipe(self, reader, writer):
+        """copy the output of one command into the next one"""
+        try:
+            while True:
+                data = await reader.read(CHUNK_SIZE)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+        finally:
+            writer.close()
+
+    async def _read(self, loop, reader, output):
+        while True:
+            data = await reader.read(CHUNK_SIZE)
+            if not data:
+                break
+
+            if self.stdout:
+                await loop.run_in_executor(self.executor, self.stdout, data)
+            else:
+                output.append(data)
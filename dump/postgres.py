@@ -2,10 +2,11 @@
 Backup only the most important parts of a Postgres db 
 
 example --
-    # backup only guys named foo in the user table:
-    import postgres
-    pg = postgres.Dump(db, user, passwd, host, port)
-    pg.select_dump('user', "SELECT * FROM user WHERE username='foo'")
+    # backup only guys named foo in the user table, this is select_dump() of
+    # dump.interface.postgres.Postgres, this module doesn't have it:
+    from dump.interface.postgres import Postgres
+    pg = Postgres(dbname=db, username=user, password=passwd, host=host, port=port, directory=path)
+    pg.select_dump('user', "SELECT * FROM \"user\" WHERE username='foo'")
 
 tuning for restoring the db:
 http://stackoverflow.com/questions/2094963/postgresql-improving-pg-dump-pg-restore-performance
@@ -85,8 +86,6 @@ class Postgres(object):
                 psql_args = self._get_args('psql', '-X', '--quiet', '-f {}'.format(path))
                 self._run_cmd(' '.join(psql_args))
 
-                # restore the sequence
-                #self._restore_auto_increment(table)
                 print('------- restored table {}'.format(table))
 
         return True
@@ -199,56 +198,4 @@ class Postgres(object):
         psql_args = self._get_args('psql', '-X', '-f {}'.format(f.name))
         return self._run_cmd(' '.join(psql_args), *args, **kwargs)
 
-    def _restore_auto_increment(self, table):
-        """restore the auto increment value for the table to what it was previously"""
-        query, seq_table, seq_column, seq_name = self._get_auto_increment_info(table)
-        if query:
-            queries = [query, "select nextval('{}')".format(seq_name)]
-            return self._run_queries(queries)
-
-    def _get_auto_increment_info(self, table):
-        """figure out the the autoincrement value for the given table"""
-        query = ''
-        seq_table = ''
-        seq_column = ''
-        seq_name = ''
-        find_query = "\n".join([
-            "SELECT",
-            "  t.relname as related_table,",
-            "  a.attname as related_column,",
-            "  s.relname as sequence_name",
-            "FROM pg_class s",
-            "JOIN pg_depend d ON d.objid = s.oid",
-            "JOIN pg_class t ON d.objid = s.oid AND d.refobjid = t.oid",
-            "JOIN pg_attribute a ON (d.refobjid, d.refobjsubid) = (a.attrelid, a.attnum)",
-            "JOIN pg_namespace n ON n.oid = s.relnamespace",
-            "WHERE",
-            "  s.relkind = 'S'",
-            "AND",
-            "  n.nspname = 'public'",
-            "AND",
-            "  t.relname = '{}'".format(table)
-        ])
-
-        pipe = self._run_queries([find_query], popen_kwargs={'stdout': subprocess.PIPE})
-        stdout, stderr = pipe.communicate()
-        if stdout:
-            try:
-                m = re.findall('^\s*(\S+)\s*\|\s*(\S+)\s*\|\s*(\S+)\s*$', stdout, flags=re.MULTILINE)
-                seq_table, seq_column, seq_name = m[1]
-                # http://www.postgresql.org/docs/9.2/static/functions-sequence.html
-                # http://www.postgresql.org/docs/9.2/static/functions-conditional.html
-                query = "\n".join([
-                    "SELECT",
-                    "  setval('{}',".format(seq_name.strip()),
-                    "  coalesce(max({}), 1),".format(seq_column.strip()),
-                    "  max({}) IS NOT null)".format(seq_column.strip()),
-                    "FROM \"{}\"".format(seq_table.strip())
-                ])
-
-            except IndexError:
-                query = ''
-
-        return query, seq_table, seq_column, seq_name
-
 
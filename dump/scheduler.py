@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, division, print_function, absolute_import
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+
+
+# how much cost a job is taken to get through a second until the finished jobs
+# say otherwise, the costs are usually bytes so this is a modest 50MB/s
+RATE = 50 * 1024 * 1024
+
+
+class Job(object):
+    """a unit of work the scheduler will run, this keeps track of what the job
+    depends on and how long it took to run"""
+    @property
+    def elapsed(self):
+        """how many seconds the job ran for, None if it hasn't finished"""
+        if self.start is None or self.stop is None:
+            return None
+        return self.stop - self.start
+
+    def __init__(self, name, callback, *args, **kwargs):
+        self.name = name
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.depends = set()
+        self.cost = 0
+        self.skipped = False
+        self.start = None
+        self.stop = None
+
+    def __call__(self):
+        self.start = time.time()
+        try:
+            return self.callback(*self.args, **self.kwargs)
+        finally:
+            self.stop = time.time()
+
+    async def run_async(self):
+        """run a job whose callback is a coroutine function"""
+        self.start = time.time()
+        try:
+            return await self.callback(*self.args, **self.kwargs)
+        finally:
+            self.stop = time.time()
+
+
+class Scheduler(object):
+    """run jobs on a bounded pool of threads
+
+    a job won't start until all the jobs it depends on have finished, so
+    independent jobs run at the same time while dependent jobs wait for their
+    parents. Of the jobs that are ready the one with the most work ahead of it
+    (its cost plus the costs of the longest chain of jobs waiting on it) is
+    started first, so the biggest tables aren't left for last, jobs that cost
+    the same are started in the order they were added
+
+    if any job fails the jobs that haven't started are never run and the error
+    is raised from run()
+
+    the jobs are orchestrated by an asyncio event loop, a job whose callback is
+    a coroutine function runs on the loop and any other job runs on a thread
+    """
+    def __init__(self, jobs=1, rate=RATE):
+        """
+        jobs -- integer -- how many jobs can run at the same time
+        rate -- float -- how much cost a job gets through a second, this is used
+            to predict when the jobs will finish before any of them have, after
+            that the rate of the finished jobs is used, None to only predict
+            once some jobs have finished
+        """
+        self.jobs = max(1, jobs)
+        self.rate = rate
+        self.queue = OrderedDict()
+
+    def add(self, name, callback, *args, **kwargs):
+        """add a job, name has to be unique"""
+        if name in self.queue:
+            raise ValueError("Job {} already exists".format(name))
+        job = Job(name, callback, *args, **kwargs)
+        self.queue[name] = job
+        return job
+
+    def depend(self, name, *parents):
+        """name won't be started until all parents have finished, any parent
+        that isn't a job in this scheduler is ignored"""
+        job = self.queue[name]
+        for parent in parents:
+            if parent in self.queue and parent != name:
+                job.depends.add(parent)
+
+    def skip(self, name):
+        """name was already done by an earlier run, it won't be run again but the
+        jobs that depend on it will be"""
+        self.queue[name].skipped = True
+
+    def weigh(self, name, cost):
+        """set how much work the job name is, like the bytes it has to dump"""
+        self.queue[name].cost = max(0, cost or 0)
+
+    def priorities(self):
+        """return how much work is ahead of each job, this is its cost plus the
+        cost of the most expensive chain of jobs that depend on it
+
+        return -- dict -- the keys are job names, the values are the priorities
+        """
+        children = dict((name, []) for name in self.queue)
+        for job in self.queue.values():
+            for name in job.depends:
+                children[name].append(job.name)
+
+        ret = {}
+
+        def priority(name, seen):
+            if name not in ret:
+                seen = seen | set([name])
+                ret[name] = self.queue[name].cost + max(
+                    [priority(child, seen) for child in children[name] if child not in seen] or [0]
+                )
+            return ret[name]
+
+        for name in self.queue:
+            priority(name, set())
+        return ret
+
+    def predict(self, rate, running=(), done=(), now=None, overhead=0.0):
+        """predict how many seconds it will take to run all the jobs that aren't
+        done, by going through them like run() would with each job taking its
+        cost divided by rate seconds
+
+        rate -- float -- how much cost a job gets through a second
+        running -- list -- the jobs that are running now
+        done -- set -- the names of the jobs that have finished
+        overhead -- float -- the seconds every job with a cost takes no matter
+            how small it is, like starting a command and connecting to the db
+        return -- float -- the seconds until all the jobs should be done
+        """
+        now = time.time() if now is None else now
+        priorities = self.priorities()
+
+        def seconds(job):
+            return overhead + job.cost / rate if job.cost else 0.0
+
+        workers = []
+        finish = {}
+        for job in running:
+            finish[job.name] = max(0.0, seconds(job) - (now - job.start))
+            workers.append(finish[job.name])
+        workers.extend([0.0] * (self.jobs - len(workers)))
+
+        pending = [job for job in self.queue.values() if job.name not in done and job.name not in finish]
+        pending.sort(key=lambda job: -priorities[job.name])
+        while pending:
+            for job in pending:
+                if all(name in done or name in finish for name in job.depends):
+                    break
+            else:
+                job = pending[0]
+
+            pending.remove(job)
+            workers.sort()
+            start = max([workers[0]] + [finish.get(name, 0.0) for name in job.depends])
+            finish[job.name] = start + seconds(job)
+            workers[0] = finish[job.name]
+
+        return max(list(finish.values()) or [0.0])
+
+    def measure(self):
+        """return how fast the finished jobs went
+
+        the quickest job is taken to be all overhead, and the rate only comes from
+        the jobs that took a lot longer than that, since the rate of a job that
+        was mostly overhead says nothing about how long a big job will take. If
+        the jobs all took about as long as each other there is no telling what
+        the overhead is, so the rate comes from all of them
+
+        return -- tuple -- (rate, overhead), rate is None if no job has finished
+        """
+        jobs = [job for job in self.queue.values() if job.cost and job.elapsed is not None]
+        overhead = min([job.elapsed for job in jobs] or [0.0])
+        cost = 0
+        elapsed = 0.0
+        for job in jobs:
+            if job.elapsed > overhead * 2:
+                cost += job.cost
+                elapsed += job.elapsed - overhead
+
+        if not elapsed:
+            cost = sum(job.cost for job in jobs)
+            elapsed = sum(job.elapsed for job in jobs)
+            overhead = 0.0
+        return (cost / elapsed if elapsed else None), overhead
+
+    def run(self, on_error=None, on_done=None):
+        """run all the jobs on a new event loop
+
+        on_error -- callable -- called if a job fails, before the error is raised,
+            this is where running work should be stopped
+        on_done -- callable -- called with each job and what it returned once it
+            has finished
+        """
+        return asyncio.run(self.run_async(on_error, on_done))
+
+    async def run_async(self, on_error=None, on_done=None):
+        """run all the jobs on the running event loop, see run()"""
+        loop = asyncio.get_running_loop()
+        priorities = self.priorities()
+        pending = sorted(self.queue.values(), key=lambda job: -priorities[job.name])
+        done = set(job.name for job in pending if job.skipped)
+        pending = [job for job in pending if not job.skipped]
+        running = {}
+
+        def log_prediction():
+            rate, overhead = self.measure()
+            rate = rate or self.rate
+            if rate and (pending or running):
+                seconds = self.predict(rate, running.values(), done, overhead=overhead)
+                logger.info("------- predicted to finish in {:.1f}s at {}".format(
+                    seconds,
+                    time.strftime("%H:%M:%S", time.localtime(time.time() + seconds)),
+                ))
+
+        def start(job):
+            if asyncio.iscoroutinefunction(job.callback):
+                future = asyncio.ensure_future(job.run_async())
+            else:
+                future = loop.run_in_executor(executor, job)
+            running[future] = job
+
+        executor = ThreadPoolExecutor(max_workers=self.jobs)
+        logger.info("------- running {} jobs {} at a time".format(len(pending), self.jobs))
+        log_prediction()
+        try:
+            while pending or running:
+                for job in list(pending):
+                    if len(running) >= self.jobs:
+                        break
+
+                    if job.depends <= done:
+                        pending.remove(job)
+                        start(job)
+
+                if not running:
+                    # everything left is waiting on something else that's
+                    # left so there is a cycle, just go in order
+                    job = pending.pop(0)
+                    logger.warning("Dependency cycle found, running {} anyway".format(job.name))
+                    start(job)
+
+                finished, _ = await asyncio.wait(list(running.keys()), return_when=asyncio.FIRST_COMPLETED)
+                for future in finished:
+                    job = running.pop(future)
+                    ret = future.result()
+                    done.add(job.name)
+                    if on_done:
+                        on_done(job, ret)
+                    if job.cost:
+                        log_prediction()
+
+        except BaseException:
+            if on_error:
+                on_error()
+
+            # a job on a thread can't be cancelled, on_error should have stopped
+            # what it was doing so wait for it to notice
+            for future in running:
+                if not isinstance(future, asyncio.Task):
+                    continue
+                future.cancel()
+            if running:
+                await asyncio.wait(list(running.keys()))
+            raise
+
+        finally:
+            # the threads are waited for on another thread so the loop can keep
+            # running anything they are waiting on
+            executor.shutdown(wait=False)
+            await loop.run_in_executor(None, executor.shutdown)
+
+    def critical_path(self):
+        """return the chain of finished jobs, parents first, that took the longest
+        time to run from start to finish, this is the lower bound on how long
+        running these jobs can take no matter how many threads are used"""
+        paths = {}
+
+        def path(job, seen):
+            if job.name not in paths:
+                best = []
+                seen = seen | set([job.name])
+                for name in job.depends:
+                    if name not in seen:
+                        p = path(self.queue[name], seen)
+                        if self.elapsed(p) > self.elapsed(best):
+                            best = p
+                paths[job.name] = best + [job]
+            return paths[job.name]
+
+        ret = []
+        for job in self.queue.values():
+            if job.elapsed is not None:
+                p = path(job, set())
+                if self.elapsed(p) > self.elapsed(ret):
+                    ret = p
+        return ret
+
+    def elapsed(self, jobs):
+        """return the total seconds of all the given jobs"""
+        return sum(job.elapsed or 0.0 for job in jobs)
+
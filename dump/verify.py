@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Check a backup without a database
+
+every backup file is read and decompressed on a pool of processes, the
+compressed bytes are hashed on the way in and the decompressed bytes are only
+counted, so nothing is ever written to disk. A file passes if it is the size
+and sha256 the manifest says, it decompresses all the way to the end (so the
+codec's own checks like gzip's CRC pass), and it has the raw bytes and rows
+the manifest says
+"""
+from __future__ import unicode_literals, division, print_function, absolute_import
+import io
+import os
+import json
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from .compression import CHUNK_SIZE, find_codec
+from .manifest import Manifest
+from .archive import Archive
+from .chunkstore import ChunkStore, EXTENSION
+from .counters import ScriptRowCounter, CopyRowCounter, BinaryRowCounter
+
+
+logger = logging.getLogger(__name__)
+
+
+class HashReader(object):
+    """a file object that hashes and counts everything read from it"""
+    def __init__(self, fp):
+        self.fp = fp
+        self.hash = hashlib.sha256()
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.fp.read(size)
+        self.hash.update(data)
+        self.bytes += len(data)
+        return data
+
+
+def verify_file(fields, directory=None, archive=None, store=None):
+    """check one backup file, this runs in its own process
+
+    fields -- dict -- the manifest fields of the file, only name is needed
+    directory -- string -- the backup directory the file is in
+    archive -- string -- the path of the archive the file is in instead
+    store -- string -- the chunk store, if the file is a recipe
+    return -- dict -- the name, rows, raw_bytes, bytes and elapsed seconds of
+        the file, and what was wrong with it in error
+    """
+    start = time.time()
+    name = fields["name"]
+    ret = OrderedDict([("name", name), ("error", None)])
+    a = None
+    try:
+        if archive:
+            a = Archive(archive)
+            fp = a.open_raw(name)
+
+        else:
+            fp = open(os.path.join(directory, name), "rb")
+
+        with fp:
+            reader = HashReader(fp)
+            if name.endswith(EXTENSION):
+                if not store:
+                    raise ValueError("the file is a recipe of a chunk store, the store is needed to check it")
+                codec, path = find_codec(name[:-len(EXTENSION)])
+                codec = ChunkStore(store).codec(codec)
+                # a recipe is small and it is read by lines
+                chunks = codec.decompress_chunks(io.BytesIO(reader.read()))
+
+            else:
+                codec, path = find_codec(name)
+                chunks = codec.decompress_chunks(reader, CHUNK_SIZE)
+
+            if path.endswith(".sql"):
+                counter = ScriptRowCounter()
+            elif path.endswith(".pgcopy"):
+                counter = BinaryRowCounter()
+            else:
+                counter = CopyRowCounter()
+
+            raw_bytes = 0
+            for data in chunks:
+                raw_bytes += len(data)
+                counter.write(data)
+
+            # anything after the end of the last stream isn't part of the file
+            reader.read()
+
+        ret["rows"] = counter.rows
+        ret["raw_bytes"] = raw_bytes
+        ret["bytes"] = reader.bytes
+        errors = []
+        for k, value in [
+            ("bytes", reader.bytes),
+            ("sha256", reader.hash.hexdigest()),
+            ("raw_bytes", raw_bytes),
+            ("rows", counter.rows),
+        ]:
+            if fields.get(k) is not None and fields[k] != value:
+                errors.append("{} is {} instead of {}".format(k, value, fields[k]))
+        if errors:
+            ret["error"] = ", ".join(errors)
+
+    except Exception as e:
+        ret["error"] = "{}: {}".format(e.__class__.__name__, e)
+
+    finally:
+        if a:
+            a.close()
+
+    ret["elapsed"] = round(time.time() - start, 3)
+    return ret
+
+
+class Verifier(object):
+    """check every file of a backup directory or archive
+
+    :Example:
+        results = Verifier("/some/backup").run(jobs=4)
+        failed = [r for r in results if r["error"]]
+    """
+    def __init__(self, directory=None, archive=None, store=None):
+        """
+        directory -- string -- the backup directory
+        archive -- string -- the archive to check instead of a directory
+        store -- string -- the chunk store of the backup, if it used one
+        """
+        if not directory and not archive:
+            raise ValueError("A backup directory or archive is needed")
+
+        self.directory = directory
+        self.archive = archive
+        self.store = store
+
+    def get_files(self):
+        """return the manifest fields of every file of the backup, a file that
+        isn't in the manifest only has its name"""
+        if self.archive:
+            a = Archive(self.archive)
+            try:
+                tables = OrderedDict()
+                if Manifest.filename in a:
+                    with a.open_raw(Manifest.filename) as fp:
+                        tables = json.loads(fp.read().decode("utf-8"), object_pairs_hook=OrderedDict)["tables"]
+                names = [name for name in a.names() if name != Manifest.filename]
+
+            finally:
+                a.close()
+
+        else:
+            tables = Manifest(self.directory).tables
+            names = [
+                name for name in sorted(os.listdir(self.directory))
+                if name[:1].isdigit() and os.path.isfile(os.path.join(self.directory, name))
+            ]
+
+        files = OrderedDict()
+        for table, record in tables.items():
+            for fields in record.get("files", []):
+                files[fields["name"]] = OrderedDict(fields, table=table)
+
+        if not files:
+            # a directory backed up before there was a manifest
+            for name in names:
+                files[name] = OrderedDict([("name", name), ("table", None)])
+        return list(files.values())
+
+    def run(self, jobs=None):
+        """check all the files, jobs of them at a time
+
+        jobs -- integer -- how many processes check files, defaults to the
+            number of cores
+        return -- list -- the result of each file, see verify_file()
+        """
+        files = self.get_files()
+        jobs = jobs or os.cpu_count() or 1
+
+        snapshots = set(fields["snapshot"] for fields in files if fields.get("snapshot"))
+        if len(snapshots) > 1:
+            logger.warning(
+                "------- the backup was resumed, its files are from {} snapshots so its tables might not be"
+                " consistent with each other".format(len(snapshots))
+            )
+        logger.info("------- verifying {} files {} at a time".format(len(files), jobs))
+
+        # the biggest files go first so they don't hold up the end
+        files.sort(key=lambda fields: -(fields.get("bytes") or 0))
+        results = []
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = [
+                executor.submit(verify_file, dict(fields), self.directory, self.archive, self.store)
+                for fields in files
+            ]
+            for fields, future in zip(files, futures):
+                ret = future.result()
+                ret["table"] = fields["table"]
+                if ret["error"]:
+                    logger.error("------- {} FAILED: {}".format(ret["name"], ret["error"]))
+
+                else:
+                    logger.info("------- {} ok, {} rows in {:.2f}s".format(ret["name"], ret["rows"], ret["elapsed"]))
+
+                results.append(ret)
+
+        return sorted(results, key=lambda ret: ret["name"])
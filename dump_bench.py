@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+benchmark dump
+
+this builds tables of synthetic rows, then backs them up and restores them with
+every combination of the given drivers, data formats, codecs, compression levels
+and job counts. It needs the same DUMP_DSN environment variable the tests use,
+to run on the command line:
+
+    python dump_bench.py [--rows=N] [--width=N] [--toast-width=N] [--tables=N]
+
+the results are printed as a table and saved as json, pass the json of an
+earlier run with --compare to see how much faster or slower each combination
+got, see --help for everything else
+"""
+from __future__ import unicode_literals, division, print_function, absolute_import
+import argparse
+import itertools
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import dsnparse
+import psycopg2
+
+from dump import __version__
+from dump.compression import CODECS, zstandard
+from dump.interface.postgres import Postgres, DATA_FORMATS, DRIVERS
+
+
+# the fields of a result that say what was run, results of different runs with
+# the same key are compared
+KEY = ("driver", "data_format", "compression", "level", "jobs")
+
+
+class Benchmark(object):
+    table_prefix = "dump_bench"
+
+    def __init__(self, dsn):
+        self.dsn = dsnparse.parse(dsn)
+        self.conn = psycopg2.connect(
+            dbname=self.dsn.dbname,
+            user=self.dsn.username,
+            password=self.dsn.password,
+            host=self.dsn.hostname,
+            port=self.dsn.port,
+        )
+        self.conn.autocommit = True
+        self.tables = []
+
+    def query(self, query_str):
+        cur = self.conn.cursor()
+        cur.execute(query_str)
+        if cur.description:
+            return cur.fetchall()
+
+    def install(self, rows, width=32, toast_width=0, tables=1):
+        """create the tables and fill them with rows
+
+        rows -- integer -- how many rows each table has
+        width -- integer -- about how many characters the body column of each row
+            has, this makes the rows wider without making them bigger on disk
+        toast_width -- integer -- if more than 0, each row gets a doc column of
+            this many random characters, past about 2000 they are moved into the
+            table's TOAST table and they barely compress
+        tables -- integer -- how many tables to create, more tables give the jobs
+            something to do at the same time
+        """
+        self.tables = []
+        for i in range(1, tables + 1):
+            table_name = "{}_{}".format(self.table_prefix, i)
+            self.query('DROP TABLE IF EXISTS "{}" CASCADE'.format(table_name))
+            self.query("\n".join([
+                'CREATE TABLE "{}" ('.format(table_name),
+                "  _id BIGSERIAL PRIMARY KEY,",
+                "  num INTEGER,",
+                "  amount NUMERIC(12, 2),",
+                "  body TEXT,",
+                "  doc TEXT,",
+                "  created TIMESTAMP",
+                ")",
+            ]))
+            self.query("\n".join([
+                'INSERT INTO "{}" (num, amount, body, doc, created)'.format(table_name),
+                "SELECT",
+                "  g,",
+                "  random() * 100000,",
+                "  repeat(md5(g::text), {}),".format(max(1, width // 32)),
+                "  {},".format(self.random_text(toast_width) if toast_width > 0 else "NULL"),
+                "  now() - (g || ' seconds')::interval",
+                "FROM generate_series(1, {}) g".format(rows),
+            ]))
+            self.query('VACUUM ANALYZE "{}"'.format(table_name))
+            self.tables.append(table_name)
+
+    def random_text(self, width):
+        """return the SQL of a random string of width characters, it uses g so it
+        is different for every row"""
+        return "(SELECT string_agg(md5(random()::text), '') FROM generate_series(g, g + {}))".format(
+            max(1, width // 32) - 1
+        )
+
+    def count(self):
+        return sum(self.query('SELECT COUNT(*) FROM "{}"'.format(t))[0][0] for t in self.tables)
+
+    def get_interface(self, directory, **kwargs):
+        return Postgres(
+            dbname=self.dsn.dbname,
+            username=self.dsn.username,
+            password=self.dsn.password,
+            host=self.dsn.hostname,
+            port=self.dsn.port,
+            directory=directory,
+            **kwargs
+        )
+
+    def run(self, rows, jobs=1, **kwargs):
+        """backup and restore the tables
+
+        return -- dict -- the bytes of the backup and how long it took to backup
+            and restore
+        """
+        directory = tempfile.mkdtemp(prefix="dump-bench-")
+        try:
+            db = self.get_interface(directory, **kwargs)
+
+            start = time.time()
+            db.tables_dump(self.tables, jobs=jobs)
+            backup_elapsed = time.time() - start
+            records = db.manifest.tables.values()
+            size = sum(record["bytes"] for record in records)
+            raw_size = sum(record["raw_bytes"] for record in records)
+
+            # the dump scripts drop and recreate the tables
+            for table_name in self.tables:
+                self.query('DELETE FROM "{}"'.format(table_name))
+            start = time.time()
+            db.restore(jobs=jobs)
+            restore_elapsed = time.time() - start
+
+            if self.count() != rows * len(self.tables):
+                raise ValueError("Restored {} rows instead of {}".format(self.count(), rows * len(self.tables)))
+
+        finally:
+            shutil.rmtree(directory)
+
+        return OrderedDict([
+            ("bytes", size),
+            ("raw_bytes", raw_size),
+            ("backup", round(backup_elapsed, 3)),
+            ("restore", round(restore_elapsed, 3)),
+            ("backup_rows_per_second", round(rows * len(self.tables) / backup_elapsed, 1)),
+            ("restore_rows_per_second", round(rows * len(self.tables) / restore_elapsed, 1)),
+        ])
+
+
+def split(value, cast=str):
+    """return the comma separated values of a command line option"""
+    return [cast(v) if v != "default" else None for v in value.split(",") if v]
+
+
+def load_results(path):
+    """return the results of an earlier run keyed by what was run"""
+    with open(path) as fp:
+        data = json.load(fp)
+    return dict((tuple(result[k] for k in KEY), result) for result in data["results"])
+
+
+def ratio(result, baseline, field):
+    """return how field of result compares to the baseline, like 0.50x for twice
+    as fast"""
+    if not baseline or not baseline.get(field):
+        return "-"
+    return "{:.2f}x".format(result[field] / baseline[field])
+
+
+def main():
+    codecs = ["gzip", "zstd", "none"] if zstandard else ["gzip", "none"]
+    parser = argparse.ArgumentParser(description="benchmark dump backups and restores")
+    parser.add_argument("--rows", type=int, default=100000, help="how many rows each table should have")
+    parser.add_argument("--width", type=int, default=32, help="about how many characters of text each row has")
+    parser.add_argument(
+        "--toast-width",
+        type=int,
+        default=0,
+        help="add this many random characters to each row, past about 2000 they are stored in TOAST"
+    )
+    parser.add_argument("--tables", type=int, default=4, help="how many tables to backup and restore")
+    parser.add_argument("--drivers", default="psql", help="comma separated, any of {}".format(", ".join(DRIVERS)))
+    parser.add_argument(
+        "--data-formats",
+        default=",".join(DATA_FORMATS),
+        help="comma separated, any of {}".format(", ".join(DATA_FORMATS))
+    )
+    parser.add_argument(
+        "--codecs",
+        default=",".join(codecs),
+        help="comma separated, any of {}".format(", ".join(sorted(CODECS.keys())))
+    )
+    parser.add_argument(
+        "--levels",
+        default="default",
+        help="comma separated compression levels, default is each codec's own default"
+    )
+    parser.add_argument("--jobs", default="1,4", help="comma separated job counts")
+    parser.add_argument("--output", default="dump_bench.json", help="where to save the results as json")
+    parser.add_argument("--compare", default=None, help="the json results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="[%(levelname).1s] %(message)s", level=logging.WARNING, stream=sys.stderr)
+
+    baselines = load_results(args.compare) if args.compare else {}
+
+    bench = Benchmark(os.environ["DUMP_DSN"])
+    bench.install(args.rows, width=args.width, toast_width=args.toast_width, tables=args.tables)
+
+    header = "{:<8} {:<8} {:<6} {:>5} {:>4} {:>12} {:>9} {:>9}".format(
+        "driver", "format", "codec", "level", "jobs", "bytes", "backup", "restore"
+    )
+    if baselines:
+        header += " {:>8} {:>8}".format("vs bak", "vs res")
+    print(header)
+
+    runs = []
+    for driver, data_format, compression in itertools.product(
+        split(args.drivers),
+        split(args.data_formats),
+        split(args.codecs),
+    ):
+        default_level = CODECS[compression].default_level
+        # a codec without levels is only run once
+        levels = split(args.levels, int) if default_level is not None else [None]
+        for level, jobs in itertools.product(levels, split(args.jobs, int)):
+            level = default_level if level is None else level
+            if (driver, data_format, compression, level, jobs) not in runs:
+                runs.append((driver, data_format, compression, level, jobs))
+
+    results = []
+    for driver, data_format, compression, level, jobs in runs:
+        result = OrderedDict([
+            ("driver", driver),
+            ("data_format", data_format),
+            ("compression", compression),
+            ("level", level),
+            ("jobs", jobs),
+        ])
+        result.update(bench.run(
+            args.rows,
+            jobs=jobs,
+            driver=driver,
+            data_format=data_format,
+            compression=compression,
+            compression_level=level,
+        ))
+        results.append(result)
+
+        line = "{:<8} {:<8} {:<6} {:>5} {:>4} {:>12} {:>8.2f}s {:>8.2f}s".format(
+            driver,
+            data_format,
+            compression,
+            "-" if level is None else level,
+            jobs,
+            result["bytes"],
+            result["backup"],
+            result["restore"],
+        )
+        if baselines:
+            baseline = baselines.get(tuple(result[k] for k in KEY))
+            line += " {:>8} {:>8}".format(
+                ratio(result, baseline, "backup"),
+                ratio(result, baseline, "restore"),
+            )
+        print(line)
+        sys.stdout.flush()
+
+    with open(args.output, "w") as fp:
+        json.dump(OrderedDict([
+            ("version", __version__),
+            ("created", time.strftime("%Y-%m-%dT%H:%M:%S")),
+            ("settings", OrderedDict([
+                ("rows", args.rows),
+                ("width", args.width),
+                ("toast_width", args.toast_width),
+                ("tables", args.tables),
+            ])),
+            ("results", results),
+        ]), fp, indent=2)
+    print("saved the results to {}".format(args.output))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
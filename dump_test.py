@@ -10,12 +10,24 @@ import unittest
 import subprocess
 import os
 import random
+import io
+import gzip
+import json
+import hashlib
+import asyncio
+import time
+import threading
 
 import testdata
 import dsnparse
 import psycopg2
 import psycopg2.extras
 
+from dump import archive, chunkstore, compression, counters, metrics
+from dump.pipeline import Pipeline
+from dump.scheduler import Scheduler
+from dump.interface import postgres
+
 
 class Connection(object):
     instance = None
@@ -133,14 +145,50 @@ class Bar(Foo):
     ]
 
 
+class Baz(Foo):
+    table_name = "baz"
+
+    fields = [
+        ("_id", "BIGSERIAL PRIMARY KEY"),
+        ("foo_id", "BIGINT REFERENCES foo (_id)"),
+    ]
+
+
+class Boo(Foo):
+    """a table that references itself"""
+    table_name = "boo"
+
+    fields = [
+        ("_id", "BIGSERIAL PRIMARY KEY"),
+        ("parent_id", "BIGINT REFERENCES boo (_id)"),
+        ("baz_id", "BIGINT REFERENCES baz (_id)"),
+    ]
+
+
+class Che(Foo):
+    """a table without a primary key"""
+    table_name = "che"
+
+    fields = [
+        ("_id", "BIGSERIAL"),
+        ("bar", "INTEGER"),
+    ]
+
+
 class Client(object):
     """makes running a command nice and easy for easy peasy testing"""
     @property
     def files(self):
+        """the backup files, without the manifest"""
         for path, dirs, files in os.walk(self.directory):
-            return [os.path.join(path, f) for f in files]
+            return [os.path.join(path, f) for f in files if f != "manifest.json"]
         #return files
 
+    @property
+    def manifest(self):
+        with open(os.path.join(self.directory, "manifest.json")) as fp:
+            return json.load(fp)
+
     def __init__(self):
         self.code = 0
         self.output = ""
@@ -157,9 +205,22 @@ class Client(object):
             "--debug",
         ])
 
+    def get_interface(self, **kwargs):
+        conn = Connection.get_instance()
+        kwargs.setdefault("directory", self.directory)
+        return postgres.Postgres(
+            dbname=conn.dbname,
+            username=conn.user,
+            password=conn.password,
+            host=conn.host,
+            port=conn.port,
+            **kwargs
+        )
+
     def run(self, arg_str):
         cmd = "python -m dump {}".format(arg_str)
 
+        self.code = 0
         try:
             self.output = subprocess.check_output(
                 cmd,
@@ -172,14 +233,23 @@ class Client(object):
             self.code = e.returncode
             self.output = e.output
 
-    def backup(self, *tables):
+    def get_arg_str(self, **kwargs):
+        arg_str = [self.arg_str]
+        for k, v in kwargs.items():
+            arg_str.append("--{}={}".format(k.replace("_", "-"), v))
+        return " ".join(arg_str)
+
+    def backup(self, *tables, **kwargs):
+        """tables can also have flags like --incremental in it"""
         subcommand = "backup"
-        arg_str = "{} {} {}".format(subcommand, self.arg_str, " ".join(tables))
+        arg_str = "{} {} {}".format(subcommand, self.get_arg_str(**kwargs), " ".join(tables))
         return self.run(arg_str)
 
-    def restore(self):
+    def restore(self, *flags, **kwargs):
         subcommand = "restore"
-        arg_str = "{} {}".format(subcommand, self.arg_str)
+        arg_str = "{} {}".format(subcommand, self.get_arg_str(**kwargs))
+        if flags:
+            arg_str += " " + " ".join(flags)
         return self.run(arg_str)
 
 
@@ -198,6 +268,7 @@ class DumpTest(unittest.TestCase):
         c = Client()
         c.backup(Foo.table_name)
         self.assertEqual(1, c.code, c.output)
+        self.assertEqual(0, len(c.files))
 
     def test_full_table_backup_and_restore(self):
         for x in range(100):
@@ -216,6 +287,10 @@ class DumpTest(unittest.TestCase):
         c.restore()
         self.assertEqual(100, Foo().count())
 
+        # the backup files should be left untouched by the restore
+        self.assertEqual(1, len(c.files))
+        self.assertTrue(c.files[0].endswith(".sql.gz"))
+
         f = Foo(bar=101)
         pk = f.save()
         self.assertLess(100, pk)
@@ -244,7 +319,1158 @@ class DumpTest(unittest.TestCase):
         self.assertEqual(count, Foo().count())
         self.assertEqual(count, Bar().count())
 
+    def test_multi_table_backup_jobs(self):
+        count = 10
+        for x in range(count):
+            Foo(bar=x).save()
+            Bar(foo=x).save()
+
+        c = Client()
+        c.backup(Foo.table_name, Bar.table_name, jobs=2)
+        self.assertEqual(0, c.code, c.output)
+        basenames = sorted(os.path.basename(path) for path in c.files)
+        self.assertEqual(["001_foo.sql.gz", "002_bar.sql.gz"], basenames)
+
+        self.setUp()
+        c.restore()
+        self.assertEqual(count, Foo().count())
+        self.assertEqual(count, Bar().count())
+
+    def test_multi_table_backup_jobs_failure(self):
+        Bar().delete()
+        c = Client()
+        c.backup(Foo.table_name, Bar.table_name, jobs=2)
+        self.assertEqual(1, c.code, c.output)
+
+    def test_table_globs(self):
+        Baz().install()
+        for x in range(10):
+            _id = Foo(bar=x).save()
+            Bar(foo=x).save()
+            Baz(foo_id=_id).save()
+
+        c = Client()
+        c.backup("'ba*'", Foo.table_name)
+        self.assertEqual(0, c.code, c.output)
+        basenames = sorted(os.path.basename(path) for path in c.files)
+        self.assertEqual(["001_public.bar.sql.gz", "002_public.baz.sql.gz", "003_foo.sql.gz"], basenames)
+
+        c = Client()
+        c.backup("'nope_*'")
+        self.assertEqual(1, c.code, c.output)
+
+        # the tables of every schema are found, and names are quoted if they
+        # have to be
+        f = Foo()
+        f.query("DROP SCHEMA IF EXISTS dump_globs CASCADE", ignore_result=True)
+        f.query("CREATE SCHEMA dump_globs", ignore_result=True)
+        f.query('CREATE TABLE dump_globs."Bar Mixed" (_id BIGSERIAL PRIMARY KEY)', ignore_result=True)
+        f.query('INSERT INTO dump_globs."Bar Mixed" DEFAULT VALUES', ignore_result=True)
+
+        c = Client()
+        c.backup("--all")
+        self.assertEqual(0, c.code, c.output)
+        tables = set(["public.foo", "public.bar", "public.baz", 'dump_globs."Bar Mixed"'])
+        self.assertLessEqual(tables, set(c.manifest["tables"].keys()))
+
+        c = Client()
+        c.backup("'dump_globs.*'")
+        self.assertEqual(0, c.code, c.output)
+        self.assertEqual(['dump_globs."Bar Mixed"'], list(c.manifest["tables"].keys()))
+
+        f.query('DROP TABLE dump_globs."Bar Mixed"', ignore_result=True)
+        c.restore("'Bar*'")
+        self.assertEqual(0, c.code, c.output)
+        self.assertEqual(1, f.query('SELECT COUNT(*) FROM dump_globs."Bar Mixed"')[0]["count"])
+        f.query("DROP SCHEMA dump_globs CASCADE", ignore_result=True)
+
+    def test_restore_foreign_key_order(self):
+        Baz().install()
+        count = 10
+        for x in range(count):
+            _id = Foo(bar=x).save()
+            Baz(foo_id=_id).save()
+
+        c = Client()
+        # baz is dumped first so restoring in file order would add its foreign
+        # key before foo exists
+        c.backup(Baz.table_name, Foo.table_name, jobs=2)
+        self.assertEqual(0, c.code, c.output)
+        # the order comes from the manifest, the scripts aren't read for it
+        self.assertEqual([["public", "foo"]], c.manifest["tables"]["baz"]["references"])
+        self.assertEqual([], c.manifest["tables"]["foo"]["references"])
+
+        Baz().delete()
+        Foo().delete()
+        c.restore(jobs=2)
+        self.assertEqual(0, c.code, c.output)
+        self.assertEqual(count, Foo().count())
+        self.assertEqual(count, Baz().count())
+        self.assertTrue(b"critical path" in c.output)
+
+        ret = Foo().query(
+            "SELECT COUNT(*) FROM pg_constraint WHERE contype = 'f' AND conrelid = 'baz'::regclass"
+        )
+        self.assertEqual(1, ret[0]["count"])
+
+        manifest = c.manifest
+        tables = dict((table, [(table, [os.path.join(c.directory, f["name"]) for f in record["files"]])])
+            for table, record in manifest["tables"].items())
+        Baz().delete()
+        Foo().delete()
+        db = c.get_interface()
+        def scan(path):
+            raise AssertionError("{} was scanned".format(path))
+        db._find_references = scan
+        self.assertEqual({"baz": set(["foo"])}, db._get_dependencies(tables, 2))
+
+        # a backup from before the manifest had the references has its scripts
+        # scanned instead
+        for record in manifest["tables"].values():
+            record.pop("references")
+        with open(os.path.join(c.directory, "manifest.json"), "w") as fp:
+            json.dump(manifest, fp)
+        db = c.get_interface()
+        self.assertEqual({"baz": set(["foo"])}, db._get_dependencies(tables, 2))
+
+    def test_restore_foreign_key_order_schemas(self):
+        Baz().install()
+        f = Foo()
+        f.query("DROP SCHEMA IF EXISTS dump_deps CASCADE", ignore_result=True)
+        f.query("CREATE SCHEMA dump_deps", ignore_result=True)
+        f.query("CREATE TABLE dump_deps.foo (_id BIGSERIAL PRIMARY KEY)", ignore_result=True)
+        f.query(
+            "CREATE TABLE dump_deps.baz (_id BIGSERIAL PRIMARY KEY, foo_id BIGINT REFERENCES dump_deps.foo (_id))",
+            ignore_result=True
+        )
+
+        db = Client().get_interface()
+        # the qualified name is the table in that schema, not the bare one
+        tables = {"foo": [], "dump_deps.foo": [], "baz": [], "dump_deps.baz": []}
+        self.assertEqual(
+            {"baz": set(["foo"]), "dump_deps.baz": set(["dump_deps.foo"])},
+            db._get_dependencies(tables),
+        )
+
+        # foo could be public.foo or dump_deps.foo so it isn't tied to either
+        tables = {"foo": [], "dump_deps.baz": []}
+        self.assertEqual({}, db._get_dependencies(tables))
+
+        # public.foo is the only other foo so that's the one the bare name is
+        tables = {"foo": [], "public.baz": [], "dump_deps.foo": []}
+        self.assertEqual({"public.baz": set(["foo"])}, db._get_dependencies(tables))
+
+        f.query("DROP SCHEMA dump_deps CASCADE", ignore_result=True)
+
+    def test_restore_fast(self):
+        Baz().install()
+        count = 10
+        for x in range(count):
+            _id = Foo(bar=x).save()
+            Baz(foo_id=_id).save()
+
+        for data_format in ["copy", "binary"]:
+            c = Client()
+            c.backup(Baz.table_name, Foo.table_name, jobs=2, chunks=2, data_format=data_format)
+            self.assertEqual(0, c.code, c.output)
+
+            Baz().delete()
+            Foo().delete()
+            c.restore("--fast", jobs=4)
+            self.assertEqual(0, c.code, c.output)
+            self.assertTrue(b"building indexes and constraints of table baz" in c.output)
+            self.assertEqual(count, Foo().count())
+            self.assertEqual(count, Baz().count())
+
+            ret = Foo().query(" ".join([
+                "SELECT contype, COUNT(*) FROM pg_constraint",
+                "WHERE conrelid IN ('foo'::regclass, 'baz'::regclass)",
+                "GROUP BY contype ORDER BY contype",
+            ]))
+            self.assertEqual([("f", 1), ("p", 2)], [(r["contype"], r["count"]) for r in ret])
+
+        # a post-data statement that fails fails the restore, a setting from the
+        # top of the script can still fail on its own
+        settings = b"SET nope_setting = 1;\n"
+        entry = b"-- Name: foo nope; Type: CONSTRAINT; Schema: public; Owner: -\n"
+        for backend in ["session", "process"]:
+            db = Client().get_interface()
+            db.backend = backend
+            db._restore_post_data("foo", [settings, entry, b"CREATE INDEX foo_bar_idx ON public.foo (bar);\n"])
+            # the session can still run a script that has errors in it
+            db._restore_post_data("foo", [settings])
+            with self.assertRaises(IOError):
+                db._restore_post_data("foo", [settings, entry, b"ALTER TABLE public.foo ADD CHECK (nope > 0);\n"])
+            db._close_sessions()
+            Foo().query("DROP INDEX foo_bar_idx", ignore_result=True)
+
+    def test_psycopg_driver(self):
+        count = 10
+        for x in range(count):
+            Foo(bar=x).save()
+
+        for data_format, chunks, names in [
+            ("copy", 1, ["001_foo.copy.gz", "001_foo.sql.gz"]),
+            ("binary", 2, ["001_foo.part1.pgcopy.gz", "001_foo.part2.pgcopy.gz", "001_foo.sql.gz"]),
+        ]:
+            c = Client()
+            c.backup(Foo.table_name, data_format=data_format, chunks=chunks, driver="psycopg")
+            self.assertEqual(0, c.code, c.output)
+            self.assertEqual(names, sorted(os.path.basename(f) for f in c.files))
+            self.assertEqual(count, c.manifest["tables"]["foo"]["rows"])
+
+            self.setUp()
+            c.restore()
+            self.assertEqual(0, c.code, c.output)
+            self.assertEqual(count, Foo().count())
+
+    def test_restore_backends(self):
+        count = 10
+        for x in range(count):
+            Foo(bar=x).save()
+
+        c = Client()
+        c.backup(Foo.table_name, data_format="binary")
+        self.assertEqual(0, c.code, c.output)
+
+        Foo().delete()
+        c.restore(backend="process")
+        self.assertEqual(0, c.code, c.output)
+        self.assertEqual(count, Foo().count())
+
+        # a table is restored in one transaction, so if its rows can't be loaded
+        # the table is left like it was
+        Foo(bar=count).save()
+        with open(os.path.join(c.directory, "001_foo.pgcopy.gz"), "wb") as fp:
+            fp.write(gzip.compress(b"not rows\n"))
+
+        c.restore(backend="session")
+        self.assertNotEqual(0, c.code, c.output)
+        self.assertEqual(count + 1, Foo().count())
+
+    def test_data_formats(self):
+        count = 10
+        for x in range(count):
+            Foo(bar=x).save()
+
+        for data_format, count_files in [("copy", 1), ("binary", 2), ("inserts", 1)]:
+            c = Client()
+            c.backup(Foo.table_name, data_format=data_format)
+            self.assertEqual(0, c.code, c.output)
+            self.assertEqual(count_files, len(c.files))
+
+            self.setUp()
+            c.restore()
+            self.assertEqual(0, c.code, c.output)
+            self.assertEqual(count, Foo().count())
+
+            # the sequence should have been restored also
+            pk = Foo(bar=count).save()
+            self.assertLess(count, pk)
+            Foo().query('DELETE FROM "{}" WHERE _id = %s'.format(Foo.table_name), [pk], ignore_result=True)
+
+    def test_other_schema(self):
+        table_name = "dump_other.users"
+        Foo().query("DROP SCHEMA IF EXISTS dump_other CASCADE", ignore_result=True)
+        Foo().query("CREATE SCHEMA dump_other", ignore_result=True)
+        Foo().query("CREATE TABLE {} (_id BIGSERIAL PRIMARY KEY, bar INTEGER)".format(table_name), ignore_result=True)
+        Foo().query(
+            "INSERT INTO {} (bar) SELECT generate_series(1, 5)".format(table_name),
+            ignore_result=True
+        )
+
+        for tables, kwargs in [
+            ([table_name], {}),
+            ([table_name, Foo.table_name], {"data_format": "binary", "chunks": 2}),
+        ]:
+            c = Client()
+            c.backup(*tables, **kwargs)
+            self.assertEqual(0, c.code, c.output)
+            basenames = [os.path.basename(path) for path in c.files]
+            self.assertIn("001_{}.sql.gz".format(table_name), basenames)
+
+            Foo().query("DROP TABLE {}".format(table_name), ignore_result=True)
+            c.restore()
+            self.assertEqual(0, c.code, c.output)
+            ret = Foo().query("SELECT COUNT(*) FROM {}".format(table_name))
+            self.assertEqual(5, ret[0]["count"])
+
+        # the table is moved out of its own schema into the target schema
+        for kwargs in [{"data_format": "binary"}, {"data_format": "binary", "chunks": 2}, {"chunks": 2}]:
+            Foo().query("DROP SCHEMA IF EXISTS dump_target CASCADE", ignore_result=True)
+            c = Client()
+            c.backup(table_name, **kwargs)
+            self.assertEqual(0, c.code, c.output)
+
+            c.restore("--target-schema=dump_target")
+            self.assertEqual(0, c.code, c.output)
+            ret = Foo().query("SELECT COUNT(*) FROM dump_target.users")
+            self.assertEqual(5, ret[0]["count"])
+            ret = Foo().query("INSERT INTO dump_target.users (bar) VALUES (6) RETURNING _id")
+            self.assertEqual(6, ret[0]["_id"])
+            ret = Foo().query("SELECT COUNT(*) FROM {}".format(table_name))
+            self.assertEqual(5, ret[0]["count"])
+
+        Foo().query("DROP SCHEMA dump_target CASCADE", ignore_result=True)
+        Foo().query("DROP SCHEMA dump_other CASCADE", ignore_result=True)
+
+    def test_compression(self):
+        count = 10
+        for x in range(count):
+            Foo(bar=x).save()
+
+        for name in sorted(compression.CODECS.keys()):
+            if name == "zstd" and not compression.zstandard:
+                continue
+
+            for threads in [1, 2]:
+                c = Client()
+                c.backup(Foo.table_name, compression=name, compression_level=1, compression_threads=threads)
+                self.assertEqual(0, c.code, c.output)
+                self.assertTrue(c.files[0].endswith(".sql" + compression.CODECS[name].extension))
+
+                self.setUp()
+                c.restore()
+                self.assertEqual(0, c.code, c.output)
+                self.assertEqual(count, Foo().count())
+
+    def test_chunks(self):
+        Che().install()
+        # enough rows that che, which is split by ctid, has more than 3 pages
+        count = 2000
+        for cls in [Foo, Che]:
+            cls().query(
+                'INSERT INTO "{}" (bar) SELECT generate_series(1, {})'.format(cls.table_name, count),
+                ignore_result=True
+            )
+
+        for table, cls in [(Foo.table_name, Foo), (Che.table_name, Che)]:
+            for data_format in ["copy", "binary"]:
+                c = Client()
+                c.backup(table, chunks=3, jobs=3, data_format=data_format)
+                self.assertEqual(0, c.code, c.output)
+                basenames = [os.path.basename(path) for path in c.files]
+                self.assertEqual(3, len([b for b in basenames if ".part" in b]), basenames)
+
+                cls().install()
+                c.restore(jobs=3)
+                self.assertEqual(0, c.code, c.output)
+                self.assertEqual(count, cls().count())
+                ret = cls().query('SELECT COUNT(DISTINCT bar) FROM "{}"'.format(table))
+                self.assertEqual(count, ret[0]["count"])
+
+        # jobs defaults to chunks but can still be passed in
+        c = Client()
+        c.get_interface().table_dump(Foo.table_name, chunks=3, jobs=1)
+        Foo().install()
+        c.restore()
+        self.assertEqual(0, c.code, c.output)
+        self.assertEqual(count, Foo().count())
+
+    def test_where(self):
+        count = 2000
+        Foo().query(
+            'INSERT INTO "{}" (bar) SELECT generate_series(1, {})'.format(Foo.table_name, count),
+            ignore_result=True
+        )
+
+        for data_format, chunks in [("copy", 1), ("binary", 1), ("copy", 3)]:
+            c = Client()
+            c.backup(Foo.table_name, "--where='bar > 1500'", chunks=chunks, jobs=chunks, data_format=data_format)
+            self.assertEqual(0, c.code, c.output)
+
+            Foo().install()
+            c.restore(jobs=chunks)
+            self.assertEqual(0, c.code, c.output)
+            self.assertEqual(500, Foo().count())
+            ret = Foo().query('SELECT MIN(bar) FROM "{}"'.format(Foo.table_name))
+            self.assertEqual(1501, ret[0]["min"])
+
+        # an empty table has one chunk without a WHERE clause of its own
+        Bar().install()
+        c = Client()
+        c.backup(Bar.table_name, "--where='foo > 1500'", chunks=3, jobs=3)
+        self.assertEqual(0, c.code, c.output)
+        c.restore(jobs=3)
+        self.assertEqual(0, c.code, c.output)
+        self.assertEqual(0, Bar().count())
+
+        c = Client()
+        db = c.get_interface()
+        db.select_dump(Foo.table_name, 'SELECT _id, bar * 2 FROM "{}" WHERE bar > 1990;'.format(Foo.table_name))
+        Foo().install()
+        c.restore()
+        self.assertEqual(0, c.code, c.output)
+        self.assertEqual(10, Foo().count())
+        ret = Foo().query('SELECT MAX(bar) FROM "{}"'.format(Foo.table_name))
+        self.assertEqual(4000, ret[0]["max"])
+
+        with self.assertRaises(ValueError):
+            db.select_dump(Foo.table_name, 'SELECT * FROM "{}"'.format(Foo.table_name), chunks=2)
+
+        with self.assertRaises(ValueError):
+            db.tables_dump([Foo.table_name], where="bar > 1", data_format="inserts")
+
+    def test_subset(self):
+        Baz().install()
+        Boo().install()
+        parent_id = None
+        for x in range(20):
+            foo_id = Foo(bar=x).save()
+            baz_id = Baz(foo_id=foo_id).save()
+            if x % 2:
+                # the odd rows reference the row before them
+                parent_id = Boo(parent_id=parent_id, baz_id=baz_id).save()
+            else:
+                parent_id = Boo(baz_id=baz_id).save()
+
+        c = Client()
+        c.backup(Boo.table_name, "--subset", "--where='_id IN (4, 8)'")
+        self.assertEqual(0, c.code, c.output)
+
+        for cls in [Boo, Baz, Foo]:
+            cls().delete()
+        c.restore()
+        self.assertEqual(0, c.code, c.output)
+        self.assertEqual(4, Boo().count())
+        self.assertEqual(4, Baz().count())
+        self.assertEqual(4, Foo().count())
+        ret = Foo().query('SELECT bar FROM "{}" ORDER BY bar'.format(Foo.table_name))
+        self.assertEqual([2, 3, 6, 7], [r["bar"] for r in ret])
+
+        c = Client()
+        db = c.get_interface()
+        db.subset_dump(Boo.table_name, percent=100)
+        self.assertEqual(3, len(db.manifest.tables))
+
+        Foo().query(
+            'ALTER TABLE "{}" ADD COLUMN baz_id BIGINT REFERENCES "{}" (_id)'.format(Foo.table_name, Baz.table_name),
+            ignore_result=True
+        )
+        with self.assertRaises(ValueError):
+            db.subset_dump(Boo.table_name, where="_id = 1")
+
+    def test_snapshot(self):
+        count = 10
+        for x in range(count):
+            Foo(bar=x).save()
+            Bar(foo=x).save()
+
+        c = Client()
+        db = c.get_interface()
+        with db.snapshot():
+            # these are committed after the snapshot so they shouldn't be dumped
+            Foo(bar=count).save()
+            Bar(foo=count).save()
+            db.tables_dump([Foo.table_name, Bar.table_name], jobs=2, chunks=2)
+
+        self.setUp()
+        c.restore()
+        self.assertEqual(0, c.code, c.output)
+        self.assertEqual(count, Foo().count())
+        self.assertEqual(count, Bar().count())
+
+    def test_incremental(self):
+        for x in range(10):
+            Foo(bar=x).save()
+
+        # the sql error of a watermark column that doesn't exist is raised
+        # before anything is dumped
+        c = Client()
+        c.backup(Foo.table_name, "--incremental", watermark="nope")
+        self.assertEqual(1, c.code, c.output)
+        self.assertIn(b'column "nope" does not exist', c.output)
+        self.assertEqual(0, len(c.files))
+
+        c.backup(Foo.table_name, "--incremental", watermark="bar")
+        self.assertEqual(0, c.code, c.output)
+
+        # an updated row and a new row
+        Foo().query('UPDATE "{}" SET bar = 100 WHERE _id = 1'.format(Foo.table_name), ignore_result=True)
+        Foo(bar=50).save()
+        c.backup(Foo.table_name, "--incremental")
+        self.assertEqual(0, c.code, c.output)
+
+        # nothing changed so there shouldn't be a new file
+        c.backup(Foo.table_name, "--incremental")
+        self.assertEqual(0, c.code, c.output)
+
+        Foo(bar=101).save()
+        c.backup(Foo.table_name, "--incremental")
+        self.assertEqual(0, c.code, c.output)
+
+        basenames = sorted(os.path.basename(path) for path in c.files)
+        self.assertEqual(
+            ["001_foo.inc1.copy.gz", "001_foo.inc2.copy.gz", "001_foo.sql.gz"],
+            basenames
+        )
+        self.assertEqual(["001_foo.inc1", "001_foo.inc2"], c.manifest["tables"]["foo"]["increments"])
+
+        self.setUp()
+        c.restore()
+        self.assertEqual(0, c.code, c.output)
+        self.assertEqual(12, Foo().count())
+        ret = Foo().query('SELECT bar FROM "{}" WHERE _id = 1'.format(Foo.table_name))
+        self.assertEqual(100, ret[0]["bar"])
+
+        # the sequence should have caught up with the increments
+        self.assertLess(12, Foo(bar=200).save())
+
+        # in fast mode the increments are loaded before the primary key is built
+        self.assertEqual(["_id"], c.manifest["tables"]["foo"]["primary_key"])
+        for flags in [["--fast"], ["--fast", "--backend=process"]]:
+            self.setUp()
+            c.restore(*flags)
+            self.assertEqual(0, c.code, c.output)
+            ret = Foo().query('SELECT COUNT(*) AS total, COUNT(DISTINCT _id) AS ids FROM "{}"'.format(Foo.table_name))
+            self.assertEqual((12, 12), (ret[0]["total"], ret[0]["ids"]))
+            ret = Foo().query("SELECT COUNT(*) FROM pg_constraint WHERE contype = 'p' AND conrelid = 'foo'::regclass")
+            self.assertEqual(1, ret[0]["count"])
+
+        # a backup from before the manifest had the primary key loads its
+        # increments once the key is built
+        manifest = c.manifest
+        manifest["tables"]["foo"].pop("primary_key")
+        with open(os.path.join(c.directory, "manifest.json"), "w") as fp:
+            json.dump(manifest, fp)
+        self.setUp()
+        c.restore("--fast")
+        self.assertEqual(0, c.code, c.output)
+        self.assertEqual(12, Foo().count())
+        ret = Foo().query('SELECT bar FROM "{}" WHERE _id = 1'.format(Foo.table_name))
+        self.assertEqual(100, ret[0]["bar"])
+
+        # the first incremental backup of a table only removes the files that
+        # a failed run left of that table, not the files of foo.bar
+        c = Client()
+        for name in ["002_foo.bar.sql.gz", "003_foo.sql.gz", "003_foo.part1.copy.gz"]:
+            with open(os.path.join(c.directory, name), "wb") as fp:
+                fp.write(b"")
+        c.backup(Foo.table_name, "--incremental")
+        self.assertEqual(0, c.code, c.output)
+        basenames = sorted(os.path.basename(path) for path in c.files)
+        self.assertEqual(["001_foo.sql.gz", "002_foo.bar.sql.gz"], basenames)
+
+    def test_previous_unchanged(self):
+        count = 10
+        for x in range(count):
+            Foo(bar=x).save()
+            Bar(foo=x).save()
+
+        # make sure the counters of these rows are flushed before the first
+        # backup, otherwise they could show up as a change in the second
+        Foo().query(" ".join([
+            "DO $$ BEGIN",
+            "IF current_setting('server_version_num')::int >= 150000 THEN",
+            "PERFORM pg_stat_force_next_flush();",
+            "END IF;",
+            "END $$",
+        ]), ignore_result=True)
+        Foo().query("SELECT 1")
+
+        # the row versions are only read when they are asked for
+        c = Client()
+        c.backup(Foo.table_name, Bar.table_name)
+        self.assertEqual(0, c.code, c.output)
+        self.assertIsNone(c.manifest["tables"]["bar"]["signature"]["rows"])
+
+        c1 = Client()
+        c1.backup(Foo.table_name, Bar.table_name, "--track-changes")
+        self.assertEqual(0, c1.code, c1.output)
+        self.assertIsNotNone(c1.manifest["tables"]["bar"]["signature"]["rows"])
+
+        # an update in place right before the backup, from a session that stays
+        # open so its change counters likely haven't been flushed yet, and the
+        # size of the table stays the same
+        Foo().query('UPDATE "{}" SET bar = -1 WHERE _id = 1'.format(Foo.table_name), ignore_result=True)
+
+        c2 = Client()
+        c2.backup(Foo.table_name, Bar.table_name, previous=c1.directory)
+        self.assertEqual(0, c2.code, c2.output)
+        self.assertFalse(c2.manifest["tables"]["foo"]["skipped"])
+        self.assertTrue(c2.manifest["tables"]["bar"]["skipped"])
+        # a backup with previous tracks its changes for the next one
+        self.assertIsNotNone(c2.manifest["tables"]["foo"]["signature"]["rows"])
+
+        # bar should be the same file as the previous backup
+        path1 = os.path.join(c1.directory, "002_bar.sql.gz")
+        path2 = os.path.join(c2.directory, "002_bar.sql.gz")
+        self.assertEqual(os.stat(path1).st_ino, os.stat(path2).st_ino)
+
+        self.setUp()
+        c2.restore()
+        self.assertEqual(0, c2.code, c2.output)
+        self.assertEqual(count, Foo().count())
+        self.assertEqual(count, Bar().count())
+        ret = Foo().query('SELECT bar FROM "{}" WHERE _id = 1'.format(Foo.table_name))
+        self.assertEqual(-1, ret[0]["bar"])
+
+    def test_restore_sequences(self):
+        for x in range(10):
+            Foo(bar=x).save()
+
+        f = Foo()
+        f.query("DROP SCHEMA IF EXISTS dump_seq CASCADE", ignore_result=True)
+        f.query("CREATE SCHEMA dump_seq", ignore_result=True)
+        f.query(
+            "CREATE TABLE dump_seq.che (_id INTEGER GENERATED BY DEFAULT AS IDENTITY, bar INTEGER)",
+            ignore_result=True,
+        )
+        f.query("INSERT INTO dump_seq.che (_id, bar) SELECT g, g FROM generate_series(1, 5) g", ignore_result=True)
+        f.query("SELECT setval('foo__id_seq', 1)")
+
+        c = Client()
+        db = c.get_interface()
+        db._restore_sequences(["foo", "dump_seq.che", "bar"])
+        self.assertEqual(11, Foo(bar=11).save())
+        ret = f.query("INSERT INTO dump_seq.che (bar) VALUES (6) RETURNING _id")
+        self.assertEqual(6, ret[0]["_id"])
+
+        # a sequence that is past its rows is left alone
+        f.query("SELECT setval('foo__id_seq', 100)")
+        db._restore_sequences(["foo"])
+        self.assertEqual(101, Foo(bar=101).save())
+        f.query("DROP SCHEMA dump_seq CASCADE", ignore_result=True)
+
+    def test_metrics(self):
+        for x in range(10):
+            Foo(bar=x).save()
+
+        c = Client()
+        events = []
+        prometheus_path = os.path.join(c.directory, "dump.prom")
+        db = c.get_interface()
+        db.metrics.listen(events.append)
+        db.metrics.listen(metrics.PrometheusTextfile(prometheus_path))
+        db.tables_dump([Foo.table_name], chunks=2)
+
+        files = [e for e in events if e["event"] == "file"]
+        self.assertEqual(3, len(files))
+        self.assertEqual(10, sum(e["rows"] for e in files))
+        for e in files:
+            self.assertEqual("backup", e["operation"])
+            self.assertEqual(["count", "compress", "write", "read"], list(e["stages"].keys()))
+            self.assertLess(0, e["bytes"])
+        # the base dump, the 2 parts, and saving the manifest
+        self.assertEqual(4, len([e for e in events if e["event"] == "job"]))
+        self.assertEqual("run", events[-1]["event"])
+        self.assertTrue(events[-1]["success"])
+
+        with open(prometheus_path) as fp:
+            body = fp.read()
+        self.assertTrue('dump_rows_total{operation="backup",table="foo"} 10' in body)
+        self.assertTrue('dump_last_run_success{operation="backup"} 1' in body)
+
+        Foo().delete()
+        c.restore("--events")
+        self.assertEqual(0, c.code, c.output)
+        lines = [json.loads(line) for line in c.output.splitlines() if line.startswith(b"{")]
+        files = [e for e in lines if e["event"] == "file"]
+        self.assertEqual(3, len(files))
+        self.assertEqual(["read", "load"], list(files[0]["stages"].keys()))
+        self.assertEqual("restore", lines[-1]["operation"])
+
+    def test_resume_backup(self):
+        for x in range(10):
+            Foo(bar=x).save()
+            Bar(foo=x).save()
+
+        c = Client()
+        db = c.get_interface()
+        table_dump = db._table_dump
+        def fail(table, *args, **kwargs):
+            if table == Bar.table_name:
+                raise IOError("bar failed")
+            return table_dump(table, *args, **kwargs)
+        db._table_dump = fail
+        with self.assertRaises(IOError):
+            db.tables_dump([Foo.table_name, Bar.table_name])
+        self.assertTrue(os.path.isfile(os.path.join(c.directory, "backup.checkpoint")))
+
+        foo_path = os.path.join(c.directory, "001_foo.sql.gz")
+        mtime = os.path.getmtime(foo_path)
+        time.sleep(0.01)
+        c.backup(Foo.table_name, Bar.table_name, "--resume")
+        self.assertEqual(0, c.code, c.output)
+        self.assertTrue(b"skipping 001_foo" in c.output)
+        self.assertEqual(mtime, os.path.getmtime(foo_path))
+        self.assertFalse(os.path.isfile(os.path.join(c.directory, "backup.checkpoint")))
+        self.assertEqual(10, c.manifest["tables"]["foo"]["rows"])
+        self.assertEqual(10, c.manifest["tables"]["bar"]["rows"])
+
+        # foo is from the snapshot of the failed backup, so restore warns about it
+        snapshots = set(
+            fields["snapshot"] for table in ["foo", "bar"] for fields in c.manifest["tables"][table]["files"]
+        )
+        self.assertEqual(2, len(snapshots))
+        c.restore()
+        self.assertEqual(0, c.code, c.output)
+        self.assertIn(b"files are from 2 snapshots", c.output)
+
+        # it has to be the same backup to be resumed
+        db = c.get_interface()
+        db._table_dump = fail
+        with self.assertRaises(IOError):
+            db.tables_dump([Foo.table_name, Bar.table_name])
+        c.backup(Foo.table_name, "--resume")
+        self.assertEqual(1, c.code, c.output)
+
+    def test_resume_restore(self):
+        for x in range(10):
+            Foo(bar=x).save()
+            Bar(foo=x).save()
+
+        c = Client()
+        c.backup(Foo.table_name, Bar.table_name)
+        self.assertEqual(0, c.code, c.output)
+
+        db = c.get_interface()
+        restore_table = db._restore_table
+        def fail(table, *args, **kwargs):
+            if table == Bar.table_name:
+                raise IOError("bar failed")
+            return restore_table(table, *args, **kwargs)
+        db._restore_table = fail
+        self.setUp()
+        with self.assertRaises(IOError):
+            db.restore()
+        self.assertEqual(10, Foo().count())
+        self.assertEqual(0, Bar().count())
+
+        # foo won't be loaded again so a row added to it stays
+        Foo(bar=100).save()
+        c.restore("--resume")
+        self.assertEqual(0, c.code, c.output)
+        self.assertEqual(11, Foo().count())
+        self.assertEqual(10, Bar().count())
+        self.assertFalse(os.path.isfile(os.path.join(c.directory, "restore.checkpoint")))
+
+    def test_restore_selected(self):
+        for x in range(10):
+            Foo(bar=x).save()
+            Bar(foo=x).save()
+
+        c = Client()
+        c.backup(Foo.table_name, Bar.table_name)
+        self.assertEqual(0, c.code, c.output)
+
+        # only bar is restored, so the row added to foo stays
+        Foo(bar=100).save()
+        Bar().delete()
+        c.restore("'b*'", "--exclude=foo")
+        self.assertEqual(0, c.code, c.output)
+        self.assertEqual(11, Foo().count())
+        self.assertEqual(10, Bar().count())
+
+        c.restore("nope")
+        self.assertNotEqual(0, c.code, c.output)
+
+        f = Foo()
+        f.query("DROP TABLE IF EXISTS foo_recovered", ignore_result=True)
+        f.query("DROP SCHEMA IF EXISTS dump_recovery CASCADE", ignore_result=True)
+
+        c.restore(Foo.table_name, "--target-table=foo_recovered")
+        self.assertEqual(0, c.code, c.output)
+        self.assertEqual(10, f.query("SELECT COUNT(*) AS c FROM foo_recovered")[0]["c"])
+        self.assertEqual(11, Foo().count())
+
+        c.restore("--target-schema=dump_recovery")
+        self.assertEqual(0, c.code, c.output)
+        self.assertEqual(10, f.query("SELECT COUNT(*) AS c FROM dump_recovery.foo")[0]["c"])
+        self.assertEqual(10, f.query("SELECT COUNT(*) AS c FROM dump_recovery.bar")[0]["c"])
+        ret = f.query("INSERT INTO dump_recovery.foo (bar) VALUES (11) RETURNING _id")
+        self.assertEqual(11, ret[0]["_id"])
+        self.assertEqual(11, Foo().count())
+
+        # the target table is created from the backup, so the dumped table
+        # doesn't have to exist, and its name is quoted
+        Foo().delete()
+        c.restore(Foo.table_name, "'--target-table=foo recovered'")
+        self.assertEqual(0, c.code, c.output)
+        self.assertEqual(10, f.query('SELECT COUNT(*) AS c FROM "foo recovered"')[0]["c"])
+        ret = f.query("SELECT to_regclass('foo') AS foo")
+        self.assertIsNone(ret[0]["foo"])
+
+        f.query("DROP TABLE foo_recovered", ignore_result=True)
+        f.query('DROP TABLE "foo recovered"', ignore_result=True)
+        f.query("DROP SCHEMA dump_recovery CASCADE", ignore_result=True)
+
+    def test_archive(self):
+        for x in range(10):
+            Foo(bar=x).save()
+            Bar(foo=x).save()
+
+        c = Client()
+        path = os.path.join(c.directory, "backup.dump")
+        c.run("backup {} {} {} > {}".format(c.get_arg_str(archive="-"), Foo.table_name, Bar.table_name, path))
+        self.assertEqual(0, c.code, c.output)
+
+        a = archive.Archive(path)
+        self.assertEqual(["001_foo.sql.gz", "002_bar.sql.gz", "manifest.json"], a.names())
+        self.assertEqual(
+            os.path.getsize(os.path.join(c.directory, "002_bar.sql.gz")),
+            a.get_size("002_bar.sql.gz"),
+        )
+        self.assertIn(b"COPY public.bar", b"".join(a.read_chunks("002_bar.sql.gz")))
+        a.close()
+
+        # only the frame of bar is read
+        Foo(bar=100).save()
+        Bar().delete()
+        r = Client()
+        r.restore(Bar.table_name, archive=path)
+        self.assertEqual(0, r.code, r.output)
+        self.assertEqual(10, Bar().count())
+        self.assertEqual(11, Foo().count())
+
+        with open(path, "rb") as fp:
+            data = fp.read()
+        with open(path, "wb") as fp:
+            fp.write(data[:-10])
+        with self.assertRaises(ValueError):
+            archive.Archive(path)
+
+        # without a directory the backup and restore go through a temporary
+        # directory, each file is written into the archive as soon as it is
+        # dumped, and every backup goes into the one archive until it is closed
+        path = os.path.join(c.directory, "tmp.dump")
+        db = c.get_interface(directory=None, archive=path)
+        db.tables_dump([Bar.table_name])
+        self.assertEqual(["manifest.json"], os.listdir(db.tmp_directory))
+        db.tables_dump([Foo.table_name])
+        db.close()
+        self.assertFalse(os.path.exists(db.tmp_directory))
+        a = archive.Archive(path)
+        self.assertEqual(["001_bar.sql.gz", "002_foo.sql.gz", "manifest.json"], a.names())
+        a.close()
+
+        Bar().delete()
+        db = c.get_interface(directory=None, archive=path)
+        with self.assertRaises(ValueError):
+            db.restore(resume=True)
+        db.restore(tables=[Bar.table_name])
+        self.assertEqual(10, Bar().count())
+        db.close()
+        self.assertFalse(os.path.exists(db.tmp_directory))
+
+        # without an archive the temporary directory is the backup so it's kept
+        db = c.get_interface(directory=None)
+        db.tables_dump([Bar.table_name])
+        directory = db.directory
+        del db
+        self.assertEqual(1, len([name for name in os.listdir(directory) if name.endswith(".sql.gz")]))
+
+    def test_chunk_store(self):
+        f = Foo()
+        f.query("DROP TABLE IF EXISTS dump_chunks", ignore_result=True)
+        f.query("CREATE TABLE dump_chunks (_id SERIAL PRIMARY KEY, body TEXT)", ignore_result=True)
+        f.query(
+            "INSERT INTO dump_chunks (body) SELECT md5(g::text) FROM generate_series(1, 200000) g",
+            ignore_result=True,
+        )
+
+        store = testdata.create_dir()
+        c1 = Client()
+        c1.backup("dump_chunks", store=store)
+        self.assertEqual(0, c1.code, c1.output)
+        f.query("UPDATE dump_chunks SET body = 'changed' WHERE _id = 10", ignore_result=True)
+        c2 = Client()
+        c2.backup("dump_chunks", store=store)
+        self.assertEqual(0, c2.code, c2.output)
+
+        first = c1.manifest["tables"]["dump_chunks"]["files"][0]
+        second = c2.manifest["tables"]["dump_chunks"]["files"][0]
+        self.assertEqual("001_dump_chunks.sql.gz.chunks", second["name"])
+        self.assertLess(second["stored_bytes"] * 5, first["stored_bytes"])
+
+        c2.restore(store=store)
+        self.assertEqual(0, c2.code, c2.output)
+        self.assertEqual(200000, f.query("SELECT COUNT(*) AS c FROM dump_chunks")[0]["c"])
+        self.assertEqual("changed", f.query("SELECT body FROM dump_chunks WHERE _id = 10")[0]["body"])
+
+        c2.restore()
+        self.assertNotEqual(0, c2.code, c2.output)
+
+        # only the chunks of the first backup that the second doesn't use go
+        db = c2.get_interface(store=store)
+        count, size = db.store.prune([c2.directory])
+        self.assertLess(0, count)
+        c2.restore(store=store)
+        self.assertEqual(0, c2.code, c2.output)
+        self.assertEqual(200000, f.query("SELECT COUNT(*) AS c FROM dump_chunks")[0]["c"])
+
+        # the chunks of the recipes in an archive are kept too
+        f.query("UPDATE dump_chunks SET body = 'changed again' WHERE _id = 10", ignore_result=True)
+        c3 = Client()
+        archive_path = os.path.join(c3.directory, "backup.dump")
+        c3.backup("dump_chunks", store=store, archive=archive_path)
+        self.assertEqual(0, c3.code, c3.output)
+        db.store.prune([c2.directory, archive_path])
+        c3.restore(store=store, archive=archive_path)
+        self.assertEqual(0, c3.code, c3.output)
+        self.assertEqual("changed again", f.query("SELECT body FROM dump_chunks WHERE _id = 10")[0]["body"])
+
+        # prune waits for the backups writing to the store
+        pruned = []
+        with db.store.lock(shared=True):
+            thread = threading.Thread(target=lambda: pruned.append(db.store.prune([c2.directory, archive_path])))
+            thread.start()
+            time.sleep(0.2)
+            self.assertEqual([], pruned)
+        thread.join()
+        self.assertEqual(1, len(pruned))
+        f.query("DROP TABLE dump_chunks", ignore_result=True)
+
+    def test_verify(self):
+        for x in range(10):
+            Foo(bar=x).save()
+            Bar(foo=x).save()
+
+        c = Client()
+        c.backup(Foo.table_name, Bar.table_name, data_format="binary", chunks=2)
+        self.assertEqual(0, c.code, c.output)
+
+        c.run("verify --dir={} --jobs=2".format(c.directory))
+        self.assertEqual(0, c.code, c.output)
+        self.assertIn(b"PASSED", c.output)
+
+        # a flipped bit fails the sha256 and the gzip CRC
+        path = os.path.join(c.directory, "002_bar.part1.pgcopy.gz")
+        with open(path, "rb") as fp:
+            data = bytearray(fp.read())
+        data[len(data) // 2] ^= 1
+        with open(path, "wb") as fp:
+            fp.write(data)
+        c.run("verify --dir={}".format(c.directory))
+        self.assertEqual(1, c.code, c.output)
+        self.assertIn(b"002_bar.part1.pgcopy.gz", c.output)
+
+        os.unlink(path)
+        c.run("verify --dir={}".format(c.directory))
+        self.assertEqual(1, c.code, c.output)
+
+    def test_manifest(self):
+        Che().install()
+        count = 10
+        for x in range(count):
+            Foo(bar=x).save()
+            Che(bar=x).save()
+
+        c = Client()
+        c.backup(Foo.table_name, Che.table_name, data_format="binary")
+        self.assertEqual(0, c.code, c.output)
+
+        tables = c.manifest["tables"]
+        for table, name in [("foo", "001_foo"), ("che", "002_che")]:
+            record = tables[table]
+            self.assertEqual(count, record["rows"])
+            self.assertEqual(
+                ["{}.pgcopy.gz".format(name), "{}.sql.gz".format(name)],
+                [f["name"] for f in record["files"]]
+            )
+
+            for f in record["files"]:
+                path = os.path.join(c.directory, f["name"])
+                with open(path, "rb") as fp:
+                    body = fp.read()
+                self.assertEqual(len(body), f["bytes"])
+                self.assertEqual(hashlib.sha256(body).hexdigest(), f["sha256"])
+                self.assertEqual(len(gzip.decompress(body)), f["raw_bytes"])
+
+            # restore jobs are weighed by the decompressed bytes
+            paths = [os.path.join(c.directory, f["name"]) for f in record["files"]]
+            self.assertEqual(record["raw_bytes"], c.get_interface()._get_raw_size(*paths))
+
+        # files that aren't in the manifest are never restored
+        with open(os.path.join(c.directory, "003_bar.sql.gz"), "wb") as fp:
+            fp.write(gzip.compress(b"INSERT INTO bar (foo) VALUES (1);\n"))
+
+        self.setUp()
+        Che().install()
+        c.restore()
+        self.assertEqual(0, c.code, c.output)
+        self.assertEqual(count, Foo().count())
+        self.assertEqual(count, Che().count())
+        self.assertEqual(0, Bar().count())
+
+
+class CompressionTest(unittest.TestCase):
+    def test_block_gzip(self):
+        data = os.urandom(1024) * 300
+        codec = compression.Gzip(threads=4, block_size=10000)
+        compressor = codec.compressor()
+        body = compressor.compress(data[:5000]) + compressor.compress(data[5000:]) + compressor.flush()
+
+        # concatenated gzip members are still one valid gzip file
+        self.assertEqual(data, gzip.GzipFile(fileobj=io.BytesIO(body)).read())
+        self.assertEqual(data, b"".join(codec.decompress_chunks(io.BytesIO(body), 1000)))
+
+    def test_empty(self):
+        for threads in [1, 2]:
+            codec = compression.Gzip(threads=threads)
+            compressor = codec.compressor()
+            body = compressor.flush()
+            self.assertEqual(b"", gzip.GzipFile(fileobj=io.BytesIO(body)).read())
+
+    def test_row_counters(self):
+        script = b"".join([
+            b"CREATE TABLE foo (bar text);\n",
+            b"COPY public.foo (bar) FROM stdin;\n",
+            b"a\n",
+            b"b\\nc\n",
+            b"d\n",
+            b"\\.\n",
+            b"INSERT INTO public.foo (bar) VALUES ('e');\n",
+        ])
+        binary = b"".join([
+            counters.PGCOPY_SIGNATURE,
+            b"\x00\x00\x00\x00",
+            b"\x00\x00\x00\x00",
+            b"\x00\x02\x00\x00\x00\x01a\xff\xff\xff\xff",
+            b"\x00\x02\x00\x00\x00\x03abc\x00\x00\x00\x00",
+            b"\xff\xff",
+        ])
+        for counter_class, data, rows in [
+            (counters.ScriptRowCounter, script, 4),
+            (counters.CopyRowCounter, b"a\nb\\nc\n", 2),
+            (counters.BinaryRowCounter, binary, 2),
+        ]:
+            # the rows should be counted no matter where the data is split
+            for size in [1, 2, 3, 7, len(data)]:
+                counter = counter_class()
+                for i in range(0, len(data), size):
+                    counter.write(data[i:i + size])
+                self.assertEqual(rows, counter.rows, "{} {}".format(counter_class.__name__, size))
+
+    def test_chunks(self):
+        store = chunkstore.ChunkStore(testdata.create_dir())
+        codec = store.codec(compression.Gzip())
+        lines = [("{}\t{}\n".format(i, hashlib.md5(str(i).encode("utf-8")).hexdigest())).encode("utf-8") for i in range(50000)]
+        paths = []
+        for i, data in enumerate([b"".join(lines), b"".join(lines[:10] + [b"new\n"] + lines[10:])]):
+            path = os.path.join(store.directory, "{}.copy.gz.chunks".format(i))
+            with codec.writer(path) as fp:
+                fp.write(data[:1000])
+                fp.write(data[1000:])
+            self.assertEqual(data, b"".join(codec.read_chunks(path)))
+            paths.append((path, fp))
+
+        # the chunks after the new line line up again
+        digests = []
+        for path, _ in paths:
+            with open(path, "rb") as fp:
+                digests.append([digest for digest, _ in chunkstore.read_recipe(fp)[1]])
+        self.assertLess(1, len(digests[0]))
+        self.assertEqual(1, len(set(digests[1]) - set(digests[0])))
+        self.assertLess(paths[1][1].stored_bytes * 2, paths[0][1].stored_bytes)
+
+    def test_truncated(self):
+        codec = compression.Gzip()
+        body = codec.compress_block(os.urandom(10000))
+        with self.assertRaises(EOFError):
+            b"".join(codec.decompress_chunks(io.BytesIO(body[:-10])))
+
+
+
+class PipelineTest(unittest.TestCase):
+    def test_pipe(self):
+        chunks = [b"foo\n", b"bar\n", b"che\n"]
+        pipeline = Pipeline([(["cat"], {}), (["wc", "-l"], {})], stdin=chunks)
+        output = asyncio.run(pipeline.run())
+        self.assertEqual(b"3", output.strip())
+
+    def test_stdout(self):
+        output = []
+        pipeline = Pipeline([(["seq", "100000"], {})], stdout=output.append)
+        self.assertEqual(None, asyncio.run(pipeline.run()))
+        self.assertEqual(100000, b"".join(output).count(b"\n"))
+
+    def test_failure(self):
+        pipeline = Pipeline([(["false"], {})])
+        with self.assertRaises(IOError):
+            asyncio.run(pipeline.run())
+
+    def test_timeout(self):
+        pipeline = Pipeline([(["sleep", "10"], {})], timeout=0.2)
+        start = time.time()
+        with self.assertRaises(IOError):
+            asyncio.run(pipeline.run())
+        self.assertLess(time.time() - start, 5)
+        self.assertIsNotNone(pipeline.procs[0].returncode)
+
+    def test_cancel(self):
+        async def run():
+            pipelines = [Pipeline([(["sleep", "10"], {})]) for _ in range(10)]
+            tasks = [asyncio.ensure_future(pipeline.run()) for pipeline in pipelines]
+            await asyncio.sleep(0.2)
+            for task in tasks:
+                task.cancel()
+            await asyncio.wait(tasks)
+            return pipelines
+
+        start = time.time()
+        pipelines = asyncio.run(run())
+        self.assertLess(time.time() - start, 5)
+        for pipeline in pipelines:
+            self.assertIsNotNone(pipeline.procs[0].returncode)
+
+
+class SchedulerTest(unittest.TestCase):
+    def test_largest_first(self):
+        order = []
+        s = Scheduler(1)
+        for name, cost in [("small", 1), ("big", 100), ("medium", 10), ("child", 150)]:
+            s.add(name, order.append, name)
+            s.weigh(name, cost)
+
+        # small has the most work ahead of it once child is waiting on it
+        s.depend("child", "small")
+        s.run()
+        self.assertEqual(["small", "child", "big", "medium"], order)
+
+    def test_predict(self):
+        s = Scheduler(2)
+        for name, cost in [("a", 4), ("b", 3), ("c", 2), ("d", 1)]:
+            s.add(name, time.sleep, 0)
+            s.weigh(name, cost)
+
+        # a and d on one thread, b and c on the other
+        self.assertEqual(5.0, s.predict(1.0))
+        self.assertEqual(2.5, s.predict(2.0))
+        self.assertEqual(2.0, s.predict(1.0, done=set(["a", "b"])))
+
+        s.depend("d", "a")
+        self.assertEqual(5.0, s.predict(1.0))
+        s.depend("c", "d")
+        self.assertEqual(7.0, s.predict(1.0))
+
+    def test_measure(self):
+        s = Scheduler(2)
+        self.assertEqual((None, 0.0), s.measure())
+
+        for name, cost in [("a", 4), ("b", 3)]:
+            s.add(name, time.sleep, 0)
+            s.weigh(name, cost)
+            s.queue[name].start = 0.0
+            s.queue[name].stop = 1.0
+
+        # the jobs took as long as each other so all of the time is work
+        self.assertEqual((3.5, 0.0), s.measure())
+
+        s.queue["a"].stop = 5.0
+        self.assertEqual((1.0, 1.0), s.measure())
+
+    def test_initial_prediction(self):
+        s = Scheduler(1)
+        for name in ["a", "b"]:
+            s.add(name, time.sleep, 0)
+            s.weigh(name, 1)
+
+        # a prediction is logged before any job has finished
+        with self.assertLogs("dump.scheduler", "INFO") as logs:
+            s.run()
+        self.assertTrue(any("predicted to finish" in line for line in logs.output[:2]), logs.output)
+
 
 if __name__ == '__main__':
     unittest.main()
-
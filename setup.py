@@ -28,7 +28,11 @@ setup(
     packages=find_packages(),
     #py_modules=[name],
     license="MIT",
+    python_requires=">=3.8",
     #install_requires=[],
+    extras_require={
+        "psycopg": ["psycopg2"],
+    },
     tests_require=["dsnparse", "psycopg2", "testdata"],
     classifiers=[ # https://pypi.python.org/pypi?:action=list_classifiers
         'Development Status :: 4 - Beta',
@@ -39,8 +43,12 @@ setup(
         'Topic :: Database',
         'Topic :: Software Development :: Libraries',
         'Topic :: Utilities',
-        'Programming Language :: Python :: 2.7',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
     entry_points = {
         'console_scripts': ['{} = {}.__main__:console'.format(name, name)]